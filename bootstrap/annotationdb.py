@@ -0,0 +1,408 @@
+import json
+import sqlite3
+import argparse
+from pathlib import Path
+from typing import Optional, List, Union, Generator, Tuple, Dict
+
+from bootstrap import config
+from bootstrap.journal import load_source_data
+from bootstrap.positions import decode_positions, encode_tiling_positions
+
+
+TILING_PARAMS = (
+    "offset_x", "offset_y", "patch_size_x", "patch_size_y", "spacing_x", "spacing_y", "size_x", "size_y",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL UNIQUE,
+    extra TEXT
+);
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    source_id INTEGER NOT NULL REFERENCES sources(id) ON DELETE CASCADE,
+    filename TEXT NOT NULL,
+    alpha TEXT,
+    extra TEXT,
+    UNIQUE (source_id, filename)
+);
+CREATE TABLE IF NOT EXISTS tilings (
+    id INTEGER PRIMARY KEY,
+    image_id INTEGER NOT NULL REFERENCES images(id) ON DELETE CASCADE,
+    tiling_index INTEGER NOT NULL,
+    offset_x INTEGER NOT NULL,
+    offset_y INTEGER NOT NULL,
+    patch_size_x INTEGER NOT NULL,
+    patch_size_y INTEGER NOT NULL,
+    spacing_x INTEGER NOT NULL,
+    spacing_y INTEGER NOT NULL,
+    size_x INTEGER NOT NULL,
+    size_y INTEGER NOT NULL,
+    extra TEXT,
+    UNIQUE (image_id, tiling_index)
+);
+CREATE TABLE IF NOT EXISTS tile_labels (
+    tiling_id INTEGER NOT NULL REFERENCES tilings(id) ON DELETE CASCADE,
+    row INTEGER NOT NULL,
+    col INTEGER NOT NULL,
+    label TEXT NOT NULL,
+    PRIMARY KEY (tiling_id, row, col, label)
+);
+CREATE INDEX IF NOT EXISTS tile_labels_label ON tile_labels (label);
+CREATE TABLE IF NOT EXISTS tile_ignores (
+    tiling_id INTEGER NOT NULL REFERENCES tilings(id) ON DELETE CASCADE,
+    row INTEGER NOT NULL,
+    col INTEGER NOT NULL,
+    PRIMARY KEY (tiling_id, row, col)
+);
+CREATE TABLE IF NOT EXISTS duplicates (
+    url TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    tiling_index INTEGER NOT NULL,
+    row INTEGER NOT NULL,
+    col INTEGER NOT NULL,
+    PRIMARY KEY (url, filename, tiling_index, row, col)
+);
+CREATE TABLE IF NOT EXISTS labels (
+    name TEXT PRIMARY KEY,
+    color TEXT NOT NULL
+);
+"""
+
+
+class AnnotationDatabase:
+    """
+    SQLite store of all annotations, as an alternative to the
+    `data/oga/*.json`, `duplicates.json` and `labels.json` files.
+
+    Source data is read and written in the same layout as the json files,
+    i.e. `{"url": ..., "images": [{"filename": <relative to web folder>, "tilings": [...]}]}`.
+    The `duplicates` table mirrors duplicates.json, where the filename
+    is relative to the web-cache.
+    """
+    def __init__(self, filename: Union[str, Path]):
+        self.filename = Path(filename)
+        # compile.py reads the sources in a pipeline thread
+        self.connection = sqlite3.connect(str(self.filename), check_same_thread=False)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    # --- sources ---
+
+    def source_urls(self) -> List[str]:
+        return [row[0] for row in self.connection.execute("SELECT url FROM sources ORDER BY url")]
+
+    def get_source_data(self, url: str) -> Optional[dict]:
+        row = self.connection.execute("SELECT id, extra FROM sources WHERE url = ?", (url, )).fetchone()
+        if row is None:
+            return None
+        source_id, extra = row
+
+        images = []
+        image_rows = self.connection.execute(
+            "SELECT id, filename, alpha, extra FROM images WHERE source_id = ? ORDER BY id", (source_id, )
+        ).fetchall()
+        for image_id, filename, alpha, image_extra in image_rows:
+            image = {
+                **json.loads(image_extra or "{}"),
+                "filename": filename,
+                "tilings": self._get_tilings(image_id),
+            }
+            if alpha:
+                image["alpha"] = json.loads(alpha)
+            images.append(image)
+
+        return {**json.loads(extra or "{}"), "url": url, "images": images}
+
+    def _get_tilings(self, image_id: int) -> List[dict]:
+        tilings = []
+        tiling_rows = self.connection.execute(
+            f"SELECT id, {', '.join(TILING_PARAMS)}, extra FROM tilings WHERE image_id = ? ORDER BY tiling_index",
+            (image_id, )
+        ).fetchall()
+        for tiling_id, *params, extra in tiling_rows:
+            tiling = {
+                **json.loads(extra or "{}"),
+                **dict(zip(TILING_PARAMS, params)),
+            }
+
+            ignore = self.connection.execute(
+                "SELECT row, col FROM tile_ignores WHERE tiling_id = ? ORDER BY row, col", (tiling_id, )
+            ).fetchall()
+            if ignore:
+                tiling["ignore"] = [list(p) for p in ignore]
+
+            labels = {}
+            for label, row, col in self.connection.execute(
+                    "SELECT label, row, col FROM tile_labels WHERE tiling_id = ? ORDER BY label, row, col",
+                    (tiling_id, )
+            ):
+                labels.setdefault(label, []).append([row, col])
+            if labels:
+                tiling["labels"] = labels
+
+            tilings.append(tiling)
+        return tilings
+
+    def save_source_data(self, data: dict, commit: bool = True):
+        """
+        Replace all data of one source, `data` is in the json-file layout
+        """
+        cursor = self.connection.cursor()
+        extra = {key: value for key, value in data.items() if key not in ("url", "images")}
+        cursor.execute(
+            "INSERT INTO sources (url, extra) VALUES (?, ?)"
+            " ON CONFLICT(url) DO UPDATE SET extra = excluded.extra",
+            (data["url"], json.dumps(extra)),
+        )
+        source_id = cursor.execute("SELECT id FROM sources WHERE url = ?", (data["url"], )).fetchone()[0]
+        cursor.execute("DELETE FROM images WHERE source_id = ?", (source_id, ))
+
+        for image in data.get("images") or []:
+            if not image.get("tilings"):
+                continue
+            image_extra = {
+                key: value for key, value in image.items() if key not in ("filename", "alpha", "tilings")
+            }
+            cursor.execute(
+                "INSERT INTO images (source_id, filename, alpha, extra) VALUES (?, ?, ?, ?)",
+                (source_id, image["filename"], json.dumps(image["alpha"]) if image.get("alpha") else None,
+                 json.dumps(image_extra)),
+            )
+            image_id = cursor.lastrowid
+
+            for tiling_index, tiling in enumerate(image["tilings"]):
+                tiling_extra = {
+                    key: value for key, value in tiling.items()
+                    if key not in TILING_PARAMS and key not in ("ignore", "labels", "duplicates")
+                }
+                cursor.execute(
+                    f"INSERT INTO tilings (image_id, tiling_index, {', '.join(TILING_PARAMS)}, extra)"
+                    f" VALUES (?, ?, {', '.join('?' for _ in TILING_PARAMS)}, ?)",
+                    (
+                        image_id, tiling_index,
+                        *(tiling.get(key) or 0 for key in TILING_PARAMS),
+                        json.dumps(tiling_extra),
+                    ),
+                )
+                tiling_id = cursor.lastrowid
+
+                cursor.executemany(
+                    "INSERT INTO tile_ignores (tiling_id, row, col) VALUES (?, ?, ?)",
+                    ((tiling_id, *pos) for pos in decode_positions(tiling.get("ignore"))),
+                )
+                for label, positions in (tiling.get("labels") or {}).items():
+                    cursor.executemany(
+                        "INSERT INTO tile_labels (tiling_id, row, col, label) VALUES (?, ?, ?, ?)",
+                        ((tiling_id, *pos, label) for pos in decode_positions(positions)),
+                    )
+
+        if commit:
+            self.connection.commit()
+
+    # --- duplicates ---
+
+    def get_duplicates_map(self) -> dict:
+        """
+        Returns the duplicates in the duplicates.json layout
+        """
+        duplicates_map = {}
+        for url, filename, tiling_index, row, col in self.connection.execute(
+                "SELECT url, filename, tiling_index, row, col FROM duplicates ORDER BY url, filename, tiling_index"
+        ):
+            tilings = duplicates_map.setdefault(url, {}).setdefault(filename, {})
+            tilings.setdefault(str(tiling_index), []).append([row, col])
+        return duplicates_map
+
+    def set_duplicates_map(self, duplicates_map: dict, commit: bool = True):
+        cursor = self.connection.cursor()
+        cursor.execute("DELETE FROM duplicates")
+        cursor.executemany(
+            "INSERT OR IGNORE INTO duplicates (url, filename, tiling_index, row, col) VALUES (?, ?, ?, ?, ?)",
+            (
+                (url, filename, int(tiling_index), *pos)
+                for url, images in duplicates_map.items()
+                for filename, tilings in images.items()
+                for tiling_index, positions in tilings.items()
+                for pos in decode_positions(positions)
+            )
+        )
+        if commit:
+            self.connection.commit()
+
+    # --- labels ---
+
+    def get_labels(self) -> List[dict]:
+        return [
+            {"name": name, "color": json.loads(color)}
+            for name, color in self.connection.execute("SELECT name, color FROM labels ORDER BY name")
+        ]
+
+    def set_labels(self, labels: List[dict], commit: bool = True):
+        cursor = self.connection.cursor()
+        cursor.execute("DELETE FROM labels")
+        cursor.executemany(
+            "INSERT OR REPLACE INTO labels (name, color) VALUES (?, ?)",
+            ((label["name"], json.dumps(label["color"])) for label in labels),
+        )
+        if commit:
+            self.connection.commit()
+
+    # --- queries ---
+
+    def iter_labeled_tiles(
+            self,
+            label: Optional[str] = None,
+    ) -> Generator[Tuple[str, str, int, int, int, str], None, None]:
+        """
+        Yields (url, image filename, tiling index, row, col, label) of all labeled tiles,
+        or only of the given label
+        """
+        query = """
+            SELECT sources.url, images.filename, tilings.tiling_index,
+                tile_labels.row, tile_labels.col, tile_labels.label
+            FROM tile_labels
+            JOIN tilings ON tilings.id = tile_labels.tiling_id
+            JOIN images ON images.id = tilings.image_id
+            JOIN sources ON sources.id = images.source_id
+        """
+        params = ()
+        if label is not None:
+            query += " WHERE tile_labels.label = ?"
+            params = (label, )
+        query += " ORDER BY sources.url, images.filename, tilings.tiling_index, tile_labels.row, tile_labels.col"
+        yield from self.connection.execute(query, params)
+
+    def label_counts(self, by_source: bool = False) -> Dict[str, Union[int, Dict[str, int]]]:
+        """
+        Number of labeled tiles per label, or per source url and label
+        """
+        if not by_source:
+            return {
+                label: count
+                for label, count in self.connection.execute(
+                    "SELECT label, COUNT(*) FROM tile_labels GROUP BY label ORDER BY label"
+                )
+            }
+
+        counts = {}
+        for url, label, count in self.connection.execute("""
+            SELECT sources.url, tile_labels.label, COUNT(*)
+            FROM tile_labels
+            JOIN tilings ON tilings.id = tile_labels.tiling_id
+            JOIN images ON images.id = tilings.image_id
+            JOIN sources ON sources.id = images.source_id
+            GROUP BY sources.url, tile_labels.label
+            ORDER BY sources.url, tile_labels.label
+        """):
+            counts.setdefault(url, {})[label] = count
+        return counts
+
+    # --- json import / export ---
+
+    def import_json(self, data_path: Union[str, Path] = config.BOOTSTRAP_DATA_PATH):
+        """
+        Replace the database content with the json files (and journals) in `data_path`
+        """
+        data_path = Path(data_path)
+        with self.connection:
+            self.connection.execute("DELETE FROM sources")
+
+            filenames = set(
+                file.with_suffix(".json")
+                for pattern in ("*.json", "*.journal")
+                for file in (data_path / "oga").glob(pattern)
+            )
+            for filename in sorted(filenames):
+                data = load_source_data(filename)
+                if data.get("url"):
+                    self.save_source_data(data, commit=False)
+
+            filename = data_path / "duplicates.json"
+            self.set_duplicates_map(json.loads(filename.read_text()) if filename.exists() else {}, commit=False)
+
+            filename = data_path / "labels.json"
+            self.set_labels(json.loads(filename.read_text()) if filename.exists() else [], commit=False)
+
+    def export_json(self, data_path: Union[str, Path] = config.BOOTSTRAP_DATA_PATH):
+        """
+        Write the database content as json files to `data_path`
+        """
+        data_path = Path(data_path)
+        (data_path / "oga").mkdir(parents=True, exist_ok=True)
+
+        for url in self.source_urls():
+            data = self.get_source_data(url)
+            if config.BOOTSTRAP_COMPACT_POSITIONS:
+                for image in data["images"]:
+                    for tiling in image["tilings"]:
+                        encode_tiling_positions(tiling)
+
+            name = url.split("/")[-1]
+            (data_path / "oga" / f"{name}.json").write_text(json.dumps(data))
+
+        (data_path / "duplicates.json").write_text(json.dumps(self.get_duplicates_map()))
+        (data_path / "labels.json").write_text(json.dumps(self.get_labels(), indent=2))
+
+
+_database: Optional[AnnotationDatabase] = None
+
+
+def get_annotation_database() -> Optional[AnnotationDatabase]:
+    """
+    The database configured by BOOTSTRAP_ANNOTATION_DB, or None to use the json files
+    """
+    global _database
+    if _database is None and config.BOOTSTRAP_ANNOTATION_DB:
+        _database = AnnotationDatabase(config.BOOTSTRAP_ANNOTATION_DB)
+    return _database
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "command", type=str, choices=["import", "export", "labels"],
+        help="import: read the json files into the database,"
+             " export: write the database as json files,"
+             " labels: print the number of tiles per label",
+    )
+    parser.add_argument(
+        "--db", type=str, default=config.BOOTSTRAP_ANNOTATION_DB or None,
+        help="Database filename, defaults to BOOTSTRAP_ANNOTATION_DB",
+    )
+    parser.add_argument(
+        "-p", "--path", type=str, default=str(config.BOOTSTRAP_DATA_PATH),
+        help="Data path of the json files",
+    )
+
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_args()
+    if not args["db"]:
+        raise SystemExit("Need --db or BOOTSTRAP_ANNOTATION_DB")
+
+    db = AnnotationDatabase(args["db"])
+    if args["command"] == "import":
+        db.import_json(args["path"])
+        print(f"imported {len(db.source_urls()):,} sources into {db.filename}")
+
+    elif args["command"] == "export":
+        db.export_json(args["path"])
+        print(f"exported {len(db.source_urls()):,} sources to {args['path']}")
+
+    elif args["command"] == "labels":
+        for label, count in sorted(db.label_counts().items(), key=lambda i: -i[1]):
+            print(f"{count:9,} {label}")
+
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import sys
 import time
+import argparse
 
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
@@ -7,10 +8,42 @@ from PyQt5.QtCore import *
 import qdarkstyle
 
 from bootstrap.app.mainwindow import MainWindow
+from bootstrap.app.instrumentation import enable_instrumentation
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-i", "--instrument", type=str, nargs="?", default=None, const="",
+        help="Measure paint and mouse event times and write the percentiles"
+             " on exit to the given json file, or print them",
+    )
+    parser.add_argument(
+        "-il", "--instrument-log", type=str, default=None,
+        help="Append each measured event time to this file",
+    )
+    parser.add_argument(
+        "-io", "--instrument-overlay", type=bool, nargs="?", default=False, const=True,
+        help="Display the recent paint times on top of the image",
+    )
+
+    # remaining arguments are passed to Qt
+    args, qt_args = parser.parse_known_args()
+    return vars(args), sys.argv[:1] + qt_args
 
 
 def main():
-    app = QApplication(sys.argv)
+    args, qt_args = parse_args()
+    app = QApplication(qt_args)
+
+    if args["instrument"] is not None or args["instrument_log"] or args["instrument_overlay"]:
+        instrumentation = enable_instrumentation(
+            summary_filename=args["instrument"] or None,
+            log_filename=args["instrument_log"],
+            overlay=args["instrument_overlay"],
+        )
+        app.aboutToQuit.connect(instrumentation.close)
 
     app.setStyleSheet(qdarkstyle.load_stylesheet())
     screen = app.primaryScreen()
@@ -0,0 +1,172 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+# the bootstrap.config is imported after the synthetic data is generated
+from bootstrap.benchmark import generate_dataset, get_revision
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Scripted drag benchmark of the ImagePatchWidget,"
+                    " run with QT_QPA_PLATFORM=offscreen for headless regression tests",
+    )
+
+    parser.add_argument(
+        "-ss", "--sheet-size", type=int, default=1024,
+        help="Width and height of the synthetic sprite sheet in pixels",
+    )
+    parser.add_argument(
+        "-ts", "--tile-size", type=int, default=16,
+        help="Width and height of the tiles in the sprite sheet",
+    )
+    parser.add_argument(
+        "-z", "--zoom", type=int, default=3,
+        help="Zoom of the image widget",
+    )
+    parser.add_argument(
+        "-m", "--moves", type=int, default=300,
+        help="Number of mouse moves per drag",
+    )
+    parser.add_argument(
+        "-sc", "--scrub-steps", type=int, default=50,
+        help="Number of tiling offset changes, like scrubbing the spin box",
+    )
+    parser.add_argument(
+        "-vs", "--view-size", type=int, nargs=2, default=[1280, 800],
+        help="Width and height of the scroll view",
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, nargs="?", default=None,
+        help="Filename of the json results, otherwise they are printed",
+    )
+
+    return vars(parser.parse_args())
+
+
+def run_drag_benchmark(
+        image_data: dict,
+        zoom: int,
+        moves: int,
+        view_size: tuple,
+        scrub_steps: int = 0,
+) -> dict:
+    from PyQt5.QtCore import Qt, QEvent, QPointF
+    from PyQt5.QtGui import QMouseEvent
+    from PyQt5.QtWidgets import QApplication, QScrollArea
+    from bootstrap.app.imagepatchwidget import ImagePatchWidget
+    from bootstrap.app.instrumentation import enable_instrumentation
+
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+
+    results = {}
+    for mode in ("tiles", "labels"):
+        instrumentation = enable_instrumentation()
+
+        view = QScrollArea()
+        widget = ImagePatchWidget()
+        view.setWidget(widget)
+        view.resize(*view_size)
+        view.show()
+
+        widget.set_zoom(zoom)
+        widget.set_image(image_data)
+        widget.set_mode(mode)
+        widget.set_label({"name": "benchmark", "color": [255, 0, 0]})
+        _wait_idle(app, widget)
+
+        def _send(event_type, x: float, y: float, button):
+            event = QMouseEvent(event_type, QPointF(x, y), button, Qt.LeftButton, Qt.NoModifier)
+            app.sendEvent(widget, event)
+            app.processEvents()
+
+        # drag diagonally through the visible part of the image
+        width = min(view_size[0], widget.width()) - 1
+        height = min(view_size[1], widget.height()) - 1
+        start_time = time.perf_counter()
+        _send(QEvent.MouseButtonPress, 0, 0, Qt.LeftButton)
+        for i in range(1, moves + 1):
+            _send(QEvent.MouseMove, width * i / moves, height * i / moves, Qt.NoButton)
+        _send(QEvent.MouseButtonRelease, width, height, Qt.LeftButton)
+
+        results[mode] = {
+            "duration": round(time.perf_counter() - start_time, 6),
+            **instrumentation.summary(),
+        }
+        view.close()
+
+    if scrub_steps:
+        instrumentation = enable_instrumentation()
+
+        view = QScrollArea()
+        widget = ImagePatchWidget()
+        view.setWidget(widget)
+        view.resize(*view_size)
+        view.show()
+        widget.set_zoom(zoom)
+        widget.set_image(image_data)
+        _wait_idle(app, widget)
+
+        # change the offset like a scrubbed spin box, the gui must not wait for the geometry
+        start_time = time.perf_counter()
+        tiling = image_data["tilings"][0]
+        for i in range(1, scrub_steps + 1):
+            data = {**image_data, "tilings": [{**tiling, "offset_x": i % tiling["patch_size_x"]}]}
+            with instrumentation.measure("scrub"):
+                widget.set_image(data)
+                app.processEvents()
+        gui_duration = time.perf_counter() - start_time
+        _wait_idle(app, widget)
+
+        results["scrub"] = {
+            "gui_duration": round(gui_duration, 6),
+            "duration": round(time.perf_counter() - start_time, 6),
+            **instrumentation.summary(),
+        }
+        view.close()
+
+    return results
+
+
+def _wait_idle(app, widget, timeout: float = 60.):
+    start_time = time.perf_counter()
+    app.processEvents()
+    while not widget.is_idle() and time.perf_counter() - start_time < timeout:
+        time.sleep(.001)
+        app.processEvents()
+
+
+def main():
+    args = parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        path = Path(path)
+        os.environ.update(generate_dataset(
+            path, count=1, sheet_size=args["sheet_size"], tile_size=args["tile_size"], label_rate=0.,
+        ))
+        data = json.loads(next((path / "data" / "oga").glob("*.json")).read_text())
+        image_data = data["images"][0]
+        image_data["filename"] = str(next((path / "web-cache" / "oga").glob("*/sheet.png")))
+
+        results = {
+            "revision": get_revision(),
+            "parameters": args,
+            "timings": run_drag_benchmark(
+                image_data, zoom=args["zoom"], moves=args["moves"], view_size=args["view_size"],
+                scrub_steps=args["scrub_steps"],
+            ),
+        }
+
+    results = json.dumps(results, indent=2)
+    if args["output"]:
+        Path(args["output"]).write_text(results)
+    else:
+        print(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+import json
+import os
+import argparse
+from pathlib import Path
+from typing import Optional, Dict, Set, Tuple, List, Union, Iterable, Generator
+
+from PyQt5.QtCore import *
+from PyQt5.QtGui import *
+
+from bootstrap import config
+from bootstrap.app.util import Tiling, get_patch_hash, get_qimage_from_source
+from bootstrap.positions import decode_positions
+from bootstrap.sources import tile_order_key
+
+
+# (image filename relative to web-cache, tiling index, row, column)
+TileKey = Tuple[str, int, int, int]
+
+# (source url, image index) of an image, see `tile_order_key`
+ImageOrder = Tuple[str, int]
+
+
+class DuplicateIndex:
+    """
+    Persistent hash index of the tiles of all tilings.
+
+    Tiles are hashed the same way as in `compile.py` (scaled to `size`, alpha colors applied)
+    and a tile is a duplicate if an equal, not-ignored tile comes first in the
+    `tile_order_key` order of `compile.py`. Images whose source url and image index
+    are not known yet come after all others, ordered by filename.
+
+    Only tilings whose parameters or alpha colors changed are re-hashed by `update_image`,
+    so keeping the index up-to-date costs the tiles of the edited tiling.
+    """
+    VERSION = 1
+
+    def __init__(self, filename: Optional[Union[str, Path]] = None, size: int = 16):
+        self.filename = None if filename is None else Path(filename)
+        self.size = size
+        # filename -> list of {"key": list, "hashes": {pos: hash}, "ignore": set of pos}
+        self._images: Dict[str, List[dict]] = {}
+        # hash -> set of not-ignored TileKeys
+        self._hash_tiles: Dict[str, Set[TileKey]] = {}
+        # filename -> (source url, image index)
+        self._image_order: Dict[str, ImageOrder] = {}
+        self._is_changed = False
+
+        if self.filename is not None and self.filename.exists():
+            self._load()
+
+    def __len__(self):
+        return sum(len(t["hashes"]) for tilings in self._images.values() for t in tilings)
+
+    def filenames(self) -> Set[str]:
+        return set(self._images)
+
+    def tilings(self) -> List[Tuple[str, int]]:
+        return [
+            (filename, tiling_index)
+            for filename, entries in sorted(self._images.items())
+            for tiling_index in range(len(entries))
+        ]
+
+    def changed_tilings(self, filename: str, image_data: dict) -> List[int]:
+        """
+        Indices of the tilings that `update_image` would hash
+        """
+        entries = self._images.get(filename) or []
+        return [
+            tiling_index
+            for tiling_index, tiling in enumerate(image_data["tilings"])
+            if tiling_index >= len(entries) or entries[tiling_index]["key"] != tiling_key(tiling, image_data)
+        ]
+
+    def update_image(
+            self,
+            filename: str,
+            image: QImage,
+            image_data: dict,
+            order: Optional[ImageOrder] = None,
+    ) -> int:
+        """
+        Update the tilings of one image.
+
+        :param filename: str, image filename relative to the web-cache
+        :param image: QImage with applied alpha colors
+        :param image_data: dict with "tilings" and optional "alpha"
+        :param order: optional (source url, image index) of the image, see `tile_order_key`
+        :return: int, number of re-hashed tiles
+        """
+        tilings = image_data["tilings"]
+        entries = self._images.setdefault(filename, [])
+        num_hashed = 0
+
+        if order is not None and self._image_order.get(filename) != tuple(order):
+            self._image_order[filename] = tuple(order)
+            self._is_changed = True
+
+        for tiling_index in range(len(tilings), len(entries)):
+            self._remove_entry(filename, tiling_index, entries[tiling_index])
+            self._is_changed = True
+        del entries[len(tilings):]
+
+        for tiling_index, tiling in enumerate(tilings):
+            key = tiling_key(tiling, image_data)
+            ignore = decode_positions(tiling.get("ignore"))
+
+            if tiling_index < len(entries) and entries[tiling_index]["key"] == key:
+                entry = entries[tiling_index]
+                if entry["ignore"] != ignore:
+                    for pos in entry["ignore"] - ignore:
+                        self.set_ignored(filename, tiling_index, pos, False)
+                    for pos in ignore - entry["ignore"]:
+                        self.set_ignored(filename, tiling_index, pos, True)
+                continue
+
+            entry = {
+                "key": key,
+                "hashes": self._hash_tiling(image, tiling),
+                "ignore": ignore,
+            }
+            num_hashed += len(entry["hashes"])
+            if tiling_index < len(entries):
+                self._remove_entry(filename, tiling_index, entries[tiling_index])
+                entries[tiling_index] = entry
+            else:
+                entries.append(entry)
+            self._add_entry(filename, tiling_index, entry)
+            self._is_changed = True
+
+        if not entries:
+            self._images.pop(filename)
+            self._image_order.pop(filename, None)
+        return num_hashed
+
+    def remove_image(self, filename: str):
+        self._image_order.pop(filename, None)
+        for tiling_index, entry in enumerate(self._images.pop(filename, [])):
+            self._remove_entry(filename, tiling_index, entry)
+            self._is_changed = True
+
+    def set_ignored(
+            self, filename: str, tiling_index: int, pos: Tuple[int, int], state: bool,
+    ) -> Set[Tuple[int, int]]:
+        """
+        Update the ignore state of a single tile.
+
+        Returns the positions in the same tiling whose duplicate state might have changed.
+        """
+        entries = self._images.get(filename)
+        if not entries or tiling_index >= len(entries):
+            return set()
+        entry = entries[tiling_index]
+        pos = tuple(pos)
+        if state == (pos in entry["ignore"]):
+            return set()
+
+        if state:
+            entry["ignore"].add(pos)
+        else:
+            entry["ignore"].discard(pos)
+        self._is_changed = True
+
+        hash = entry["hashes"].get(pos)
+        if hash is None:
+            return set()
+
+        tiles = self._hash_tiles.setdefault(hash, set())
+        if state:
+            tiles.discard((filename, tiling_index, *pos))
+        else:
+            tiles.add((filename, tiling_index, *pos))
+
+        positions = {pos}
+        for tile_key in tiles:
+            if tile_key[:2] == (filename, tiling_index):
+                positions.add(tile_key[2:])
+        if not tiles:
+            self._hash_tiles.pop(hash)
+        return positions
+
+    def is_duplicate(self, filename: str, tiling_index: int, pos: Tuple[int, int]) -> bool:
+        entries = self._images.get(filename)
+        if not entries or tiling_index >= len(entries):
+            return False
+        return self._is_duplicate(filename, tiling_index, entries[tiling_index], tuple(pos))
+
+    def tile_hashes(self, filename: str, tiling_index: int) -> Dict[Tuple[int, int], str]:
+        """
+        Hash of each tile of a tiling
+        """
+        entries = self._images.get(filename)
+        if not entries or tiling_index >= len(entries):
+            return {}
+        return entries[tiling_index]["hashes"]
+
+    def duplicates(self, filename: str, tiling_index: int) -> Set[Tuple[int, int]]:
+        """
+        Positions of the duplicate tiles of a tiling
+        """
+        entries = self._images.get(filename)
+        if not entries or tiling_index >= len(entries):
+            return set()
+
+        entry = entries[tiling_index]
+        return set(
+            pos
+            for pos in entry["hashes"]
+            if self._is_duplicate(filename, tiling_index, entry, pos)
+        )
+
+    def _is_duplicate(self, filename: str, tiling_index: int, entry: dict, pos: Tuple[int, int]) -> bool:
+        if pos in entry["ignore"] or pos not in entry["hashes"]:
+            return False
+        tiles = self._hash_tiles.get(entry["hashes"][pos])
+        if not tiles or len(tiles) < 2:
+            return False
+        return min(tiles, key=self._order_key) != (filename, tiling_index, *pos)
+
+    def _order_key(self, tile_key: TileKey) -> tuple:
+        filename, tiling_index, row, column = tile_key
+        order = self._image_order.get(filename)
+        if order is None:
+            return 1, filename, tiling_index, row, column
+        return 0, *tile_order_key(order[0], order[1], tiling_index, (row, column))
+
+    def save(self, force: bool = False):
+        if self.filename is None or not (self._is_changed or force):
+            return
+
+        data = {
+            "version": self.VERSION,
+            "size": self.size,
+            "images": {
+                filename: [
+                    {
+                        "key": entry["key"],
+                        "tiles": [[*pos, hash] for pos, hash in sorted(entry["hashes"].items())],
+                        "ignore": [list(pos) for pos in sorted(entry["ignore"])],
+                    }
+                    for entry in entries
+                ]
+                for filename, entries in sorted(self._images.items())
+            },
+            "order": {
+                filename: list(order)
+                for filename, order in sorted(self._image_order.items())
+            },
+        }
+        os.makedirs(self.filename.parent, exist_ok=True)
+        temp_filename = self.filename.with_name(f".{self.filename.name}.tmp")
+        temp_filename.write_text(json.dumps(data))
+        os.replace(temp_filename, self.filename)
+        self._is_changed = False
+
+    def _load(self):
+        data = json.loads(self.filename.read_text())
+        if data.get("version") != self.VERSION or data.get("size") != self.size:
+            # hashes are not comparable, re-hash everything lazily
+            self._is_changed = True
+            return
+
+        self._image_order = {
+            filename: tuple(order)
+            for filename, order in (data.get("order") or {}).items()
+        }
+        for filename, entries in data["images"].items():
+            self._images[filename] = []
+            for tiling_index, entry in enumerate(entries):
+                entry = {
+                    "key": entry["key"],
+                    "hashes": {(row, col): hash for row, col, hash in entry["tiles"]},
+                    "ignore": set(tuple(pos) for pos in entry["ignore"]),
+                }
+                self._images[filename].append(entry)
+                self._add_entry(filename, tiling_index, entry)
+
+    def _add_entry(self, filename: str, tiling_index: int, entry: dict):
+        for pos, hash in entry["hashes"].items():
+            if pos not in entry["ignore"]:
+                self._hash_tiles.setdefault(hash, set()).add((filename, tiling_index, *pos))
+
+    def _remove_entry(self, filename: str, tiling_index: int, entry: dict):
+        for pos, hash in entry["hashes"].items():
+            tiles = self._hash_tiles.get(hash)
+            if tiles:
+                tiles.discard((filename, tiling_index, *pos))
+                if not tiles:
+                    self._hash_tiles.pop(hash)
+
+    def _hash_tiling(self, image: QImage, tiling: dict) -> Dict[Tuple[int, int], str]:
+        # ignore and duplicate state is handled by the index itself
+        tiling = {key: value for key, value in tiling.items() if key not in ("ignore", "duplicates", "labels")}
+        patch_size = QSize(self.size, self.size)
+        return {
+            pos: get_patch_hash(image.copy(rect).scaled(patch_size))
+            for rect, pos in Tiling(image.size(), tiling).iter_rects(yield_pos=True)
+        }
+
+
+def tiling_key(tiling: dict, image_data: dict) -> list:
+    """
+    The tiling parameters and alpha colors, tiles need to be re-hashed when they change
+    """
+    return [
+        tiling["offset_x"], tiling["offset_y"],
+        tiling["patch_size_x"], tiling["patch_size_y"],
+        tiling["spacing_x"], tiling["spacing_y"],
+        tiling.get("size_x") or 0, tiling.get("size_y") or 0,
+        image_data.get("alpha") or [],
+    ]
+
+
+def duplicate_index_filename() -> Path:
+    return config.BOOTSTRAP_DATA_PATH / "duplicate-index.json"
+
+
+def webcache_filename(filename: Union[str, Path]) -> Optional[str]:
+    """
+    The filename relative to the web-cache, or None if it's somewhere else
+    """
+    try:
+        return str(Path(filename).relative_to(config.BOOTSTRAP_WEBCACHE_PATH))
+    except ValueError:
+        return None
+
+
+_duplicate_index: Optional[DuplicateIndex] = None
+
+
+def get_duplicate_index() -> DuplicateIndex:
+    global _duplicate_index
+    if _duplicate_index is None:
+        _duplicate_index = DuplicateIndex(duplicate_index_filename())
+    return _duplicate_index
+
+
+def update_duplicate_index(index: DuplicateIndex, sources: Iterable[dict]) -> int:
+    """
+    Update the index with the tiled images of all `sources` and remove images that are gone.
+
+    Images are only decoded if some of their tilings need to be hashed.
+    Returns the number of hashed tiles.
+    """
+    filenames = set()
+    num_hashed = 0
+    for source in sources:
+        for image_index, image_data in enumerate(source["images"]):
+            filename = webcache_filename(image_data["filename"])
+            if not image_data["tilings"] or filename is None:
+                continue
+            filenames.add(filename)
+            image = QImage()
+            if index.changed_tilings(filename, image_data):
+                image = get_qimage_from_source(image_data)
+            num_hashed += index.update_image(filename, image, image_data, order=(source["url"], image_index))
+
+    for filename in index.filenames() - filenames:
+        index.remove_image(filename)
+
+    return num_hashed
+
+
+def iter_sources() -> Generator[dict, None, None]:
+    from bootstrap.sources import scan_sources
+
+    yield from scan_sources()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Build or update the duplicate index of all tiled images,"
+                    " which is afterwards kept up-to-date by the app",
+    )
+
+    parser.add_argument(
+        "-f", "--force", type=bool, nargs="?", default=False, const=True,
+        help="Re-hash all tilings instead of only the changed ones",
+    )
+
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_args()
+    if args["force"] and duplicate_index_filename().exists():
+        duplicate_index_filename().unlink()
+    index = get_duplicate_index()
+
+    num_hashed = update_duplicate_index(index, iter_sources())
+    index.save()
+
+    num_duplicates = sum(len(index.duplicates(*key)) for key in index.tilings())
+    print(f"hashed {num_hashed:,} tiles, index: {len(index):,} tiles, {num_duplicates:,} duplicates")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,13 +9,16 @@ from PyQt5.QtWidgets import *
 
 from .imagepatchwidget import ImagePatchWidget
 from .labelmodel import LabelModel
-from .util import get_default_tiling
+from .util import get_default_tiling, get_qimage_from_source
+from .tilingdetect import propose_tiling
+from ..journal import image_to_json
 from .newlabelbox import NewLabelBox
 
 
 class ImagePatchEditor(QWidget):
 
-    signal_save_source = pyqtSignal(dict)
+    # the updated source and the journal records of the changes
+    signal_save_source = pyqtSignal(dict, list)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -23,6 +26,10 @@ class ImagePatchEditor(QWidget):
         self._index: Optional[int] = None
         self._image_data: Optional[dict] = None
         self._image_size: Optional[QSize] = None
+        # unsaved tile edits
+        self._tile_records: List[dict] = []
+        # unsaved changes that are not tile edits
+        self._is_image_changed = False
 
         self._create_widgets()
         self.setDisabled(True)
@@ -47,6 +54,7 @@ class ImagePatchEditor(QWidget):
         self.patch_widget = ImagePatchWidget(self)
         self.view.setWidget(self.patch_widget)
         self.patch_widget.signal_image_changed.connect(self._update_image_from_patch_widget)
+        self.patch_widget.signal_tile_changed.connect(self._slot_tile_changed)
         self.patch_widget.signal_info_changed.connect(self._slot_info_changed)
 
         lh.addWidget(self.patch_widget.create_control_widget())
@@ -54,6 +62,7 @@ class ImagePatchEditor(QWidget):
         self.controls.signal_zoom_changed.connect(self.patch_widget.set_zoom)
         self.controls.signal_mode_changed.connect(self.patch_widget.set_mode)
         self.controls.signal_tilings_changed.connect(self._slot_tilings_changed)
+        self.controls.signal_tiling_removed.connect(self._slot_tiling_removed)
         self.controls.signal_tiling_selected.connect(self.patch_widget.set_tiling_index)
         self.controls.signal_label_changed.connect(self.patch_widget.set_label)
 
@@ -67,29 +76,74 @@ class ImagePatchEditor(QWidget):
         self._source = source
         self._index = index
         self._image_data = deepcopy(self._source["images"][index])
+        self._tile_records = []
+        self._is_image_changed = False
         self._image_size = QPixmap(self._image_data["filename"]).size()
+        default_tiling = None
+        if not self._image_data["tilings"]:
+            default_tiling = propose_tiling(get_qimage_from_source(self._image_data))
+        self.controls.set_default_tiling(default_tiling)
         self.controls.set_tilings(self._image_data["tilings"], self._image_size)
+        self.patch_widget.image_order = (self._source["url"], index)
         self.patch_widget.set_image(self._image_data)
         self.setEnabled(True)
 
     def _update_image_from_patch_widget(self, image_data: dict):
         self._image_data = deepcopy(image_data)
+        self._is_image_changed = True
         self.controls.set_tilings(self._image_data["tilings"], self._image_size)
 
+    def _slot_tile_changed(self, record: dict):
+        self._tile_records.append(record)
+
     def _slot_tilings_changed(self, tilings: List[dict]):
         if self._image_data is not None:
-            self._image_data["tilings"] = deepcopy(tilings)
+            # the tile edits of the patch widget are newer than the tilings of the controls
+            current_tilings = self.patch_widget.image_data()["tilings"]
+            tilings = deepcopy(tilings)
+            for tiling, current_tiling in zip(tilings, current_tilings):
+                for key in ("ignore", "labels", "duplicates"):
+                    if key in current_tiling:
+                        tiling[key] = deepcopy(current_tiling[key])
+                    else:
+                        tiling.pop(key, None)
+
+            self._image_data["tilings"] = tilings
+            self._is_image_changed = True
             self.patch_widget.set_image(self._image_data)
 
-            #self.signal_save_source_image
+    def _slot_tiling_removed(self, index: int):
+        if self._image_data is not None:
+            self._image_data = deepcopy(self.patch_widget.image_data())
+            self._image_data["tilings"].pop(index)
+            self._is_image_changed = True
+            self.controls.set_tilings(self._image_data["tilings"], self._image_size)
+            self.patch_widget.set_image(self._image_data)
 
     def _slot_info_changed(self, info: str):
         self.info_label.setText(info)
 
     def _save_source_image(self):
-        source = deepcopy(self._source)
+        self._image_data = deepcopy(self.patch_widget.image_data())
+        image_filename = str(Path(self._image_data["filename"]).relative_to(self._source["web_folder"]))
+
+        if self._is_image_changed:
+            records = [{
+                "op": "image",
+                "image": image_filename,
+                "data": image_to_json(self._image_data, self._source["web_folder"]),
+            }]
+        else:
+            records = [
+                {**record, "image": image_filename}
+                for record in self._tile_records
+            ]
+        self._tile_records = []
+        self._is_image_changed = False
+
+        source = {**self._source, "images": list(self._source["images"])}
         source["images"][self._index] = self._image_data
-        self.signal_save_source.emit(source)
+        self.signal_save_source.emit(source, records)
 
 
 class ImagePatchEditorControls(QWidget):
@@ -101,12 +155,15 @@ class ImagePatchEditorControls(QWidget):
     signal_label_changed = pyqtSignal(dict)
     signal_tilings_changed = pyqtSignal(list)
     signal_tiling_selected = pyqtSignal(int)
+    signal_tiling_removed = pyqtSignal(int)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self._tilings = []
         self._image_size: Optional[QSize] = None
+        # the proposed tiling of an untiled image
+        self._default_tiling: Optional[dict] = None
         self._do_listen_value_change = True
         self._do_listen_tab_click = True
 
@@ -187,6 +244,9 @@ class ImagePatchEditorControls(QWidget):
         else:
             self._update_xy_widgets(self._tilings[self.tiling_tab.currentIndex()])
 
+    def set_default_tiling(self, tiling: Optional[dict]):
+        self._default_tiling = deepcopy(tiling)
+
     def _tab_clicked(self, index: int):
         if not self._do_listen_tab_click:
             return
@@ -200,6 +260,8 @@ class ImagePatchEditorControls(QWidget):
             default_tiling = deepcopy(self._tilings[self.tiling_tab.currentIndex()])
             default_tiling.pop("ignore", None)
             default_tiling.pop("labels", None)
+        elif self._default_tiling:
+            default_tiling = deepcopy(self._default_tiling)
         else:
             default_tiling = get_default_tiling(self._image_size)
 
@@ -233,10 +295,7 @@ class ImagePatchEditorControls(QWidget):
 
     def _remove_tiling(self, index: int):
         if index < len(self._tilings):
-            tilings = self._tilings.copy()
-            tilings.pop(index)
-            self.set_tilings(tilings, self._image_size)
-            self.signal_tilings_changed.emit(self._tilings)
+            self.signal_tiling_removed.emit(index)
 
     def _update_xy_widgets(self, data):
         try:
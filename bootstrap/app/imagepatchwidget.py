@@ -1,6 +1,7 @@
 import json
+import time
 from functools import partial
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from copy import deepcopy
 from pathlib import Path
 
@@ -8,7 +9,14 @@ from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
-from .util import Tiling, get_qimage_from_source
+from .util import Tiling, get_qimage_from_source, qimage_to_numpy
+from ..emptytiles import find_empty_tiles
+from ..positions import decode_positions
+from .duplicateindex import get_duplicate_index, webcache_filename
+from .labelsuggest import get_label_suggestion_index
+from .zoomcache import ZoomPixmapCache
+from .tilinggeometry import TilingGeometry, TilingGeometryWorker, tiling_geometry_key
+from .instrumentation import get_instrumentation, measure
 from .labelmodel import LabelModel
 from .selectlabelbox import SelectLabelBox
 
@@ -18,6 +26,8 @@ class ImagePatchWidget(QWidget):
     signal_info_changed = pyqtSignal(str)
     signal_image_changed = pyqtSignal(dict)
     signal_set_label = pyqtSignal(dict)
+    # a single tile edit, see SourceJournal
+    signal_tile_changed = pyqtSignal(dict)
 
     signal_color_selected = pyqtSignal(QColor)
 
@@ -27,9 +37,15 @@ class ImagePatchWidget(QWidget):
         super().__init__(*args, **kwargs)
         self._image_data: Optional[dict] = None
         self._image: Optional[QImage] = None
+        # (source url, image index) of the image, orders the duplicates in the duplicate index
+        self.image_order: Optional[Tuple[str, int]] = None
+        # the image scaled to the zoom levels, built on the first paint after set_image/set_zoom
+        self._pixmap_cache = ZoomPixmapCache()
         self._zoom = 3
         self._tiling_index = 0
         self._tiling: Optional[Tiling] = None
+        # the ignore and label sets of the current tiling are newer than the lists in _image_data
+        self._is_tiling_changed = False
         self._outside_control_widget: Optional[ImagePatchEditorControls] = None
         self._control_widget: Optional[ImagePatchWidgetControls] = None
         self._background = "cross"
@@ -39,9 +55,22 @@ class ImagePatchWidget(QWidget):
         self._mode = "tiles"
         self._current_label: Optional[dict] = None
         self._last_hover_label_pos = None
+        # (label, score) of the hovered tile, selectable with the number keys
+        self._label_suggestions: List[Tuple[str, float]] = []
         self._label_select_box: Optional[SelectLabelBox] = None
-        self._outside_polygon: Optional[QPolygon] = None
-        self._last_outside_polygon_rect: Optional[QRect] = None
+        # latest finished geometry of the current tiling, calculated in the background
+        self._geometry: Optional[TilingGeometry] = None
+        self._geometry_key: Optional[tuple] = None
+        self._geometry_worker = TilingGeometryWorker(self)
+        self._geometry_worker.signal_finished.connect(self._slot_geometry_finished)
+        # the worker thread must end before the worker is deleted with this widget
+        self.destroyed.connect(partial(self._geometry_worker.stop))
+        # hashing changed tilings is delayed until the tiling parameters settle
+        self._duplicates_timer = QTimer(self)
+        self._duplicates_timer.setSingleShot(True)
+        self._duplicates_timer.setInterval(300)
+        self._duplicates_timer.timeout.connect(self._slot_update_duplicates)
+        self._move_event_time: Optional[float] = None
         self.label_model = None
 
         # quickly load throw-away label model
@@ -57,35 +86,121 @@ class ImagePatchWidget(QWidget):
         self._control_widget.signal_background_changed.connect(self.set_background)
         self._control_widget.signal_select_color.connect(self._select_color)
         self._control_widget.signal_image_changed.connect(self._update_image_from_control)
+        self._control_widget.signal_ignore_empty.connect(self.ignore_empty_tiles)
         self.signal_color_selected.connect(self._control_widget.set_selected_color)
 
         return self._control_widget
 
+    def image_data(self) -> Optional[dict]:
+        """
+        The current image data, including all tile edits
+        """
+        self._sync_tiling()
+        return self._image_data
+
+    def _sync_tiling(self):
+        if not self._is_tiling_changed:
+            return
+        self._is_tiling_changed = False
+
+        tiling_data = self._image_data["tilings"][self._tiling_index]
+        if self._tiling.ignore_tiles:
+            tiling_data["ignore"] = list(self._tiling.ignore_tiles)
+        else:
+            tiling_data.pop("ignore", None)
+
+        if self._tiling.labels:
+            tiling_data["labels"] = {
+                l: list(p)
+                for l, p in self._tiling.labels.items()
+            }
+        else:
+            tiling_data.pop("labels", None)
+
+        if self._tiling.duplicate_tiles:
+            tiling_data["duplicates"] = sorted(self._tiling.duplicate_tiles)
+        else:
+            tiling_data.pop("duplicates", None)
+
+    def _update_duplicates(self, defer: bool = True):
+        """
+        Update the duplicate index with the tilings of the current image
+        and mark the duplicates. Only changed tilings are hashed.
+
+        If `defer` is True, changed tilings are hashed later by the timer
+        and their duplicate marks are removed until then.
+        """
+        self._duplicates_timer.stop()
+        filename = webcache_filename(self._image_data["filename"])
+        if filename is None:
+            return
+
+        index = get_duplicate_index()
+        if defer:
+            changed_tilings = index.changed_tilings(filename, self._image_data)
+            if changed_tilings:
+                for tiling_index in changed_tilings:
+                    self._image_data["tilings"][tiling_index].pop("duplicates", None)
+                self._duplicates_timer.start()
+                return
+
+        with measure("duplicate_index"):
+            index.update_image(filename, self._image, self._image_data, order=self.image_order)
+            for tiling_index, tiling_data in enumerate(self._image_data["tilings"]):
+                duplicates = index.duplicates(filename, tiling_index)
+                if duplicates:
+                    tiling_data["duplicates"] = sorted(duplicates)
+                else:
+                    tiling_data.pop("duplicates", None)
+
+        with measure("label_suggestion_index"):
+            get_label_suggestion_index().update_image(filename, self._image, self._image_data)
+
+    def _slot_update_duplicates(self):
+        if self._image_data is None:
+            return
+        self._sync_tiling()
+        self._update_duplicates(defer=False)
+        if self._tiling is not None:
+            self._tiling.duplicate_tiles = decode_positions(
+                self._image_data["tilings"][self._tiling_index].get("duplicates")
+            )
+        self.update()
+
     def set_image(self, image_data: Optional[dict] = None):
+        self._is_tiling_changed = False
         if image_data is None:
+            self._duplicates_timer.stop()
             self._image_data = image_data
             self._image = None
+            self._pixmap_cache.set_image(None)
             self._tiling_index = 0
             self._tiling = None
-            self._outside_polygon = None
+            self._geometry = None
+            self._geometry_key = None
             self.setGeometry(QRect(0, 0, 10, 10))
         else:
             if (not self._image_data
                     or self._image_data["filename"] != image_data["filename"]
                     or self._image_data.get("alpha") != image_data.get("alpha")
             ):
+                if not self._image_data or self._image_data["filename"] != image_data["filename"]:
+                    # do not paint the tiles of the previous image
+                    self._geometry = None
                 self._image = get_qimage_from_source(image_data)
+                self._pixmap_cache.set_image(self._image)
                 r = self._image.rect()
                 r = QRect(QPoint(0, 0), QPoint(r.width() * self._zoom, r.height() * self._zoom))
                 if self.geometry() != r:
                     self.setGeometry(r)
 
             self._image_data = deepcopy(image_data)
+            self._update_duplicates()
             self._tiling_index = max(0, min(self._tiling_index, len(self._image_data["tilings"]) - 1))
             self._tiling = None
-            self._outside_polygon = None
             if self._image_data["tilings"]:
                 self._tiling = Tiling(self._image.size(), self._image_data["tilings"][self._tiling_index], zoom=self._zoom)
+            self._request_geometry()
 
             if self._control_widget:
                 self._control_widget.set_image_data(self._image_data, self._image, self._tiling)
@@ -94,8 +209,8 @@ class ImagePatchWidget(QWidget):
         self.update()
 
     def set_zoom(self, zoom: int):
+        self._sync_tiling()
         self._zoom = zoom
-        self._outside_polygon = None
         if self._image is not None:
             r = self._image.rect()
             r = QRect(QPoint(0, 0), QPoint(r.width() * self._zoom, r.height() * self._zoom))
@@ -104,6 +219,7 @@ class ImagePatchWidget(QWidget):
 
             if self._image_data["tilings"]:
                 self._tiling = Tiling(self._image.size(), self._image_data["tilings"][self._tiling_index], zoom=self._zoom)
+            self._request_geometry()
 
             if self._control_widget:
                 self._control_widget.set_image_data(self._image_data, self._image, self._tiling)
@@ -114,35 +230,85 @@ class ImagePatchWidget(QWidget):
         assert mode in ("tiles", "labels"), f"Got: {mode}"
         self._mode = mode
         self._label_select_box = None
-        self._outside_polygon = None
         self.update()
 
     def set_tiling_index(self, index: int):
+        self._sync_tiling()
         self._label_select_box = None
         self._tiling_index = index
         self._tiling = None
-        self._outside_polygon = None
         if self._image_data:
             self._tiling_index = min(self._tiling_index, len(self._image_data["tilings"]))
             if self._image_data["tilings"]:
                 self._tiling = Tiling(self._image.size(), self._image_data["tilings"][self._tiling_index], zoom=self._zoom)
                 self.update_info_label(0, 0)
+            self._request_geometry()
 
             if self._control_widget:
                 self._control_widget.set_image_data(self._image_data, self._image, self._tiling)
 
         self.update()
 
+    def _request_geometry(self):
+        """
+        Request the geometry of the current tiling from the background worker, if it changed.
+        Until it's finished, the previous geometry is painted.
+        """
+        if self._tiling is None:
+            self._geometry = None
+            self._geometry_key = None
+            return
+
+        tiling_data = self._image_data["tilings"][self._tiling_index]
+        key = tiling_geometry_key(self._image.size(), tiling_data, self._zoom)
+        if key != self._geometry_key:
+            self._geometry_key = key
+            self._geometry_worker.request(self._image.size(), tiling_data, self._zoom)
+
+    def _slot_geometry_finished(self, geometry: TilingGeometry):
+        if self._geometry_key is None:
+            return
+        if self._geometry is None or geometry.request_id > self._geometry.request_id:
+            self._geometry = geometry
+            self.update()
+
+    def is_idle(self) -> bool:
+        """
+        True if the painted geometry matches the current tiling
+        and no duplicate update is pending
+        """
+        if self._duplicates_timer.isActive():
+            return False
+        return self._geometry_key is None or (
+            self._geometry is not None and self._geometry.key == self._geometry_key
+        )
+
     def set_background(self, mode: str):
         self._background = mode
         self.update()
 
     def paintEvent(self, event: QPaintEvent):
-        if self._last_outside_polygon_rect != event.rect():
-            if self._last_outside_polygon_rect is None or not self._last_outside_polygon_rect.contains(event.rect()):
-                self._last_outside_polygon_rect = event.rect()
-                self._outside_polygon = None
+        instrumentation = get_instrumentation()
+        if instrumentation is None:
+            self._paint(event)
+            return
+
+        with instrumentation.measure("paint"):
+            self._paint(event)
 
+        if self._move_event_time is not None:
+            instrumentation.record("move_to_paint", time.perf_counter() - self._move_event_time)
+            self._move_event_time = None
+
+        if instrumentation.overlay:
+            text = instrumentation.overlay_text()
+            if text:
+                painter = QPainter(self)
+                painter.setPen(QPen(QColor(255, 255, 0)))
+                rect = self.visibleRegion().boundingRect().adjusted(5, 5, -5, -5)
+                painter.drawText(rect, Qt.AlignLeft | Qt.AlignTop, text)
+
+    def _paint(self, event: QPaintEvent):
         painter = QPainter(self)
         if not self._is_color_select:
             painter.setRenderHint(QPainter.RenderHint.Antialiasing)
@@ -168,33 +334,48 @@ class ImagePatchWidget(QWidget):
         if self._image_data is None:
             return
 
-        painter.drawImage(self.rect(), self._image)
+        self._paint_image(painter, event.rect())
 
         if self._is_color_select:
             return
 
-        if self._tiling:
+        geometry = self._geometry
+        if self._tiling and geometry is not None:
+            positions = geometry.visible_positions(event.rect())
 
             if self._mode == "tiles":
+                ignore_tiles = self._tiling.ignore_tiles
+                duplicate_tiles = self._tiling.duplicate_tiles
+
+                rects = [
+                    geometry.rects[pos].adjusted(0, 0, -1, -1)
+                    for pos in positions
+                    if pos not in ignore_tiles and pos not in duplicate_tiles
+                ]
                 painter.setPen(QPen(QColor(255, 255, 255, 196)))
                 painter.setBrush(QBrush(QColor(255, 255, 255, 50)))
-                painter.drawRects(self._tiling.rects(size_minus=1))
+                painter.drawRects(rects)
 
+                rects = [
+                    geometry.rects[pos]
+                    for pos in positions
+                    if pos in ignore_tiles and pos not in duplicate_tiles
+                ]
                 painter.setPen(Qt.NoPen)
                 painter.setBrush(QBrush(QColor(255, 128, 128, 196)))
-                painter.drawRects(self._tiling.rects(ignored=True))
+                painter.drawRects(rects)
 
+                rects = [geometry.rects[pos] for pos in positions if pos in duplicate_tiles]
                 painter.setPen(Qt.NoPen)
                 painter.setBrush(QBrush(QColor(64, 0, 0, 196)))
-                painter.drawRects(self._tiling.rects(duplicates=True))
+                painter.drawRects(rects)
 
             elif self._mode == "labels":
                 painter.setPen(Qt.NoPen)
                 painter.setBrush(QBrush(QColor(0, 0, 0, 196)))
-                if self._outside_polygon is None:
-                    # print("calc", event.rect(), self._last_outside_polygon_rect)
-                    self._outside_polygon = self._tiling.outside_polygon(event.rect())
-                painter.drawPolygon(self._outside_polygon)
+                painter.setClipRegion(geometry.outside.intersected(event.rect()))
+                painter.drawRect(event.rect())
+                painter.setClipping(False)
 
                 if self._current_label:
                     for label, pos_set in self._tiling.labels.items():
@@ -209,13 +390,32 @@ class ImagePatchWidget(QWidget):
                             painter.setPen(Qt.NoPen)
                             painter.setBrush(QBrush(QColor(0, 0, 0, 160)))
 
-                        rects = []
-                        for rect, pos in self._tiling.iter_rects(size_minus=1, yield_pos=True):
-                            if pos in pos_set:
-                                rects.append(rect)
+                        rects = [
+                            geometry.rects[pos].adjusted(0, 0, -1, -1)
+                            for pos in positions
+                            if pos in pos_set
+                        ]
                         if rects:
                             painter.drawRects(rects)
 
+    def _paint_image(self, painter: QPainter, rect: QRect):
+        pixmap = self._pixmap_cache.pixmap(self._zoom)
+        if pixmap is not None:
+            painter.drawPixmap(rect, pixmap, rect)
+            return
+
+        # too large for the cache, only scale the exposed pixels
+        z = self._zoom
+        source_rect = QRect(
+            QPoint(rect.left() // z, rect.top() // z),
+            QPoint(rect.right() // z, rect.bottom() // z),
+        ).intersected(self._image.rect())
+        painter.drawImage(
+            QRect(source_rect.topLeft() * z, source_rect.size() * z),
+            self._image,
+            source_rect,
+        )
+
     def mousePressEvent(self, event: QMouseEvent):
         if self._tiling:
 
@@ -230,7 +430,6 @@ class ImagePatchWidget(QWidget):
                 if self._draw_state is not None:
                     self._is_drawing = True
                     self.update()
-                    self.signal_image_changed.emit(self._image_data)
 
             elif self._mode == "labels":
                 if self._current_label:
@@ -238,11 +437,20 @@ class ImagePatchWidget(QWidget):
                     self.set_label_tile(*pos, label=self._current_label["name"], remove=not self._draw_state)
                     self._is_drawing = True
                     self.update()
-                    self.signal_image_changed.emit(self._image_data)
 
             self.update_info_label(*pos)
 
     def mouseMoveEvent(self, event: QMouseEvent):
+        move_time = time.perf_counter()
+        with measure("mouse_move"):
+            is_updated = self._mouse_move(event)
+
+        # remember the first unpainted move for the move-to-paint latency
+        if is_updated and self._move_event_time is None and get_instrumentation() is not None:
+            self._move_event_time = move_time
+
+    def _mouse_move(self, event: QMouseEvent) -> bool:
+        is_updated = False
         if self._tiling:
             pos = self._tiling.to_tile_pos(event.y(), event.x())
 
@@ -251,17 +459,19 @@ class ImagePatchWidget(QWidget):
                 if self._mode == "tiles":
                     if self.set_ignor_tile(*pos, state=self._draw_state):
                         self.update()
-                        self.signal_image_changed.emit(self._image_data)
+                        is_updated = True
 
                 elif self._mode == "labels" and self._current_label:
                     if self.set_label_tile(*pos, label=self._current_label["name"], remove=not self._draw_state):
                         self.update()
-                        self.signal_image_changed.emit(self._image_data)
+                        is_updated = True
 
             if pos != self._last_hover_label_pos:
                 self._last_hover_label_pos = pos
                 self.update_info_label(*pos)
 
+        return is_updated
+
     def mouseReleaseEvent(self, event: QMouseEvent):
         self._is_drawing = False
 
@@ -282,8 +492,26 @@ class ImagePatchWidget(QWidget):
                 labels = ', '.join(f'"{l}"' for l in labels)
                 text.append(f"labels: {labels}")
 
+            self._label_suggestions = []
+            if self._mode == "labels" and not labels and self._has_tile(*pos):
+                with measure("label_suggestions"):
+                    self._label_suggestions = get_label_suggestion_index().suggest_tile(
+                        self._image, self._image_data["tilings"][self._tiling_index], pos,
+                    )
+                if self._label_suggestions:
+                    suggestions = ", ".join(
+                        f'{i + 1}: "{label}" {score * 100:.0f}%'
+                        for i, (label, score) in enumerate(self._label_suggestions)
+                    )
+                    text.append(f"suggestions: {suggestions}")
+
         self.signal_info_changed.emit(", ".join(text))
 
+    def _has_tile(self, *pos: int) -> bool:
+        if self._geometry is not None and self._geometry.key == self._geometry_key:
+            return pos in self._geometry.rects
+        return False
+
     def swap_ignore_tile(self, *pos: int) -> Optional[bool]:
         next_state = pos not in self._tiling.ignore_tiles
         if next_state is not None:
@@ -305,13 +533,45 @@ class ImagePatchWidget(QWidget):
                 self._tiling.ignore_tiles.add(pos)
                 ret = True
 
-        if self._tiling.ignore_tiles:
-            self._image_data["tilings"][self._tiling_index]["ignore"] = list(self._tiling.ignore_tiles)
-        else:
-            self._image_data["tilings"][self._tiling_index].pop("ignore", None)
+        if ret:
+            self._is_tiling_changed = True
+            filename = webcache_filename(self._image_data["filename"])
+            if filename is not None:
+                index = get_duplicate_index()
+                for changed_pos in index.set_ignored(filename, self._tiling_index, pos, state):
+                    if index.is_duplicate(filename, self._tiling_index, changed_pos):
+                        self._tiling.duplicate_tiles.add(changed_pos)
+                    else:
+                        self._tiling.duplicate_tiles.discard(changed_pos)
+            self.signal_tile_changed.emit({
+                "op": "tile", "tiling": self._tiling_index, "pos": list(pos), "key": "ignore", "state": state,
+            })
 
         return ret
 
+    def ignore_empty_tiles(self, uniform: bool = True) -> int:
+        """
+        Ignore all fully transparent (and single-color) tiles of the current tiling.
+
+        Returns the number of newly ignored tiles.
+        """
+        if self._tiling is None:
+            return 0
+
+        with measure("empty_tiles"):
+            empty = find_empty_tiles(
+                qimage_to_numpy(self._image), self._image_data["tilings"][self._tiling_index], uniform=uniform,
+            )
+
+        num_ignored = 0
+        for pos in sorted(empty):
+            if self.set_ignor_tile(*pos, state=True):
+                num_ignored += 1
+
+        self.signal_info_changed.emit(f"ignored {num_ignored} of {len(empty)} empty tiles")
+        self.update()
+        return num_ignored
+
     def set_label(self, label: dict):
         self._current_label = label
         self.update()
@@ -334,13 +594,17 @@ class ImagePatchWidget(QWidget):
                 self._tiling.labels[label].add(pos)
                 is_changed = True
 
-        if self._tiling.labels:
-            self._image_data["tilings"][self._tiling_index]["labels"] = {
-                l: list(p)
-                for l, p in self._tiling.labels.items()
-            }
-        else:
-            self._image_data["tilings"][self._tiling_index].pop("labels", None)
+        if is_changed:
+            self._is_tiling_changed = True
+            filename = webcache_filename(self._image_data["filename"])
+            if filename is not None:
+                get_label_suggestion_index().set_tile_labels(
+                    filename, self._image, self._image_data, self._tiling_index, pos, self._tiling.get_labels_at(*pos),
+                )
+            self.signal_tile_changed.emit({
+                "op": "tile", "tiling": self._tiling_index, "pos": list(pos),
+                "key": "labels", "label": label, "state": not remove,
+            })
 
         return is_changed
 
@@ -360,6 +624,14 @@ class ImagePatchWidget(QWidget):
             self._label_select_box.setModal(True)
             self._label_select_box.show()
 
+        elif self._mode == "labels" and ord("1") <= event.key() <= ord("9"):
+            index = event.key() - ord("1")
+            if index < len(self._label_suggestions):
+                label_model = self.label_model or LabelModel(self)
+                label = label_model.get_label(self._label_suggestions[index][0])
+                if label:
+                    self.signal_set_label.emit(label)
+
     def _select_closed(self):
         self._label_select_box = None
 
@@ -368,9 +640,14 @@ class ImagePatchWidget(QWidget):
         self.update()
 
     def _update_image_from_control(self, image_data: dict):
-        # image_data = deepcopy(image_data)
-        self.set_image(image_data)
-        self.signal_image_changed.emit(image_data)
+        # the controls only change the alpha colors, the tilings might be outdated
+        data = deepcopy(self.image_data())
+        if image_data.get("alpha"):
+            data["alpha"] = image_data["alpha"]
+        else:
+            data.pop("alpha", None)
+        self.set_image(data)
+        self.signal_image_changed.emit(self._image_data)
 
 
 class ImagePatchWidgetControls(QWidget):
@@ -378,6 +655,7 @@ class ImagePatchWidgetControls(QWidget):
     signal_image_changed = pyqtSignal(dict)
     signal_background_changed = pyqtSignal(str)
     signal_select_color = pyqtSignal()
+    signal_ignore_empty = pyqtSignal()
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -418,6 +696,12 @@ class ImagePatchWidgetControls(QWidget):
         self.remove_alpha_butt.clicked.connect(self._remove_alpha_click)
         self.remove_alpha_butt.setDisabled(True)
         lv.addWidget(self.remove_alpha_butt)
+        lv.addSpacing(10)
+
+        self.ignore_empty_butt = QPushButton("ignore empty tiles", self)
+        self.ignore_empty_butt.setToolTip("Ignore all transparent and single-color tiles of the current tiling")
+        self.ignore_empty_butt.clicked.connect(self.signal_ignore_empty)
+        lv.addWidget(self.ignore_empty_butt)
 
         lv.addStretch(1)
 
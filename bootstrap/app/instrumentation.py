@@ -0,0 +1,121 @@
+import json
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Optional, Dict, List, Union
+
+import numpy as np
+
+
+class GuiInstrumentation:
+    """
+    Collects durations of gui events (in seconds) by name,
+    e.g. "paint", "move_to_paint" or "tiling_geometry".
+
+    If `log_filename` is given, each sample is appended as a
+    tab-separated line (time, name, milliseconds).
+    The percentile summary is written to `summary_filename` by `write_summary`.
+    """
+    PERCENTILES = (50, 90, 95, 99)
+
+    def __init__(
+            self,
+            summary_filename: Optional[Union[str, Path]] = None,
+            log_filename: Optional[Union[str, Path]] = None,
+            overlay: bool = False,
+    ):
+        self.summary_filename = None if summary_filename is None else Path(summary_filename)
+        self.log_filename = None if log_filename is None else Path(log_filename)
+        self.overlay = overlay
+        self.samples: Dict[str, List[float]] = {}
+        self._log_fp = None
+        if self.log_filename is not None:
+            self._log_fp = self.log_filename.open("at")
+
+    def record(self, name: str, seconds: float):
+        if name not in self.samples:
+            self.samples[name] = []
+        self.samples[name].append(seconds)
+        if self._log_fp is not None:
+            self._log_fp.write(f"{time.time():.6f}\t{name}\t{seconds * 1000:.3f}\n")
+
+    @contextmanager
+    def measure(self, name: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start_time)
+
+    def summary(self) -> dict:
+        summary = {}
+        for name, samples in sorted(self.samples.items()):
+            samples = np.array(samples) * 1000
+            summary[name] = {
+                "count": len(samples),
+                "mean_ms": round(float(samples.mean()), 3),
+                "max_ms": round(float(samples.max()), 3),
+                **{
+                    f"p{p}_ms": round(float(v), 3)
+                    for p, v in zip(self.PERCENTILES, np.percentile(samples, self.PERCENTILES))
+                },
+            }
+        return summary
+
+    def overlay_text(self) -> str:
+        lines = []
+        for name in ("paint", "move_to_paint"):
+            samples = self.samples.get(name)
+            if samples:
+                recent = np.array(samples[-100:]) * 1000
+                lines.append(
+                    f"{name}: {recent[-1]:.1f}ms"
+                    f" (p50 {np.percentile(recent, 50):.1f}, p95 {np.percentile(recent, 95):.1f})"
+                )
+        return "\n".join(lines)
+
+    def write_summary(self):
+        if self._log_fp is not None:
+            self._log_fp.flush()
+        summary = self.summary()
+        if self.summary_filename is not None:
+            self.summary_filename.write_text(json.dumps(summary, indent=2))
+        else:
+            for name, stats in summary.items():
+                print(
+                    f"{name:28} count: {stats['count']:7,}  mean: {stats['mean_ms']:8.2f}ms"
+                    f"  p50: {stats['p50_ms']:8.2f}ms  p95: {stats['p95_ms']:8.2f}ms"
+                    f"  max: {stats['max_ms']:8.2f}ms"
+                )
+
+    def close(self):
+        self.write_summary()
+        if self._log_fp is not None:
+            self._log_fp.close()
+            self._log_fp = None
+
+
+_instrumentation: Optional[GuiInstrumentation] = None
+
+
+def enable_instrumentation(
+        summary_filename: Optional[Union[str, Path]] = None,
+        log_filename: Optional[Union[str, Path]] = None,
+        overlay: bool = False,
+) -> GuiInstrumentation:
+    global _instrumentation
+    _instrumentation = GuiInstrumentation(summary_filename, log_filename=log_filename, overlay=overlay)
+    return _instrumentation
+
+
+def get_instrumentation() -> Optional[GuiInstrumentation]:
+    return _instrumentation
+
+
+def measure(name: str):
+    """
+    Context manager that records the duration if the instrumentation is enabled
+    """
+    if _instrumentation is None:
+        return nullcontext()
+    return _instrumentation.measure(name)
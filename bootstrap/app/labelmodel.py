@@ -10,6 +10,7 @@ from PyQt5.QtWidgets import *
 
 from bootstrap.config import SOURCE_URLS, BOOTSTRAP_WEBCACHE_PATH, BOOTSTRAP_DATA_PATH
 from bootstrap.app.util import DEFAULT_TILING
+from bootstrap.annotationdb import get_annotation_database
 
 
 class LabelModel(QAbstractItemModel):
@@ -62,7 +63,10 @@ class LabelModel(QAbstractItemModel):
             return label
 
     def load_preset(self):
-        if (self.data_path / "labels.json").exists():
+        database = get_annotation_database()
+        if database is not None:
+            self._labels = database.get_labels()
+        elif (self.data_path / "labels.json").exists():
             self._labels = json.loads((self.data_path / "labels.json").read_text())
         else:
             self._labels = []
@@ -70,7 +74,11 @@ class LabelModel(QAbstractItemModel):
 
     def save_preset(self):
         self._labels.sort(key=lambda l: l["name"])
-        (self.data_path / "labels.json").write_text(json.dumps(self._labels, indent=2))
+        database = get_annotation_database()
+        if database is not None:
+            database.set_labels(self._labels)
+        else:
+            (self.data_path / "labels.json").write_text(json.dumps(self._labels, indent=2))
 
     def add_label(self, label: dict) -> int:
         self.load_preset()
@@ -0,0 +1,205 @@
+import json
+import time
+import argparse
+from pathlib import Path
+from typing import List, Dict, Iterable, Tuple
+
+import numpy as np
+
+from bootstrap.app.duplicateindex import (
+    DuplicateIndex, get_duplicate_index, update_duplicate_index, webcache_filename, iter_sources,
+)
+from bootstrap.positions import decode_positions
+
+
+def propagate_labels(index: DuplicateIndex, sources: Iterable[dict]) -> Tuple[List[dict], List[dict]]:
+    """
+    Find labels for unlabeled tiles from labeled tiles with the same hash.
+
+    The hash is the one of the duplicate index, so copies of a tile
+    that are stored at a different scale match as well.
+    A hash whose labeled tiles disagree about the labels is a conflict
+    and its unlabeled tiles get no suggestion.
+
+    :param index: DuplicateIndex, up-to-date with the `sources`
+    :param sources: the sources of the SourceModel
+    :return: tuple of
+        list of suggestions {"url", "image", "tiling", "pos", "labels", "copies"}
+            where "image" is relative to the web-cache and "copies" is the number of labeled tiles,
+        list of conflicts {"hash", "labels": [[label, ...], ...], "tiles": [[image, tiling, row, col], ...]}
+    """
+    # one entry per tile
+    urls, tile_keys, hashes, label_codes = [], [], [], []
+    # sorted labels joined by newline -> code
+    label_sets: Dict[str, int] = {}
+
+    for source in sources:
+        for image_data in source["images"]:
+            filename = webcache_filename(image_data["filename"])
+            if filename is None:
+                continue
+            for tiling_index, tiling in enumerate(image_data["tilings"]):
+                tile_hashes = index.tile_hashes(filename, tiling_index)
+                if not tile_hashes:
+                    continue
+
+                ignore = decode_positions(tiling.get("ignore"))
+                tile_labels = {}
+                for label, positions in (tiling.get("labels") or {}).items():
+                    for pos in decode_positions(positions):
+                        tile_labels.setdefault(pos, []).append(label)
+
+                for pos, hash in tile_hashes.items():
+                    # ignored tiles neither vote nor get a suggestion, even if they are labeled
+                    if pos in ignore:
+                        continue
+                    if pos in tile_labels:
+                        code = label_sets.setdefault("\n".join(sorted(tile_labels[pos])), len(label_sets))
+                    else:
+                        code = -1
+                    urls.append(source["url"])
+                    tile_keys.append((filename, tiling_index, *pos))
+                    hashes.append(hash)
+                    label_codes.append(code)
+
+    if not hashes:
+        return [], []
+
+    hash_values, hash_codes = np.unique(np.array(hashes), return_inverse=True)
+    label_codes = np.array(label_codes)
+    is_labeled = label_codes >= 0
+
+    # distinct (hash, label set) pairs of the labeled tiles
+    pairs = np.unique(np.stack([hash_codes[is_labeled], label_codes[is_labeled]], axis=1), axis=0)
+    num_label_sets = np.bincount(pairs[:, 0], minlength=len(hash_values))
+    num_copies = np.bincount(hash_codes[is_labeled], minlength=len(hash_values))
+    hash_label = np.full(len(hash_values), -1)
+    hash_label[pairs[:, 0]] = pairs[:, 1]
+
+    label_names = [key.split("\n") for key in label_sets]
+
+    suggestions = []
+    targets = np.nonzero(~is_labeled & (num_label_sets[hash_codes] == 1))[0]
+    for i in targets:
+        filename, tiling_index, row, col = tile_keys[i]
+        suggestions.append({
+            "url": urls[i],
+            "image": filename,
+            "tiling": tiling_index,
+            "pos": [row, col],
+            "labels": label_names[hash_label[hash_codes[i]]],
+            "copies": int(num_copies[hash_codes[i]]),
+        })
+
+    conflicts = []
+    # tiles grouped by hash
+    order = np.argsort(hash_codes, kind="stable")
+    starts = np.searchsorted(hash_codes[order], np.arange(len(hash_values) + 1))
+    for hash_code in np.nonzero(num_label_sets > 1)[0]:
+        tiles = order[starts[hash_code]:starts[hash_code + 1]]
+        conflicts.append({
+            "hash": str(hash_values[hash_code]),
+            "labels": [label_names[code] for code in pairs[pairs[:, 0] == hash_code, 1]],
+            "tiles": [list(tile_keys[i]) for i in tiles],
+        })
+
+    return suggestions, conflicts
+
+
+def apply_suggestions(sources: Iterable[dict], suggestions: List[dict]) -> int:
+    """
+    Store the suggested labels in the annotation data, returns the number of labeled tiles
+    """
+    from bootstrap.journal import SourceJournal, source_to_json
+    from bootstrap.annotationdb import get_annotation_database
+
+    suggestions_map = {}
+    for suggestion in suggestions:
+        suggestions_map.setdefault(suggestion["url"], []).append(suggestion)
+
+    database = get_annotation_database()
+    num_labeled = 0
+    for source in sources:
+        if source["url"] not in suggestions_map:
+            continue
+
+        images = {webcache_filename(image_data["filename"]): image_data for image_data in source["images"]}
+        records = []
+        for suggestion in suggestions_map[source["url"]]:
+            image_data = images[suggestion["image"]]
+            tiling = image_data["tilings"][suggestion["tiling"]]
+            labels = tiling.setdefault("labels", {})
+            for label in suggestion["labels"]:
+                labels[label] = sorted(decode_positions(labels.get(label)) | {tuple(suggestion["pos"])})
+                records.append({
+                    "op": "tile",
+                    "image": str(Path(image_data["filename"]).relative_to(source["web_folder"])),
+                    "tiling": suggestion["tiling"],
+                    "pos": suggestion["pos"],
+                    "key": "labels",
+                    "label": label,
+                    "state": True,
+                })
+            num_labeled += 1
+
+        if database is not None:
+            database.save_source_data(source_to_json(source))
+        else:
+            SourceJournal(source["data_filename"]).append(records)
+
+    return num_labeled
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Suggest labels for unlabeled tiles that are equal to labeled tiles",
+    )
+
+    parser.add_argument(
+        "-a", "--apply", type=bool, nargs="?", default=False, const=True,
+        help="Store the suggested labels in the annotation data",
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, nargs="?", default=None,
+        help="Filename of the json report with all suggestions and conflicts",
+    )
+
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_args()
+
+    start_time = time.time()
+    sources = list(iter_sources())
+    index = get_duplicate_index()
+    num_hashed = update_duplicate_index(index, sources)
+    index.save()
+
+    suggestions, conflicts = propagate_labels(index, sources)
+
+    label_counts = {}
+    for suggestion in suggestions:
+        for label in suggestion["labels"]:
+            label_counts[label] = label_counts.get(label, 0) + 1
+    for label, count in sorted(label_counts.items(), key=lambda i: -i[1]):
+        print(f"{label:30} {count:,}")
+    for conflict in conflicts:
+        labels = " / ".join(", ".join(labels) for labels in conflict["labels"])
+        print(f"conflict: {len(conflict['tiles'])} equal tiles, labeled {labels}")
+
+    print(
+        f"{len(suggestions):,} suggestions, {len(conflicts):,} conflicts"
+        f" (hashed {num_hashed:,} tiles) in {time.time() - start_time:.2f}s"
+    )
+
+    if args["output"]:
+        Path(args["output"]).write_text(json.dumps({"suggestions": suggestions, "conflicts": conflicts}, indent=2))
+
+    if args["apply"] and suggestions:
+        num_labeled = apply_suggestions(sources, suggestions)
+        print(f"labeled {num_labeled:,} tiles")
+
+
+if __name__ == "__main__":
+    main()
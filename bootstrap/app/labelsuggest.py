@@ -0,0 +1,446 @@
+import io
+import json
+import os
+import time
+import argparse
+from pathlib import Path
+from typing import Optional, Dict, List, Tuple, Union, Iterable
+
+import numpy as np
+from PyQt5.QtCore import *
+from PyQt5.QtGui import *
+
+from bootstrap import config
+from bootstrap.app.util import get_qimage_from_source
+from bootstrap.positions import decode_positions
+from bootstrap.app.duplicateindex import TileKey, tiling_key, webcache_filename, iter_sources
+
+
+class LabelSuggestionIndex:
+    """
+    Nearest-neighbour index of the labeled tiles.
+
+    The feature of a tile is the tile scaled to `size` x `size` pixels with
+    premultiplied alpha, so fully transparent pixels are all the same.
+    `suggest` votes the labels of the closest labeled tiles, weighted by distance.
+
+    Features are only calculated for newly labeled tiles and for the labeled tiles
+    of tilings whose parameters or alpha colors changed.
+    """
+    VERSION = 1
+
+    def __init__(self, filename: Optional[Union[str, Path]] = None, size: int = 8):
+        self.filename = None if filename is None else Path(filename)
+        self.size = size
+        self.num_features = size * size * 4
+        # rows of features, rows of removed tiles are reused
+        self._features = np.zeros((0, self.num_features), dtype=np.float32)
+        self._squared_norms = np.zeros(0, dtype=np.float32)
+        self._is_active = np.zeros(0, dtype=bool)
+        self._row_keys: List[Optional[TileKey]] = []
+        self._row_labels: List[List[str]] = []
+        self._free_rows: List[int] = []
+        # (filename, tiling index) -> {"key": list, "rows": {pos: row}}
+        self._tilings: Dict[Tuple[str, int], dict] = {}
+        self._is_changed = False
+
+        if self.filename is not None and self.filename.exists():
+            self._load()
+
+    def __len__(self):
+        return int(self._is_active.sum())
+
+    def filenames(self):
+        return set(filename for filename, _ in self._tilings)
+
+    def needs_image(self, filename: str, image_data: dict) -> bool:
+        """
+        True if `update_image` needs to calculate features
+        """
+        for tiling_index, tiling in enumerate(image_data["tilings"]):
+            entry = self._tilings.get((filename, tiling_index))
+            labeled = _labeled_positions(tiling)
+            if not labeled:
+                continue
+            if entry is None or entry["key"] != tiling_key(tiling, image_data):
+                return True
+            if any(pos not in entry["rows"] for pos in labeled):
+                return True
+        return False
+
+    def update_image(self, filename: str, image: QImage, image_data: dict) -> int:
+        """
+        Update the labeled tiles of all tilings of one image.
+
+        :param filename: str, image filename relative to the web-cache
+        :param image: QImage with applied alpha colors
+        :param image_data: dict with "tilings" and optional "alpha"
+        :return: int, number of calculated features
+        """
+        num_calculated = 0
+        tiling_keys = set()
+        for tiling_index, tiling in enumerate(image_data["tilings"]):
+            tiling_keys.add((filename, tiling_index))
+            key = tiling_key(tiling, image_data)
+            entry = self._tilings.get((filename, tiling_index))
+            if entry is not None and entry["key"] != key:
+                self._remove_tiling(filename, tiling_index)
+                entry = None
+            if entry is None:
+                entry = self._tilings[(filename, tiling_index)] = {"key": key, "rows": {}}
+                self._is_changed = True
+
+            labeled = _labeled_positions(tiling)
+            for pos in list(entry["rows"]):
+                if pos not in labeled:
+                    self._remove_row(entry["rows"].pop(pos))
+
+            new_positions = []
+            for pos, labels in labeled.items():
+                row = entry["rows"].get(pos)
+                if row is None:
+                    new_positions.append(pos)
+                elif self._row_labels[row] != labels:
+                    self._row_labels[row] = labels
+                    self._is_changed = True
+
+            if new_positions:
+                features = self.get_features(image, [tile_rect(tiling, pos) for pos in new_positions])
+                for pos, feature in zip(new_positions, features):
+                    entry["rows"][pos] = self._add_row((filename, tiling_index, *pos), feature, labeled[pos])
+                num_calculated += len(new_positions)
+
+        for key in [key for key in self._tilings if key[0] == filename and key not in tiling_keys]:
+            self._remove_tiling(*key)
+
+        return num_calculated
+
+    def remove_image(self, filename: str):
+        for key in [key for key in self._tilings if key[0] == filename]:
+            self._remove_tiling(*key)
+
+    def set_tile_labels(
+            self,
+            filename: str,
+            image: QImage,
+            image_data: dict,
+            tiling_index: int,
+            pos: Tuple[int, int],
+            labels: List[str],
+    ):
+        """
+        Update the labels of a single tile, e.g. after it has been labeled in the app
+        """
+        tiling = image_data["tilings"][tiling_index]
+        key = tiling_key(tiling, image_data)
+        entry = self._tilings.get((filename, tiling_index))
+        if entry is None or entry["key"] != key:
+            # the whole tiling is updated by the next update_image
+            return
+
+        pos = tuple(pos)
+        labels = sorted(labels)
+        row = entry["rows"].get(pos)
+        if not labels:
+            if row is not None:
+                self._remove_row(entry["rows"].pop(pos))
+        elif row is None:
+            feature = self.get_features(image, [tile_rect(tiling, pos)])[0]
+            entry["rows"][pos] = self._add_row((filename, tiling_index, *pos), feature, labels)
+        elif self._row_labels[row] != labels:
+            self._row_labels[row] = labels
+            self._is_changed = True
+
+    def suggest(
+            self,
+            feature: np.ndarray,
+            k: int = 3,
+            num_neighbours: int = 10,
+            exclude: Optional[TileKey] = None,
+    ) -> List[Tuple[str, float]]:
+        """
+        The `k` most likely labels for the feature of a tile.
+
+        :param feature: numpy array as returned by `get_features`
+        :param k: int, maximum number of labels
+        :param num_neighbours: int, number of closest labeled tiles that vote
+        :param exclude: optional TileKey of a labeled tile that should not vote
+        :return: list of (label, score), scores sum to 1
+        """
+        num_rows = len(self._row_keys)
+        if not num_rows:
+            return []
+
+        # squared euclidean distance to all rows
+        distances = (
+            self._squared_norms[:num_rows] - 2 * (self._features[:num_rows] @ feature) + feature @ feature
+        )
+        distances[~self._is_active[:num_rows]] = np.inf
+        if exclude is not None:
+            entry = self._tilings.get(exclude[:2])
+            if entry is not None and exclude[2:] in entry["rows"]:
+                distances[entry["rows"][exclude[2:]]] = np.inf
+
+        num_neighbours = min(num_neighbours, num_rows)
+        rows = np.argpartition(distances, num_neighbours - 1)[:num_neighbours]
+        rows = rows[np.isfinite(distances[rows])]
+
+        votes = {}
+        for row in rows:
+            weight = 1. / (1. + max(0., float(distances[row])))
+            for label in self._row_labels[row]:
+                votes[label] = votes.get(label, 0.) + weight
+
+        total = sum(votes.values())
+        return [
+            (label, vote / total)
+            for label, vote in sorted(votes.items(), key=lambda i: -i[1])[:k]
+        ]
+
+    def suggest_tile(
+            self,
+            image: QImage,
+            tiling: dict,
+            pos: Tuple[int, int],
+            k: int = 3,
+            exclude: Optional[TileKey] = None,
+    ) -> List[Tuple[str, float]]:
+        return self.suggest(self.get_features(image, [tile_rect(tiling, pos)])[0], k=k, exclude=exclude)
+
+    def evaluate(self, k: int = 3) -> Tuple[float, float]:
+        """
+        Leave-one-out accuracy of the suggestions for all labeled tiles.
+
+        Returns the fraction of tiles where the first suggestion is one of their labels
+        and where one of the `k` suggestions is one of their labels.
+        """
+        rows = np.nonzero(self._is_active)[0]
+        if not len(rows):
+            return 0., 0.
+
+        num_top_1 = num_top_k = 0
+        for row in rows:
+            labels = set(self._row_labels[row])
+            suggestions = [
+                label for label, score in self.suggest(self._features[row], k=k, exclude=self._row_keys[row])
+            ]
+            num_top_1 += bool(suggestions) and suggestions[0] in labels
+            num_top_k += bool(labels & set(suggestions))
+        return num_top_1 / len(rows), num_top_k / len(rows)
+
+    def get_features(self, image: QImage, rects: List[QRect]) -> np.ndarray:
+        """
+        Features of the tiles at `rects` in shape [len(rects), num_features]
+        """
+        features = np.empty((len(rects), self.num_features), dtype=np.float32)
+        size = QSize(self.size, self.size)
+        for i, rect in enumerate(rects):
+            patch = (
+                image.copy(rect)
+                .convertToFormat(QImage.Format_ARGB32_Premultiplied)
+                .scaled(size, transformMode=Qt.SmoothTransformation)
+            )
+            data = patch.bits().asarray(patch.byteCount())
+            features[i] = np.frombuffer(data, dtype=np.uint8)[:self.num_features]
+        return features / 255.
+
+    def save(self, force: bool = False):
+        if self.filename is None or not (self._is_changed or force):
+            return
+
+        rows = np.nonzero(self._is_active)[0]
+        row_index = {int(row): i for i, row in enumerate(rows)}
+        meta = {
+            "version": self.VERSION,
+            "size": self.size,
+            "tilings": [
+                {
+                    "image": filename,
+                    "tiling": tiling_index,
+                    "key": entry["key"],
+                    "tiles": [[*pos, row_index[row]] for pos, row in sorted(entry["rows"].items())],
+                }
+                for (filename, tiling_index), entry in sorted(self._tilings.items())
+            ],
+            "labels": [self._row_labels[row] for row in rows],
+        }
+
+        buffer = io.BytesIO()
+        np.savez(buffer, features=self._features[rows], meta=np.array(json.dumps(meta)))
+
+        os.makedirs(self.filename.parent, exist_ok=True)
+        temp_filename = self.filename.with_name(f".{self.filename.name}.tmp")
+        temp_filename.write_bytes(buffer.getvalue())
+        os.replace(temp_filename, self.filename)
+        self._is_changed = False
+
+    def _load(self):
+        data = np.load(self.filename)
+        meta = json.loads(str(data["meta"]))
+        if meta.get("version") != self.VERSION or meta.get("size") != self.size:
+            self._is_changed = True
+            return
+
+        features = data["features"].astype(np.float32)
+        self._features = features
+        self._squared_norms = (features * features).sum(axis=1)
+        self._is_active = np.ones(len(features), dtype=bool)
+        self._row_keys = [None] * len(features)
+        self._row_labels = meta["labels"]
+        for tiling in meta["tilings"]:
+            rows = {}
+            for y, x, row in tiling["tiles"]:
+                rows[(y, x)] = row
+                self._row_keys[row] = (tiling["image"], tiling["tiling"], y, x)
+            self._tilings[(tiling["image"], tiling["tiling"])] = {"key": tiling["key"], "rows": rows}
+
+    def _add_row(self, key: TileKey, feature: np.ndarray, labels: List[str]) -> int:
+        if self._free_rows:
+            row = self._free_rows.pop()
+        else:
+            row = len(self._row_keys)
+            if row >= len(self._features):
+                self._grow(max(64, len(self._features) * 2))
+            self._row_keys.append(None)
+            self._row_labels.append([])
+
+        self._features[row] = feature
+        self._squared_norms[row] = feature @ feature
+        self._is_active[row] = True
+        self._row_keys[row] = key
+        self._row_labels[row] = labels
+        self._is_changed = True
+        return row
+
+    def _remove_row(self, row: int):
+        self._is_active[row] = False
+        self._row_keys[row] = None
+        self._row_labels[row] = []
+        self._free_rows.append(row)
+        self._is_changed = True
+
+    def _remove_tiling(self, filename: str, tiling_index: int):
+        entry = self._tilings.pop((filename, tiling_index), None)
+        if entry is not None:
+            for row in entry["rows"].values():
+                self._remove_row(row)
+            self._is_changed = True
+
+    def _grow(self, capacity: int):
+        num_rows = len(self._features)
+        self._features = np.concatenate([
+            self._features, np.zeros((capacity - num_rows, self.num_features), dtype=np.float32)
+        ])
+        self._squared_norms = np.concatenate([self._squared_norms, np.zeros(capacity - num_rows, dtype=np.float32)])
+        self._is_active = np.concatenate([self._is_active, np.zeros(capacity - num_rows, dtype=bool)])
+
+
+def tile_rect(tiling: dict, pos: Tuple[int, int]) -> QRect:
+    """
+    The image rectangle of the tile at (row, column)
+    """
+    return QRect(
+        tiling["offset_x"] + pos[1] * (tiling["patch_size_x"] + tiling["spacing_x"]),
+        tiling["offset_y"] + pos[0] * (tiling["patch_size_y"] + tiling["spacing_y"]),
+        tiling["patch_size_x"],
+        tiling["patch_size_y"],
+    )
+
+
+def _labeled_positions(tiling: dict) -> Dict[Tuple[int, int], List[str]]:
+    """
+    pos -> sorted labels
+    """
+    labeled = {}
+    for label, positions in (tiling.get("labels") or {}).items():
+        for pos in decode_positions(positions):
+            labeled.setdefault(pos, []).append(label)
+    for labels in labeled.values():
+        labels.sort()
+    return labeled
+
+
+def label_suggestions_filename() -> Path:
+    return config.BOOTSTRAP_DATA_PATH / "label-suggestions.npz"
+
+
+_label_suggestion_index: Optional[LabelSuggestionIndex] = None
+
+
+def get_label_suggestion_index() -> LabelSuggestionIndex:
+    global _label_suggestion_index
+    if _label_suggestion_index is None:
+        _label_suggestion_index = LabelSuggestionIndex(label_suggestions_filename())
+    return _label_suggestion_index
+
+
+def update_label_suggestion_index(index: LabelSuggestionIndex, sources: Iterable[dict]) -> int:
+    """
+    Update the index with the labeled tiles of all `sources` and remove images that are gone.
+
+    Returns the number of calculated features.
+    """
+    filenames = set()
+    num_calculated = 0
+    for source in sources:
+        for image_data in source["images"]:
+            filename = webcache_filename(image_data["filename"])
+            if not image_data["tilings"] or filename is None:
+                continue
+            filenames.add(filename)
+            image = QImage()
+            if index.needs_image(filename, image_data):
+                image = get_qimage_from_source(image_data)
+            num_calculated += index.update_image(filename, image, image_data)
+
+    for filename in index.filenames() - filenames:
+        index.remove_image(filename)
+
+    return num_calculated
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Build or update the label suggestion index of all labeled tiles,"
+                    " which is afterwards kept up-to-date by the app",
+    )
+
+    parser.add_argument(
+        "-f", "--force", type=bool, nargs="?", default=False, const=True,
+        help="Calculate the features of all labeled tiles instead of only the new ones",
+    )
+    parser.add_argument(
+        "-e", "--evaluate", type=bool, nargs="?", default=False, const=True,
+        help="Print the leave-one-out accuracy of the suggestions for the labeled tiles",
+    )
+    parser.add_argument(
+        "-k", "--top-k", type=int, default=3,
+        help="Number of suggestions to consider in the evaluation",
+    )
+
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_args()
+    if args["force"] and label_suggestions_filename().exists():
+        label_suggestions_filename().unlink()
+    index = get_label_suggestion_index()
+
+    start_time = time.time()
+    num_calculated = update_label_suggestion_index(index, iter_sources())
+    index.save()
+    print(f"calculated {num_calculated:,} features, index: {len(index):,} tiles in {time.time() - start_time:.2f}s")
+
+    if args["evaluate"] and len(index):
+        start_time = time.time()
+        top_1, top_k = index.evaluate(k=args["top_k"])
+        duration = time.time() - start_time
+        print(
+            f"top-1: {top_1:.3f}, top-{args['top_k']}: {top_k:.3f}"
+            f", {duration / len(index) * 1000:.2f}ms per query"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,5 @@
-import json
-import os
-from pathlib import Path
 from functools import partial
-from copy import deepcopy
-from typing import List
+from typing import List, Dict
 
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
@@ -12,13 +8,22 @@ from PyQt5.QtWidgets import *
 from .sourceselect import SourceSelect
 from .imageselect import ImageSelect
 from .imagepatcheditor import ImagePatchEditor
+from ..journal import SourceJournal, source_to_json
+from .duplicateindex import get_duplicate_index
+from .labelsuggest import get_label_suggestion_index
+from ..annotationdb import get_annotation_database
 from .. import config
 
 
 class MainWindow(QMainWindow):
 
+    # number of journal records after which the source data file is rewritten
+    JOURNAL_COMPACT_RECORDS = 500
+
     def __init__(self):
         super().__init__()
+        # source name -> (journal, latest source)
+        self._journals: Dict[str, tuple] = {}
 
         self.setWindowTitle(self.tr("PixelArt Dataset"))
         # self.setWindowFlag(Qt.WindowMinMaxButtonsHint, True)
@@ -60,6 +65,12 @@ class MainWindow(QMainWindow):
         # Client.singleton().stop()
         return True
 
+    def closeEvent(self, event: QCloseEvent):
+        self.compact_journals()
+        get_duplicate_index().save()
+        get_label_suggestion_index().save()
+        super().closeEvent(event)
+
     def slot_exit(self):
         self.close()
 
@@ -69,24 +80,26 @@ class MainWindow(QMainWindow):
     def _slot_image_selected(self, data: dict, index: int):
         self.image_editor.set_image(data, index)
 
-    def slot_save_source(self, source: dict):
+    def slot_save_source(self, source: dict, records: List[dict]):
         self.image_select.set_source(source)
         self.source_select.update_source(source)
 
-        filename = Path(source["data_filename"])
-        os.makedirs(filename.parent, exist_ok=True)
-
-        source2 = deepcopy(source)
-        source2["images"] = []
-        for image in source["images"]:
-            if image["tilings"]:
-                image = deepcopy(image)
-                image["filename"] = str(Path(image["filename"]).relative_to(source["web_folder"]))
-                for tiling in image["tilings"]:
-                    tiling.pop("duplicates", None)
-                source2["images"].append(image)
-
-        for key in ("name", "web_folder", "data_filename"):
-            source2.pop(key, None)
-
-        filename.write_text(json.dumps(source2))
+        database = get_annotation_database()
+        if database is not None:
+            database.save_source_data(source_to_json(source))
+            return
+
+        if source["name"] in self._journals:
+            journal = self._journals[source["name"]][0]
+        else:
+            journal = SourceJournal(source["data_filename"])
+        self._journals[source["name"]] = (journal, source)
+
+        journal.append(records)
+        if journal.num_records >= self.JOURNAL_COMPACT_RECORDS:
+            journal.compact(source)
+
+    def compact_journals(self):
+        for journal, source in self._journals.values():
+            if journal.num_records:
+                journal.compact(source)
@@ -0,0 +1,315 @@
+import json
+import time
+import argparse
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+from PyQt5.QtCore import *
+from PyQt5.QtGui import *
+
+from bootstrap.app.util import get_default_tiling, get_qimage_from_source, qimage_to_numpy
+from bootstrap.emptytiles import find_empty_tiles
+
+
+def detect_tiling(image: np.ndarray, min_size: int = 4) -> Optional[dict]:
+    """
+    Propose a tiling for a sprite sheet.
+
+    The stride of each axis is the strongest period in the autocorrelation of
+    the content edges of the columns (or rows), or of the color changes
+    if the content does not vary.
+    Columns that are empty in every period are the spacing, otherwise the
+    offset is placed at the emptiest columns or at the strongest color changes.
+
+    :param image: numpy array of shape [4, H, W] as returned by `qimage_to_numpy`
+    :param min_size: int, the smallest patch size to consider
+    :return: tiling dict or None if no periodic structure is found
+    """
+    packed = _pack_pixels(image)
+    content = _get_content_mask(image, packed)
+    # set background pixels to zero, so that changes within the background do not count
+    pixels = np.where(content, packed, 0)
+
+    axes = []
+    for axis_pixels, axis_content in ((pixels, content), (pixels.T, content.T)):
+        axes.append(_detect_axis(axis_pixels, axis_content, min_size=min_size))
+
+    if axes[0] is None and axes[1] is None:
+        return None
+
+    # square tiles are the common case, so use the size of the detected axis for both
+    if axes[0] is None:
+        axes[0] = (0, *axes[1][1:])
+    if axes[1] is None:
+        axes[1] = (0, *axes[0][1:])
+    (offset_x, size_x, spacing_x), (offset_y, size_y, spacing_y) = axes
+    return {
+        **get_default_tiling(),
+        "offset_x": offset_x,
+        "offset_y": offset_y,
+        "patch_size_x": size_x,
+        "patch_size_y": size_y,
+        "spacing_x": spacing_x,
+        "spacing_y": spacing_y,
+    }
+
+
+def propose_tiling(image: QImage, min_size: int = 4) -> dict:
+    """
+    The detected tiling or the default tiling of the image
+    """
+    return detect_tiling(qimage_to_numpy(image), min_size=min_size) or get_default_tiling(image.size())
+
+
+def _pack_pixels(image: np.ndarray) -> np.ndarray:
+    """
+    RGBA [4, H, W] uint8 to [H, W] uint32
+    """
+    return (
+        image[0].astype(np.uint32) << 24 | image[1].astype(np.uint32) << 16
+        | image[2].astype(np.uint32) << 8 | image[3].astype(np.uint32)
+    )
+
+
+def _get_content_mask(image: np.ndarray, packed: np.ndarray) -> np.ndarray:
+    """
+    Boolean [H, W] mask of the pixels that are not transparent
+    and not the background color
+    """
+    alpha = image[3]
+    if (alpha == 0).any():
+        return alpha > 0
+
+    border = np.concatenate([packed[0], packed[-1], packed[:, 0], packed[:, -1]])
+    values, counts = np.unique(border, return_counts=True)
+    return packed != values[np.argmax(counts)]
+
+
+def _detect_axis(pixels: np.ndarray, content: np.ndarray, min_size: int) -> Optional[Tuple[int, int, int]]:
+    """
+    Detect (offset, patch size, spacing) along the last axis of the [H, W] packed pixels
+    """
+    width = content.shape[1]
+    if width < min_size * 2:
+        return None
+
+    # fraction of content per column
+    content_profile = content.mean(axis=0)
+    # change of the content fraction between column x - 1 and x
+    edge_profile = np.zeros(width)
+    edge_profile[1:] = np.abs(np.diff(content_profile))
+    # fraction of changed pixels between column x - 1 and x
+    change_profile = np.zeros(width)
+    change_profile[1:] = (pixels[:, 1:] != pixels[:, :-1]).mean(axis=0)
+
+    # sprites on a background show the grid in the content edges,
+    #   the color changes are used for (almost) opaque tiles
+    stride = None
+    if content_profile.mean() < .99:
+        stride = _detect_period(edge_profile, min_size=min_size)
+    if stride is None:
+        stride = _detect_comb_period(change_profile, min_size=min_size)
+    if stride is None:
+        return None
+
+    num_periods = width // stride
+    folded_content = content_profile[:num_periods * stride].reshape(num_periods, stride).mean(axis=0)
+    folded_change = change_profile[:num_periods * stride].reshape(num_periods, stride).mean(axis=0)
+
+    # columns that are empty in every period
+    start, length = _longest_cyclic_run(folded_content == 0)
+    if 0 < length <= stride // 2:
+        return (start + length) % stride, stride - length, length
+
+    if folded_content.max() - folded_content.min() > .1:
+        # the boundary is between the two emptiest neighbouring columns
+        return int(np.argmin(folded_content + np.roll(folded_content, 1))), stride, 0
+
+    return int(np.argmax(folded_change)), stride, 0
+
+
+def _detect_period(profile: np.ndarray, min_size: int, threshold: float = .15) -> Optional[int]:
+    """
+    The smallest strong period of the normalized autocorrelation of the profile
+    """
+    width = len(profile)
+    profile = profile - profile.mean()
+    if not np.any(np.abs(profile) > 1e-9):
+        return None
+
+    spectrum = np.fft.rfft(profile, width * 2)
+    correlation = np.fft.irfft(spectrum * np.conj(spectrum))[:width]
+    correlation /= correlation[0]
+
+    lags = np.arange(min_size, width // 2 + 1)
+    if not len(lags):
+        return None
+    values = correlation[lags]
+    is_peak = (values >= correlation[lags - 1]) & (values >= correlation[np.minimum(lags + 1, width - 1)])
+    if not is_peak.any():
+        return None
+
+    best = values[is_peak].max()
+    if best < threshold:
+        return None
+
+    # harmonics of the period are about as strong, so take the first strong peak
+    return int(lags[is_peak & (values >= best * .8)][0])
+
+
+def _detect_comb_period(profile: np.ndarray, min_size: int, threshold: float = .02) -> Optional[int]:
+    """
+    The period at which exactly one phase of the folded profile stands out.
+
+    Used for the color changes of opaque tiles, where the changes at the
+    tile boundaries are only a bit more frequent than within the tiles.
+    At multiples of the period, more than one phase stands out and
+    at divisors, the boundary phase is mixed with other phases.
+    """
+    width = len(profile)
+    # the maximum of few folded periods is noisy
+    lags = np.arange(min_size, width // 3 + 1)
+    if not len(lags):
+        return None
+
+    scores = _comb_scores(profile, lags)
+    if scores.max() < threshold:
+        return None
+    lag = int(lags[np.argmax(scores)])
+
+    # upscaled pixels are a period themselves, look for the tiles in the rest of the profile
+    multiples = lags[lags % lag == 0][1:]
+    if len(multiples):
+        folded = profile[:width // lag * lag].reshape(-1, lag).mean(axis=0)
+        residual = profile - np.resize(folded, width)
+        scores = _comb_scores(residual, multiples)
+        if scores.max() >= threshold:
+            lag = int(multiples[np.argmax(scores)])
+
+    return lag
+
+
+def _comb_scores(profile: np.ndarray, lags: np.ndarray) -> np.ndarray:
+    """
+    Difference between the largest and second largest phase of the profile folded at each lag
+    """
+    width = len(profile)
+    scores = np.empty(len(lags))
+    for i, lag in enumerate(lags):
+        folded = np.sort(profile[:width // lag * lag].reshape(-1, lag).mean(axis=0))
+        scores[i] = folded[-1] - folded[-2]
+    return scores
+
+
+def _longest_cyclic_run(mask: np.ndarray) -> Tuple[int, int]:
+    """
+    Start and length of the longest run of True values, wrapping around the end
+    """
+    if mask.all():
+        return 0, len(mask)
+    if not mask.any():
+        return 0, 0
+
+    # rotate so that the array starts with a False value
+    shift = int(np.argmin(mask))
+    rotated = np.roll(mask, -shift).astype(np.int8)
+    edges = np.diff(np.concatenate([[0], rotated, [0]]))
+    starts = np.nonzero(edges == 1)[0]
+    ends = np.nonzero(edges == -1)[0]
+    index = int(np.argmax(ends - starts))
+    return int((starts[index] + shift) % len(mask)), int(ends[index] - starts[index])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Propose tilings for all images without a tiling",
+    )
+
+    parser.add_argument(
+        "-a", "--apply", type=bool, nargs="?", default=False, const=True,
+        help="Store the proposed tilings in the annotation data",
+    )
+    parser.add_argument(
+        "-ie", "--ignore-empty", type=bool, nargs="?", default=False, const=True,
+        help="Ignore the transparent and single-color tiles of the proposed tilings",
+    )
+    parser.add_argument(
+        "-ms", "--min-size", type=int, default=4,
+        help="The smallest patch size to consider",
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, nargs="?", default=None,
+        help="Filename of the json proposals, keyed by source url and image filename",
+    )
+
+    return vars(parser.parse_args())
+
+
+def main():
+    from bootstrap.app.sourcemodel import SourceModel
+    from bootstrap.journal import SourceJournal, image_to_json, source_to_json
+    from bootstrap.annotationdb import get_annotation_database
+
+    args = parse_args()
+
+    proposals = {}
+    num_images = 0
+    start_time = time.time()
+    model = SourceModel(None)
+    for row in range(model.rowCount()):
+        source = model.data(model.index(row, 0), role=Qt.ItemDataRole.UserRole)
+        records = []
+        for image_data in source["images"]:
+            if image_data["tilings"]:
+                continue
+
+            num_images += 1
+            image = get_qimage_from_source(image_data)
+            if image.isNull():
+                continue
+
+            pixels = qimage_to_numpy(image)
+            tiling = detect_tiling(pixels, min_size=args["min_size"])
+            if tiling is None:
+                continue
+
+            if args["ignore_empty"]:
+                empty = find_empty_tiles(pixels, tiling)
+                if empty:
+                    tiling["ignore"] = sorted(empty)
+
+            filename = str(Path(image_data["filename"]).relative_to(source["web_folder"]))
+            proposals.setdefault(source["url"], {})[filename] = tiling
+            print(
+                f"{source['name']}/{filename}: {image.width()}x{image.height()}"
+                f" patch {tiling['patch_size_x']}x{tiling['patch_size_y']}"
+                f" spacing {tiling['spacing_x']}x{tiling['spacing_y']}"
+                f" offset {tiling['offset_x']}x{tiling['offset_y']}"
+                + (f" ignored {len(tiling['ignore'])}" if tiling.get("ignore") else "")
+            )
+
+            if args["apply"]:
+                image_data["tilings"] = [tiling]
+                records.append({
+                    "op": "image",
+                    "image": filename,
+                    "data": image_to_json(image_data, source["web_folder"]),
+                })
+
+        if records:
+            database = get_annotation_database()
+            if database is not None:
+                database.save_source_data(source_to_json(source))
+            else:
+                SourceJournal(source["data_filename"]).append(records)
+
+    num_proposals = sum(len(p) for p in proposals.values())
+    print(f"proposed {num_proposals:,} tilings for {num_images:,} untiled images in {time.time() - start_time:.2f}s")
+
+    if args["output"]:
+        Path(args["output"]).write_text(json.dumps(proposals, indent=2))
+
+
+if __name__ == "__main__":
+    main()
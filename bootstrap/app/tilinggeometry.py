@@ -0,0 +1,188 @@
+import time
+import threading
+from typing import Optional, Dict, Tuple, List, Callable
+
+from PyQt5.QtCore import *
+from PyQt5.QtGui import *
+
+from .util import Tiling
+from .instrumentation import get_instrumentation
+
+
+class TilingGeometry:
+    """
+    The display geometry of a tiling at a specific zoom.
+
+    `rects` maps each tile position to its (zoomed) rectangle,
+    `outside` is the region of the widget that is not covered by any tile.
+    """
+    def __init__(
+            self,
+            request_id: int,
+            key: tuple,
+            zoom: int,
+            offset: Tuple[int, int],
+            stride: Tuple[int, int],
+            rects: Dict[Tuple[int, int], QRect],
+            outside: QRegion,
+    ):
+        self.request_id = request_id
+        self.key = key
+        self.zoom = zoom
+        self.offset = offset
+        self.stride = stride
+        self.rects = rects
+        self.outside = outside
+
+    def visible_positions(self, rect: QRect) -> List[Tuple[int, int]]:
+        """
+        Positions of the tiles that intersect with the (zoomed) `rect`
+        """
+        rows = range(
+            max(0, (rect.top() // self.zoom - self.offset[0]) // self.stride[0]),
+            (rect.bottom() // self.zoom - self.offset[0]) // self.stride[0] + 1,
+        )
+        cols = range(
+            max(0, (rect.left() // self.zoom - self.offset[1]) // self.stride[1]),
+            (rect.right() // self.zoom - self.offset[1]) // self.stride[1] + 1,
+        )
+        return [
+            (row, col)
+            for row in rows
+            for col in cols
+            if (row, col) in self.rects
+        ]
+
+
+def tiling_geometry_key(image_size: QSize, tiling: dict, zoom: int) -> tuple:
+    return (
+        image_size.width(), image_size.height(), zoom,
+        tiling["offset_x"], tiling["offset_y"],
+        tiling["patch_size_x"], tiling["patch_size_y"],
+        tiling["spacing_x"], tiling["spacing_y"],
+        tiling.get("size_x") or 0, tiling.get("size_y") or 0,
+    )
+
+
+def compute_tiling_geometry(
+        request_id: int,
+        image_size: QSize,
+        tiling: dict,
+        zoom: int,
+        is_cancelled: Optional[Callable[[], bool]] = None,
+) -> Optional[TilingGeometry]:
+    """
+    Calculate the TilingGeometry, returns None if `is_cancelled()` became True in between.
+
+    The steps are recorded as "tiling.rects" and "tiling.outside_polygon"
+    if the instrumentation is enabled.
+    """
+    # the geometry does not depend on the tile states
+    tiling = {key: value for key, value in tiling.items() if key not in ("ignore", "duplicates", "labels")}
+    t = Tiling(image_size, tiling, zoom=zoom)
+    instrumentation = get_instrumentation()
+
+    start_time = time.perf_counter()
+    rects = {}
+    stride_rects = []
+    for i, (rect, pos) in enumerate(t.iter_rects(yield_pos=True)):
+        if is_cancelled is not None and i % 256 == 0 and is_cancelled():
+            return None
+        rects[pos] = rect
+        stride_rects.append(QRect(rect.x(), rect.y(), t.stride_x * zoom, t.stride_y * zoom))
+    if instrumentation is not None:
+        instrumentation.record("tiling.rects", time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    # iter_rects yields non-overlapping rects in row-major order,
+    #   which is the banded form expected by setRects and much faster than uniting them
+    tiles_region = QRegion()
+    if stride_rects:
+        tiles_region.setRects(stride_rects)
+    outside = QRegion(QRect(QPoint(0, 0), image_size * zoom)).subtracted(tiles_region)
+    if instrumentation is not None:
+        instrumentation.record("tiling.outside_polygon", time.perf_counter() - start_time)
+
+    return TilingGeometry(
+        request_id=request_id,
+        key=tiling_geometry_key(image_size, tiling, zoom),
+        zoom=zoom,
+        offset=(t.offset_y, t.offset_x),
+        stride=(t.stride_y, t.stride_x),
+        rects=rects,
+        outside=outside,
+    )
+
+
+class TilingGeometryWorker(QObject):
+    """
+    Calculates TilingGeometry in a background thread.
+
+    Only the latest request is calculated, older pending requests are dropped
+    and a running calculation is cancelled when a new request arrives.
+    `stop` ends the thread, it must be called before the worker is deleted.
+    """
+    signal_finished = pyqtSignal(object)
+
+    def __init__(self, parent: Optional[QObject] = None):
+        super().__init__(parent)
+        self._condition = threading.Condition()
+        self._request: Optional[tuple] = None
+        self._request_id = 0
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def request_id(self) -> int:
+        """
+        Id of the latest request
+        """
+        return self._request_id
+
+    def request(self, image_size: QSize, tiling: dict, zoom: int) -> int:
+        with self._condition:
+            self._request_id += 1
+            self._request = (self._request_id, QSize(image_size), dict(tiling), zoom)
+            self._condition.notify()
+
+        if self._thread is None:
+            self._stopped = False
+            self._thread = threading.Thread(target=self._mainloop, name="tiling-geometry", daemon=True)
+            self._thread.start()
+
+        return self._request_id
+
+    def stop(self):
+        """
+        Cancel the pending request and wait for the thread to end,
+        no `signal_finished` is emitted afterwards
+        """
+        with self._condition:
+            self._stopped = True
+            self._request = None
+            self._condition.notify()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _is_cancelled(self) -> bool:
+        return self._request is not None or self._stopped
+
+    def _mainloop(self):
+        while True:
+            with self._condition:
+                while self._request is None and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                request, self._request = self._request, None
+
+            start_time = time.perf_counter()
+            geometry = compute_tiling_geometry(*request, is_cancelled=self._is_cancelled)
+
+            if geometry is not None and not self._stopped:
+                instrumentation = get_instrumentation()
+                if instrumentation is not None:
+                    instrumentation.record("tiling_geometry", time.perf_counter() - start_time)
+                self.signal_finished.emit(geometry)
@@ -1,26 +1,16 @@
-import math
+import hashlib
 from io import BytesIO
 from copy import deepcopy
-from typing import List, Generator, Tuple, Optional
+from typing import List, Generator, Tuple, Optional, Set, Dict
 
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 
 import PIL.Image
 import numpy as np
-import skimage.measure
 
-
-DEFAULT_TILING = {
-    "offset_x": 0,
-    "offset_y": 0,
-    "patch_size_x": 16,
-    "patch_size_y": 16,
-    "spacing_x": 0,
-    "spacing_y": 0,
-    "size_x": 0,
-    "size_y": 0,
-}
+from .. import images
+from ..sources import DEFAULT_TILING, TileGrid
 
 
 def get_default_tiling(image_size: Optional[QSize] = None):
@@ -39,11 +29,14 @@ def get_default_tiling(image_size: Optional[QSize] = None):
 
 
 class Tiling:
-    
+    """
+    The Qt view of a `TileGrid`, with QRects scaled by `zoom`.
+    """
     def __init__(self, image_size: QSize, tiling: dict, zoom: int = 1):
         self.image_size = image_size
         self._tiling = tiling
         self.zoom = zoom
+        self.grid = TileGrid((image_size.width(), image_size.height()), tiling)
 
         self.offset_x = tiling["offset_x"]
         self.offset_y = tiling["offset_y"]
@@ -55,21 +48,26 @@ class Tiling:
         #self.limit_y = tiling.get("limit_y") or image_size.height()
         self.size_x = tiling.get("size_x") or 0
         self.size_y = tiling.get("size_y") or 0
-        if tiling.get("ignore"):
-            self.ignore_tiles = set(tuple(t) for t in tiling["ignore"])
-        else:
-            self.ignore_tiles = set()
-        if tiling.get("duplicates"):
-            self.duplicate_tiles = set(tuple(t) for t in tiling["duplicates"])
-        else:
-            self.duplicate_tiles = set()
-        if tiling.get("labels"):
-            self.labels = {
-                label: set(tuple(p) for p in positions)
-                for label, positions in tiling["labels"].items()
-            }
-        else:
-            self.labels = {}
+
+    @property
+    def ignore_tiles(self) -> Set[Tuple[int, int]]:
+        return self.grid.ignore_tiles
+
+    @ignore_tiles.setter
+    def ignore_tiles(self, positions: Set[Tuple[int, int]]):
+        self.grid.ignore_tiles = positions
+
+    @property
+    def duplicate_tiles(self) -> Set[Tuple[int, int]]:
+        return self.grid.duplicate_tiles
+
+    @duplicate_tiles.setter
+    def duplicate_tiles(self, positions: Set[Tuple[int, int]]):
+        self.grid.duplicate_tiles = positions
+
+    @property
+    def labels(self) -> Dict[str, Set[Tuple[int, int]]]:
+        return self.grid.labels
 
     def rects(
             self,
@@ -90,35 +88,20 @@ class Tiling:
             size_minus: int = 0,
             full_stride: bool = False,
     ) -> Generator[QRect, None, None]:
-
-        patch_size_y = self.patch_size_y
-        patch_size_x = self.patch_size_x
-        if full_stride:
-            patch_size_y = self.stride_y
-            patch_size_x = self.stride_x
-
-        for y in range(self.offset_y, self.image_size.height(), self.stride_y):
-            if y + self.patch_size_y <= self.image_size.height():
-                for x in range(self.offset_x, self.image_size.width(), self.stride_x):
-                    if x + self.patch_size_x <= self.image_size.width():
-
-                        tile_pos = self.to_tile_pos(self.zoom * y, self.zoom * x)
-                        if ignored == (tile_pos in self.ignore_tiles) or duplicates:
-                            if duplicates == (tile_pos in self.duplicate_tiles):
-
-                                if not self.size_y or tile_pos[0] < self.size_y:
-                                    if not self.size_x or tile_pos[1] < self.size_x:
-
-                                        rect = QRect(
-                                            self.zoom * x,
-                                            self.zoom * y,
-                                            self.zoom * patch_size_x - size_minus,
-                                            self.zoom * patch_size_y - size_minus,
-                                        )
-                                        if yield_pos:
-                                            yield rect, tile_pos
-                                        else:
-                                            yield rect
+        for (x, y, width, height), tile_pos in self.grid.iter_rects(ignored=ignored, duplicates=duplicates):
+            if full_stride:
+                width, height = self.stride_x, self.stride_y
+
+            rect = QRect(
+                self.zoom * x,
+                self.zoom * y,
+                self.zoom * width - size_minus,
+                self.zoom * height - size_minus,
+            )
+            if yield_pos:
+                yield rect, tile_pos
+            else:
+                yield rect
 
     def outside_polygon(self, display_rect: Optional[QRect] = None):
         if display_rect is None:
@@ -142,11 +125,15 @@ class Tiling:
         return pos in self.duplicate_tiles
 
     def get_labels_at(self, *pos: int) -> List[str]:
-        labels = []
-        for key, pos_set in self.labels.items():
-            if pos in pos_set:
-                labels.append(key)
-        return labels
+        return self.grid.get_labels_at(*pos)
+
+
+def get_patch_hash(patch: QImage) -> str:
+    """
+    Hash of the exact pixel data of a patch
+    """
+    data = patch.bits().asarray(size=patch.byteCount())
+    return hashlib.md5(data).hexdigest()
 
 
 def qimage_to_pil(image: QImage) -> PIL.Image.Image:
@@ -195,6 +182,18 @@ def numpy_to_pil(data: np.ndarray) -> PIL.Image.Image:
 
 
 def get_qimage_from_source(image_data: dict) -> QImage:
+    image = load_qimage_from_source(image_data)
+
+    if image_data.get("alpha"):
+        image = apply_alpha_colors(image, image_data["alpha"])
+
+    return image
+
+
+def load_qimage_from_source(image_data: dict) -> QImage:
+    """
+    Load the source image file, without applying the alpha colors
+    """
     image = QImage(image_data["filename"])
 
     if image.hasAlphaChannel() or image_data.get("alpha"):
@@ -202,44 +201,40 @@ def get_qimage_from_source(image_data: dict) -> QImage:
     else:
         image = image.convertToFormat(QImage.Format_RGB32)
 
-    if image_data.get("alpha"):
-        image_np = qimage_to_numpy(image)
+    return image
 
-        for color in image_data["alpha"]:
-            mask = (image_np[0] == color[0]) & (image_np[1] == color[1]) & (image_np[2] == color[2])
-            mask = ~mask
 
-            image_np[3] = image_np[3] * mask
+def apply_alpha_colors(image: QImage, colors: List[List[int]]) -> QImage:
+    """
+    Make all pixels transparent that match one of the RGB `colors`,
+    see `bootstrap.images.apply_alpha_colors`
+    """
+    return pixels_to_qimage(images.apply_alpha_colors(qimage_to_pixels(image), colors))
 
-        image = numpy_to_qimage(image_np.astype(np.uint8))
 
-    return image
+def get_image_bounding_rect(image_channel: np.ndarray) -> QRect:
+    """
+    The bounding box of the contours of an alpha channel as QRect,
+    see `bootstrap.images.get_alpha_bounding_rect`
+    """
+    return QRect(*images.get_alpha_bounding_rect(image_channel))
 
 
-def get_image_bounding_rect(image_channel: np.ndarray) -> QRect:
+def qimage_to_pixels(image: QImage) -> np.ndarray:
+    """
+    The [H, W] uint32 0xAARRGGBB pixels of the image, like `bootstrap.images.load_image`
+    """
+    image = image.convertToFormat(QImage.Format_ARGB32)
+    data = image.constBits().asarray(image.byteCount())
+    pixels = np.frombuffer(data, dtype=np.uint32).reshape(image.height(), image.bytesPerLine() // 4)
+    return pixels[:, :image.width()].copy()
+
 
-    min_x, min_y, max_x, max_y = None, None, None, None
-    for cont in skimage.measure.find_contours(image_channel):
-        c_min_x = cont[:, 0].min()
-        c_max_x = cont[:, 0].max()
-        c_min_y = cont[:, 1].min()
-        c_max_y = cont[:, 1].max()
-
-        if min_x is None or c_min_x < min_x:
-            min_x = c_min_x
-        if min_y is None or c_min_y < min_y:
-            min_y = c_min_y
-        if max_x is None or c_max_x > max_x:
-            max_x = c_max_x
-        if max_y is None or c_max_y > max_y:
-            max_y = c_max_y
-
-    if min_x is None:
-        return QRect(0, 0, image_channel.shape[-1], image_channel.shape[-2])
-
-    min_x = int(math.floor(min_x))
-    min_y = int(math.floor(min_y))
-    max_x = min(image_channel.shape[-1], int(math.ceil(max_x)))
-    max_y = min(image_channel.shape[-2], int(math.ceil(max_y)))
-
-    return QRect(min_x, min_y, max_x - min_x, max_y - min_y)
+def pixels_to_qimage(pixels: np.ndarray) -> QImage:
+    """
+    ARGB32 QImage of [H, W] uint32 0xAARRGGBB pixels
+    """
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint32)
+    height, width = pixels.shape
+    # copy() detaches the image from the numpy buffer
+    return QImage(pixels.tobytes(), width, height, width * 4, QImage.Format_ARGB32).copy()
@@ -0,0 +1,55 @@
+from collections import OrderedDict
+from typing import Optional
+
+from PyQt5.QtCore import *
+from PyQt5.QtGui import *
+
+
+class ZoomPixmapCache:
+    """
+    Pre-scaled pixmaps of one image per zoom level.
+
+    The least recently used zoom levels are evicted when the pixmaps
+    exceed `max_bytes`. Zoom levels that would not fit on their own
+    are not cached and `pixmap` returns None.
+    """
+    def __init__(self, max_bytes: int = 256 * 2**20):
+        self.max_bytes = max_bytes
+        self._image: Optional[QImage] = None
+        self._pixmaps = OrderedDict()
+        self._num_bytes = 0
+
+    @property
+    def num_bytes(self) -> int:
+        return self._num_bytes
+
+    def set_image(self, image: Optional[QImage]):
+        self._image = image
+        self._pixmaps.clear()
+        self._num_bytes = 0
+
+    def pixmap(self, zoom: int) -> Optional[QPixmap]:
+        if self._image is None:
+            return None
+
+        if zoom in self._pixmaps:
+            self._pixmaps.move_to_end(zoom)
+            return self._pixmaps[zoom]
+
+        size = self._image.size() * zoom
+        num_bytes = size.width() * size.height() * 4
+        if num_bytes > self.max_bytes:
+            return None
+
+        while self._pixmaps and self._num_bytes + num_bytes > self.max_bytes:
+            _, pixmap = self._pixmaps.popitem(last=False)
+            self._num_bytes -= self._pixmap_bytes(pixmap)
+
+        pixmap = QPixmap.fromImage(self._image.scaled(size, transformMode=Qt.FastTransformation))
+        self._pixmaps[zoom] = pixmap
+        self._num_bytes += self._pixmap_bytes(pixmap)
+        return pixmap
+
+    @staticmethod
+    def _pixmap_bytes(pixmap: QPixmap) -> int:
+        return pixmap.width() * pixmap.height() * max(1, pixmap.depth() // 8)
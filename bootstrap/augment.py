@@ -0,0 +1,382 @@
+import csv
+import json
+import os
+import time
+import argparse
+import multiprocessing
+from pathlib import Path
+from typing import Optional, Tuple, Iterable, Sequence, Generator, Union
+
+import numpy as np
+from tqdm import tqdm
+
+from bootstrap.dataset import TileDataset
+
+
+TRANSFORMS = ("original", "flip_h", "flip_v", "rot90", "rot180", "rot270", "hue", "outline")
+
+# the dataset of the worker process, see `_init_worker`
+_worker_dataset: Optional[TileDataset] = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Write augmented copies of the tiles of a compiled dataset",
+    )
+
+    parser.add_argument(
+        "dataset", type=str,
+        help="Directory of the dataset written by compile.py",
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, required=True,
+        help="Directory to store the augmented shards",
+    )
+    parser.add_argument(
+        "-t", "--transforms", type=str, default="flip_h,flip_v,rot90,rot180,rot270,hue,outline",
+        help=f"Comma-separated transforms, each one writes one copy of every tile: {', '.join(TRANSFORMS)}."
+             f" 'hue' can be repeated for several random hue shifts",
+    )
+    parser.add_argument(
+        "-sp", "--split", type=str, default=None,
+        help="Only augment the tiles of this split, e.g. train",
+    )
+    parser.add_argument(
+        "-ss", "--shard-size", type=int, default=4096,
+        help="Number of source tiles per shard",
+    )
+    parser.add_argument(
+        "-bs", "--batch-size", type=int, default=512,
+        help="Number of source tiles that are transformed at once",
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=os.cpu_count() or 1,
+        help="Number of worker processes",
+    )
+    parser.add_argument(
+        "-s", "--seed", type=int, default=0,
+        help="Random seed of the hue shifts, the output does not depend on the number of workers",
+    )
+    parser.add_argument(
+        "-oc", "--outline-color", type=str, default="ffffff",
+        help="Hex RGB color of the outline",
+    )
+    parser.add_argument(
+        "-bg", "--background", type=str, default="000000",
+        help="Hex RGB color of the background of tiles without alpha channel,"
+             " compile.py draws transparent pixels black",
+    )
+
+    return vars(parser.parse_args())
+
+
+def parse_color(color: str) -> Tuple[int, int, int]:
+    color = color.lstrip("#")
+    if len(color) != 6:
+        raise ValueError(f"Expected a hex RGB color like 'ff8000', got '{color}'")
+    return tuple(int(color[i:i + 2], 16) for i in range(0, 6, 2))
+
+
+def shift_hue(tiles: np.ndarray, degrees: Union[float, np.ndarray]) -> np.ndarray:
+    """
+    Rotate the hue of [N, H, W, C] uint8 tiles in HSV space, by one angle per tile.
+    Gray pixels and the alpha channel are unchanged.
+    """
+    rgb = tiles[..., :3].astype(np.float32) / 255
+    red, green, blue = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    value = rgb.max(axis=-1)
+    delta = value - rgb.min(axis=-1)
+    safe_delta = np.where(delta > 0, delta, 1)
+
+    hue = np.where(
+        value == red, ((green - blue) / safe_delta) % 6,
+        np.where(value == green, (blue - red) / safe_delta + 2, (red - green) / safe_delta + 4),
+    )
+    degrees = np.broadcast_to(np.asarray(degrees, dtype=np.float32), (len(tiles),))
+    hue = (hue + degrees[:, None, None] / 60) % 6
+    chroma = delta
+
+    # HSV -> RGB of each channel with its offset on the hue circle
+    channels = []
+    for offset in (5, 3, 1):
+        k = (hue + offset) % 6
+        channels.append(value - chroma * np.clip(np.minimum(k, 4 - k), 0, 1))
+
+    result = tiles.copy()
+    result[..., :3] = np.clip(np.rint(np.stack(channels, axis=-1) * 255), 0, 255).astype(np.uint8)
+    return result
+
+
+def outline_tiles(
+        tiles: np.ndarray,
+        color: Sequence[int] = (255, 255, 255),
+        background: Sequence[int] = (0, 0, 0),
+) -> np.ndarray:
+    """
+    Draw a one pixel outline around the shapes of [N, H, W, C] uint8 tiles.
+
+    Background pixels next to (left, right, above or below) a non-background pixel get the `color`.
+    With an alpha channel, the fully transparent pixels are the background,
+    otherwise the pixels of the `background` color.
+    """
+    if tiles.shape[-1] == 4:
+        is_background = tiles[..., 3] == 0
+    else:
+        is_background = np.all(tiles == np.asarray(background, dtype=np.uint8), axis=-1)
+
+    is_shape = np.pad(~is_background, ((0, 0), (1, 1), (1, 1)))
+    is_next_to_shape = (
+        is_shape[:, :-2, 1:-1] | is_shape[:, 2:, 1:-1] | is_shape[:, 1:-1, :-2] | is_shape[:, 1:-1, 2:]
+    )
+
+    result = tiles.copy()
+    result[is_background & is_next_to_shape] = (*color, 255)[:tiles.shape[-1]]
+    return result
+
+
+def transform_tiles(
+        tiles: np.ndarray,
+        transform: str,
+        rng: Optional[np.random.Generator] = None,
+        outline_color: Sequence[int] = (255, 255, 255),
+        background: Sequence[int] = (0, 0, 0),
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Apply one of `TRANSFORMS` to a batch of [N, H, W, C] uint8 tiles.
+
+    :return: tuple of the transformed tiles and the [N] hue shifts in degrees (0 except for "hue")
+    """
+    hue_shifts = np.zeros(len(tiles), dtype=np.float32)
+    if transform == "original":
+        result = tiles
+    elif transform == "flip_h":
+        result = tiles[:, :, ::-1]
+    elif transform == "flip_v":
+        result = tiles[:, ::-1]
+    elif transform in ("rot90", "rot180", "rot270"):
+        # counter-clockwise
+        result = np.rot90(tiles, int(transform[3:]) // 90, axes=(1, 2))
+    elif transform == "hue":
+        # shifts of less than 30 degrees are hard to tell apart in small pixel-art palettes
+        rng = rng or np.random.default_rng()
+        hue_shifts = rng.uniform(30, 330, size=len(tiles)).astype(np.float32)
+        result = shift_hue(tiles, hue_shifts)
+    elif transform == "outline":
+        result = outline_tiles(tiles, outline_color, background)
+    else:
+        raise ValueError(f"Unknown transform '{transform}', expected one of {', '.join(TRANSFORMS)}")
+
+    return np.ascontiguousarray(result), hue_shifts
+
+
+def iter_dataset_batches(
+        dataset: TileDataset,
+        batch_size: int,
+        indices: Optional[np.ndarray] = None,
+) -> Generator[Tuple[np.ndarray, np.ndarray], None, None]:
+    """
+    Yield (indices, tiles) of all or some tiles of a dataset view
+
+    :param indices: optional indices into the view, all tiles by default
+    :return: yields the indices of the tiles in the compiled dataset and the [N, H, W, C] uint8 tiles
+    """
+    if indices is None:
+        indices = np.arange(len(dataset))
+    for start in range(0, len(indices), batch_size):
+        batch_indices = indices[start:start + batch_size]
+        yield dataset.indices[batch_indices], dataset.get_batch(batch_indices)
+
+
+def iter_augmented(
+        batches: Iterable[Tuple[np.ndarray, np.ndarray]],
+        transforms: Sequence[str],
+        rng: Optional[np.random.Generator] = None,
+        outline_color: Sequence[int] = (255, 255, 255),
+        background: Sequence[int] = (0, 0, 0),
+) -> Generator[dict, None, None]:
+    """
+    Generator stage that applies each transform to each batch.
+    The command line only feeds it the tiles of a compiled dataset.
+
+    :param batches: iterable of (source indices, [N, H, W, C] uint8 tiles), see `iter_dataset_batches`
+    :param transforms: list of `TRANSFORMS`
+    :return: yields dicts with "source_indices", "transform", "tiles" and "hue_shifts"
+    """
+    for source_indices, tiles in batches:
+        for transform in transforms:
+            result, hue_shifts = transform_tiles(
+                tiles, transform, rng=rng, outline_color=outline_color, background=background,
+            )
+            yield {
+                "source_indices": source_indices,
+                "transform": transform,
+                "tiles": result,
+                "hue_shifts": hue_shifts,
+            }
+
+
+def write_shard(
+        dataset: TileDataset,
+        directory: Path,
+        shard: int,
+        source_indices: np.ndarray,
+        transforms: Sequence[str],
+        batch_size: int = 512,
+        seed: int = 0,
+        outline_color: Sequence[int] = (255, 255, 255),
+        background: Sequence[int] = (0, 0, 0),
+) -> dict:
+    """
+    Write the augmented tiles of some source tiles as a dataset that `TileDataset` can read.
+    `dataset` is the whole compiled dataset, the `source_indices` are its indices.
+
+    `tiles.csv` has the provenance columns `source_index`, `transform` and `hue_shift`,
+    followed by the columns of the source tile (`tile_id` is renamed to `source_tile_id`).
+
+    :return: dict with the shard's directory name and counts
+    """
+    name = f"shard-{shard:05d}"
+    os.makedirs(directory / name, exist_ok=True)
+    # each shard has its own random sequence, independent of the process that writes it
+    rng = np.random.default_rng([seed, shard])
+
+    count = len(source_indices) * len(transforms)
+    tiles = np.lib.format.open_memmap(
+        str(directory / name / "tiles.npy"), mode="w+", dtype=np.uint8, shape=(count, *dataset.shape),
+    )
+    source_columns = [c for c in dataset.columns if c != "index"]
+    index = 0
+    with (directory / name / "tiles.csv").open("wt") as fp:
+        writer = csv.writer(fp)
+        writer.writerow(
+            ["index", "source_index", "transform", "hue_shift"]
+            + ["source_tile_id" if c == "tile_id" else c for c in source_columns]
+        )
+        batches = iter_dataset_batches(dataset, batch_size, source_indices)
+        for item in iter_augmented(batches, transforms, rng, outline_color=outline_color, background=background):
+            tiles[index:index + len(item["tiles"])] = item["tiles"]
+            columns = [dataset.column(c)[item["source_indices"]].tolist() for c in source_columns]
+            rows = zip(item["source_indices"].tolist(), item["hue_shifts"], *columns)
+            for source_index, hue_shift, *values in rows:
+                writer.writerow([index, source_index, item["transform"], round(float(hue_shift), 1), *values])
+                index += 1
+    tiles.flush()
+    del tiles
+
+    (directory / name / "tiles.json").write_text(json.dumps({
+        **{key: dataset.info[key] for key in ("channels", "shape", "min_source_shape") if key in dataset.info},
+        "count": count,
+        "augmented": {
+            "source": str(dataset.path.resolve()),
+            "shard": shard,
+            "transforms": list(transforms),
+            "seed": seed,
+        },
+    }, indent=2))
+    return {"path": name, "count": count, "source_count": len(source_indices)}
+
+
+def augment_dataset(
+        dataset: TileDataset,
+        directory: Union[str, Path],
+        transforms: Sequence[str],
+        split: Optional[str] = None,
+        shard_size: int = 4096,
+        batch_size: int = 512,
+        workers: int = 1,
+        seed: int = 0,
+        outline_color: Sequence[int] = (255, 255, 255),
+        background: Sequence[int] = (0, 0, 0),
+) -> dict:
+    """
+    Write the augmented tiles of a dataset in shards of `shard_size` source tiles,
+    each shard in a worker process, and the `augment.json` manifest.
+
+    :return: dict, the manifest
+    """
+    for transform in transforms:
+        if transform not in TRANSFORMS:
+            raise ValueError(f"Unknown transform '{transform}', expected one of {', '.join(TRANSFORMS)}")
+
+    directory = Path(directory)
+    os.makedirs(directory, exist_ok=True)
+    source_indices = (dataset.split(split) if split else dataset).indices
+    tasks = [
+        (shard, source_indices[start:start + shard_size])
+        for shard, start in enumerate(range(0, len(source_indices), shard_size))
+    ]
+    shard_kwargs = {
+        "directory": directory, "transforms": list(transforms), "batch_size": batch_size, "seed": seed,
+        "outline_color": tuple(outline_color), "background": tuple(background),
+    }
+
+    shards = []
+    with tqdm(total=len(source_indices) * len(transforms), desc="augmenting") as progress:
+        if workers <= 1 or len(tasks) <= 1:
+            _init_worker(dataset.path)
+            results = (_write_shard_task(task, shard_kwargs) for task in tasks)
+            for result in results:
+                shards.append(result)
+                progress.update(result["count"])
+        else:
+            with multiprocessing.Pool(
+                    min(workers, len(tasks)), initializer=_init_worker, initargs=(dataset.path,),
+            ) as pool:
+                task_args = [(task, shard_kwargs) for task in tasks]
+                for result in pool.imap_unordered(_write_shard_task_star, task_args):
+                    shards.append(result)
+                    progress.update(result["count"])
+
+    manifest = {
+        "source": str(dataset.path.resolve()),
+        "split": split,
+        "transforms": list(transforms),
+        "seed": seed,
+        "source_count": len(source_indices),
+        "count": sum(s["count"] for s in shards),
+        "shards": sorted(shards, key=lambda s: s["path"]),
+    }
+    (directory / "augment.json").write_text(json.dumps(manifest, indent=2))
+    return manifest
+
+
+def _init_worker(path: Path):
+    global _worker_dataset
+    _worker_dataset = TileDataset(path)
+
+
+def _write_shard_task(task: Tuple[int, np.ndarray], kwargs: dict) -> dict:
+    shard, source_indices = task
+    return write_shard(_worker_dataset, shard=shard, source_indices=source_indices, **kwargs)
+
+
+def _write_shard_task_star(args: Tuple[Tuple[int, np.ndarray], dict]) -> dict:
+    return _write_shard_task(*args)
+
+
+def main():
+    args = parse_args()
+    dataset = TileDataset(args["dataset"])
+    transforms = [t.strip() for t in args["transforms"].split(",") if t.strip()]
+
+    start_time = time.time()
+    manifest = augment_dataset(
+        dataset,
+        args["output"],
+        transforms,
+        split=args["split"],
+        shard_size=args["shard_size"],
+        batch_size=args["batch_size"],
+        workers=args["workers"],
+        seed=args["seed"],
+        outline_color=parse_color(args["outline_color"]),
+        background=parse_color(args["background"]),
+    )
+    print(
+        f"wrote {manifest['count']:,} tiles of {manifest['source_count']:,} source tiles"
+        f" in {len(manifest['shards'])} shards to {args['output']} in {time.time() - start_time:.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+import json
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+import contextlib
+import itertools
+from pathlib import Path
+from functools import partial
+from typing import Optional, List, Callable
+
+import numpy as np
+import PIL.Image
+
+# bootstrap.config reads the data paths on import,
+#   so it must only be imported after the synthetic data is generated
+BENCHMARK_URL_PREFIX = "https://opengameart.org/content/benchmark-sheet-"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-c", "--count", type=int, default=10,
+        help="Number of synthetic sprite sheets",
+    )
+    parser.add_argument(
+        "-ss", "--sheet-size", type=int, default=512,
+        help="Width and height of each sprite sheet in pixels",
+    )
+    parser.add_argument(
+        "-ts", "--tile-size", type=int, default=16,
+        help="Width and height of the tiles in the sprite sheets",
+    )
+    parser.add_argument(
+        "-sp", "--spacing", type=int, default=1,
+        help="Spacing between tiles in the sprite sheets",
+    )
+    parser.add_argument(
+        "-ak", "--alpha-key-rate", type=float, default=.3,
+        help="Fraction of sprite sheets that use a color key instead of an alpha channel",
+    )
+    parser.add_argument(
+        "-dr", "--duplicate-rate", type=float, default=.2,
+        help="Probability that a tile is a copy of a previously generated tile",
+    )
+    parser.add_argument(
+        "-lr", "--label-rate", type=float, default=.5,
+        help="Fraction of tiles that get a label",
+    )
+    parser.add_argument(
+        "-s", "--size", type=int, default=16,
+        help="Size of compiled patches",
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=3,
+        help="Number of runs per benchmark, the fastest is reported",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=23,
+        help="Random seed of the generator",
+    )
+    parser.add_argument(
+        "-p", "--path", type=str, default=None,
+        help="Directory for the synthetic data, defaults to a temporary directory",
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, nargs="?", default=None,
+        help="Filename of the json results, otherwise they are printed",
+    )
+
+    return vars(parser.parse_args())
+
+
+def generate_tile(rng: np.random.Generator, size: int, num_colors: int = 6) -> np.ndarray:
+    """
+    Create a pixel-art-like RGBA tile of shape [H, W, 4]
+    with a small palette and a transparent border around a blob.
+    """
+    palette = rng.integers(0, 256, (num_colors, 3), dtype=np.uint8)
+    block = max(1, size // 8)
+    small = rng.integers(0, num_colors, (size // block + 1, size // block + 1))
+    indices = small.repeat(block, axis=0).repeat(block, axis=1)[:size, :size]
+
+    tile = np.empty((size, size, 4), dtype=np.uint8)
+    tile[..., :3] = palette[indices]
+
+    yx = np.mgrid[:size, :size] - (size - 1) / 2
+    radius = rng.uniform(.3, .8) * size
+    tile[..., 3] = np.where(np.hypot(*yx) <= radius, 255, 0)
+    return tile
+
+
+def generate_dataset(
+        path: Path,
+        count: int = 10,
+        sheet_size: int = 512,
+        tile_size: int = 16,
+        spacing: int = 1,
+        alpha_key_rate: float = .3,
+        duplicate_rate: float = .2,
+        label_rate: float = .5,
+        seed: int = 23,
+        labels: Optional[List[str]] = None,
+) -> dict:
+    """
+    Write synthetic sprite sheets below `path / "web-cache"` and
+    their tilings and labels below `path / "data"`.
+
+    Returns the environment variables that point the bootstrap config to the data.
+    """
+    rng = np.random.default_rng(seed)
+    if labels is None:
+        labels = ["wall", "floor", "water", "tree", "character", "item"]
+
+    webcache_path = path / "web-cache"
+    data_path = path / "data"
+    os.makedirs(data_path / "oga", exist_ok=True)
+
+    stride = tile_size + spacing
+    num_tiles = max(1, (sheet_size + spacing) // stride)
+    tile_pool = []
+    urls = []
+
+    for sheet_index in range(count):
+        name = f"benchmark-sheet-{sheet_index}"
+        url = f"{BENCHMARK_URL_PREFIX}{sheet_index}"
+        urls.append(url)
+
+        alpha_key = None
+        if rng.uniform() < alpha_key_rate:
+            alpha_key = [int(c) for c in rng.integers(0, 256, 3)]
+
+        sheet = np.zeros((sheet_size, sheet_size, 4), dtype=np.uint8)
+        if alpha_key is not None:
+            sheet[..., :3] = alpha_key
+            sheet[..., 3] = 255
+
+        tile_labels = {}
+        for y in range(num_tiles):
+            for x in range(num_tiles):
+                if tile_pool and rng.uniform() < duplicate_rate:
+                    tile = tile_pool[rng.integers(0, len(tile_pool))]
+                else:
+                    tile = generate_tile(rng, tile_size)
+                    tile_pool.append(tile)
+
+                target = sheet[y * stride: y * stride + tile_size, x * stride: x * stride + tile_size]
+                if alpha_key is None:
+                    target[:] = tile
+                else:
+                    mask = tile[..., 3] > 0
+                    target[mask, :3] = tile[mask, :3]
+
+                if rng.uniform() < label_rate:
+                    label = labels[rng.integers(0, len(labels))]
+                    tile_labels.setdefault(label, []).append([y, x])
+
+        folder = webcache_path / "oga" / name
+        os.makedirs(folder, exist_ok=True)
+        if alpha_key is None:
+            PIL.Image.fromarray(sheet, "RGBA").save(folder / "sheet.png")
+        else:
+            PIL.Image.fromarray(sheet[..., :3], "RGB").save(folder / "sheet.png")
+
+        image = {
+            "filename": "sheet.png",
+            "tilings": [{
+                "offset_x": 0,
+                "offset_y": 0,
+                "patch_size_x": tile_size,
+                "patch_size_y": tile_size,
+                "spacing_x": spacing,
+                "spacing_y": spacing,
+                "size_x": 0,
+                "size_y": 0,
+                "labels": tile_labels,
+            }],
+        }
+        if alpha_key is not None:
+            image["alpha"] = [alpha_key]
+
+        (data_path / "oga" / f"{name}.json").write_text(json.dumps({"url": url, "images": [image]}))
+
+    (data_path / "urls.txt").write_text("".join(f"{url}\n" for url in urls))
+    (data_path / "labels.json").write_text(json.dumps(
+        [{"name": label, "color": [128, 128, 128]} for label in labels], indent=2
+    ))
+
+    return {
+        "BOOTSTRAP_WEBCACHE_PATH": str(webcache_path),
+        "BOOTSTRAP_DATA_PATH": str(data_path),
+    }
+
+
+def time_function(func: Callable, repeat: int) -> float:
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def run_benchmarks(size: int, repeat: int, output_path: Path) -> dict:
+    """
+    Time the compile.py hot paths, the bootstrap config must point to the synthetic data.
+    """
+    from bootstrap.compile import iter_patches, SimilarityFilter, DatasetCompiler
+
+    os.makedirs(output_path, exist_ok=True)
+
+    compiler = DatasetCompiler(
+        size=size, duplicates=False, output=str(output_path),
+        min_size=0, max_patches=0, require_label=False,
+    )
+
+    patches = []
+
+    def _iter_patches():
+        patches.clear()
+        patches.extend(iter_patches(size=size))
+
+    def _similarity_filter(**kwargs):
+        sim_filter = SimilarityFilter(**kwargs)
+        # batched per image, like DatasetCompiler
+        for _, image_patches in itertools.groupby(patches, key=lambda p: (id(p["source"]), p["image_index"])):
+            sim_filter.filter_hashes(sim_filter.get_keys([p["patch"] for p in image_patches]))
+
+    def _analyze_patch():
+        for patch_data in patches:
+            compiler._analyze_patch(patch_data)
+
+    def _write_patches():
+        compiler._write_patches("tiles.png", [p["patch"] for p in patches])
+
+    results = {}
+    # keep stdout clean for the json results
+    with contextlib.redirect_stdout(sys.stderr):
+        for name, func in (
+                ("iter_patches", _iter_patches),
+                ("SimilarityFilter", _similarity_filter),
+                (
+                    "SimilarityFilter_transforms_palette",
+                    partial(_similarity_filter, transforms=True, palette=True),
+                ),
+                ("_analyze_patch", _analyze_patch),
+                ("_write_patches", _write_patches),
+        ):
+            seconds = time_function(func, repeat)
+            results[name] = {
+                "seconds": round(seconds, 6),
+                "items": len(patches),
+                "us_per_item": round(seconds / max(1, len(patches)) * 1_000_000, 3),
+            }
+            print(f"{name:36} {seconds:10.4f}s  {results[name]['us_per_item']:10.2f}us/patch", file=sys.stderr)
+
+    return results
+
+
+def get_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=Path(__file__).resolve().parent, stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args = parse_args()
+    output = args.pop("output")
+    path = args.pop("path")
+    size = args.pop("size")
+    repeat = args.pop("repeat")
+
+    with tempfile.TemporaryDirectory() as temp_path:
+        path = Path(path or temp_path).expanduser()
+
+        start = time.perf_counter()
+        os.environ.update(generate_dataset(path, **args))
+        print(f"generated data in {time.perf_counter() - start:.2f}s: {path}", file=sys.stderr)
+
+        results = {
+            "revision": get_revision(),
+            "parameters": {**args, "size": size, "repeat": repeat},
+            "timings": run_benchmarks(size=size, repeat=repeat, output_path=path / "output"),
+        }
+
+    results = json.dumps(results, indent=2)
+    if output:
+        Path(output).write_text(results)
+    else:
+        print(results)
+
+
+if __name__ == "__main__":
+    main()
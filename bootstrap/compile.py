@@ -1,22 +1,32 @@
 import json
-import math
 import os
-import sys
 import argparse
-import hashlib
-from io import BytesIO
+import itertools
+import collections
+import multiprocessing
 import csv
+import cProfile
+import pstats
 from pathlib import Path
-from typing import Generator, Tuple, Optional, List
-
-from PyQt5.QtCore import *
-from PyQt5.QtGui import *
+from functools import partial
+from typing import Generator, Tuple, Optional, List, Callable, Iterable, Dict, Sequence
 
 from tqdm import tqdm
 import numpy as np
 
-from bootstrap.app.sourcemodel import SourceModel
-from bootstrap.app.util import Tiling, get_qimage_from_source, get_image_bounding_rect, qimage_to_numpy
+from bootstrap.positions import encode_positions
+from bootstrap.emptytiles import find_empty_tiles
+from bootstrap.annotationdb import get_annotation_database
+from bootstrap.sources import scan_sources, read_image_size, TileGrid
+from bootstrap.images import (
+    Rect, load_image, has_alpha_channel, apply_alpha_colors, cut_tiles, scale_tiles, pixels_to_rgb, pixels_to_rgba,
+    write_mosaic, get_alpha_bounding_rect,
+)
+from bootstrap.hashing import HASH_NAME, hash_rows, canonical_hash_rows, digests_to_hex, hex_to_digests
+from bootstrap.pipeline import Pipeline
+from bootstrap.tilestore import TileStore
+from bootstrap.palette import ColorPalette, index_dtype
+from bootstrap.profiling import StageTimer
 from bootstrap import config
 
 
@@ -47,61 +57,463 @@ def parse_args():
         "-rl", "--require-label", type=bool, nargs="?", default=False, const=True,
         help="Only consider labeled patches",
     )
+    parser.add_argument(
+        "-sp", "--split", type=str, default=None,
+        help="Comma-separated percentages of the train, validation and (optional) test split, e.g. 80,10,10."
+             " Sources are not shared between splits and the labels are distributed evenly",
+    )
+    parser.add_argument(
+        "-ss", "--split-seed", type=int, default=0,
+        help="Random seed of the split assignment",
+    )
+    parser.add_argument(
+        "-u", "--update", type=bool, nargs="?", default=False, const=True,
+        help="Patch the existing dataset in the output directory: unchanged tiles keep their index"
+             " and only new and moved tiles are written to tiles.npy",
+    )
+    parser.add_argument(
+        "-ts", "--tile-store", type=str, default=config.BOOTSTRAP_TILE_STORE or None,
+        help="Directory of a tile store that is shared between datasets. Only tiles that are not"
+             " in the store are written and the dataset is just the tiles.csv/tiles.json manifest",
+    )
+    parser.add_argument(
+        "-ix", "--indexed", type=bool, nargs="?", default=False, const=True,
+        help="Keep the tiles as indices into a global color palette and write tiles.npy"
+             " as indices with the palette in palette.npz",
+    )
+    parser.add_argument(
+        "-de", "--drop-empty", type=bool, nargs="?", default=False, const=True,
+        help="Skip fully transparent and single-color tiles before hashing",
+    )
+    parser.add_argument(
+        "-dt", "--dedupe-transforms", type=bool, nargs="?", default=False, const=True,
+        help="Also treat rotated and flipped copies of a tile as duplicates",
+    )
+    parser.add_argument(
+        "-dp", "--dedupe-palette", type=bool, nargs="?", default=False, const=True,
+        help="Also treat copies of a tile with different colors as duplicates",
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=0,
+        help="Number of processes that decode the images, 0 decodes them in the pipeline",
+    )
+    parser.add_argument(
+        "-qs", "--queue-size", type=int, default=16,
+        help="Maximum number of items waiting between two pipeline stages",
+    )
+    parser.add_argument(
+        "-p", "--profile", type=bool, nargs="?", default=False, const=True,
+        help="Write a cProfile stats file and a json timing report next to the dataset output",
+    )
 
     return vars(parser.parse_args())
 
 
+SPLIT_NAMES = ("train", "validation", "test")
+
+
+def parse_split(split: str) -> List[float]:
+    """
+    "80,10,10" -> [.8, .1, .1]
+    """
+    values = [float(v) for v in split.split(",")]
+    if not 2 <= len(values) <= len(SPLIT_NAMES) or any(v < 0 for v in values) or not sum(values):
+        raise ValueError(f"Expected 2 or 3 positive split percentages, got '{split}'")
+    return [v / sum(values) for v in values]
+
+
+def read_tile_table(filename: Path) -> Optional[List[dict]]:
+    """
+    The rows of an existing tiles.csv or None
+    """
+    if not filename.exists():
+        return None
+    with filename.open("rt") as fp:
+        return list(csv.DictReader(fp))
+
+
+def get_delta(previous_rows: List[dict], rows: List[dict]) -> dict:
+    """
+    The changes between two tiles.csv tables, by "tile_id".
+
+    Returns a dict with lists of
+        "added": [tile_id, index]
+        "removed": [tile_id, previous index]
+        "relabeled": [tile_id, index, previous label, label]
+        "moved": [tile_id, previous index, index]
+    """
+    previous = {row["tile_id"]: row for row in previous_rows if row.get("tile_id")}
+    current = {row["tile_id"]: row for row in rows}
+
+    delta = {
+        "previous_count": len(previous_rows),
+        "count": len(rows),
+        "added": [],
+        "removed": [],
+        "relabeled": [],
+        "moved": [],
+    }
+    for tile_id, row in current.items():
+        previous_row = previous.get(tile_id)
+        if previous_row is None:
+            delta["added"].append([tile_id, int(row["index"])])
+            continue
+        if previous_row["label"] != str(row["label"]):
+            delta["relabeled"].append([tile_id, int(row["index"]), previous_row["label"], row["label"]])
+        if int(previous_row["index"]) != int(row["index"]):
+            delta["moved"].append([tile_id, int(previous_row["index"]), int(row["index"])])
+
+    for tile_id, previous_row in previous.items():
+        if tile_id not in current:
+            delta["removed"].append([tile_id, int(previous_row["index"])])
+
+    return delta
+
+
+def resize_npy(filename: Path, count: int) -> Optional[np.memmap]:
+    """
+    Change the number of rows of a .npy file in place and return it memory-mapped.
+
+    The file is truncated or extended with zeros. Returns None if the new
+    shape does not fit into the space of the existing header.
+    """
+    with open(filename, "r+b") as fp:
+        version = np.lib.format.read_magic(fp)
+        if version != (1, 0):
+            return None
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+        offset = fp.tell()
+        if fortran_order:
+            return None
+
+        shape = (count, *shape[1:])
+        header = repr({"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": shape})
+        # magic string, version and header length take 10 bytes, the header ends with a newline
+        space = offset - 10
+        if len(header) + 1 > space:
+            return None
+        fp.seek(10)
+        fp.write((header + " " * (space - len(header) - 1) + "\n").encode("latin1"))
+        fp.truncate(offset + count * int(np.prod(shape[1:])) * dtype.itemsize)
+
+    return np.memmap(filename, dtype=dtype, mode="r+", offset=offset, shape=shape)
+
+
 def iter_patches(
         size: int,
         # in order to determine all duplicates we need to include them here
         include_duplicates: bool = True,
+        tile_filter: Optional[Callable[[TileGrid, Rect, Tuple[int, int]], bool]] = None,
+        timer: Optional[StageTimer] = None,
+        drop_empty: bool = False,
+        workers: int = 0,
 ) -> Generator[dict, None, None]:
+    """
+    Yield all patches of all tilings of all sources.
+
+    :param size: int, width and height of the yielded patches
+    :param include_duplicates: bool, also yield tiles that are listed in duplicates.json
+    :param tile_filter: optional callable(tiling, rect, tile_pos) -> bool.
+        Tiles that are rejected are never cut or scaled and images
+        without any accepted tile are not decoded at all.
+    :param timer: optional StageTimer to collect the time of each processing step
+    :param drop_empty: bool, skip fully transparent and single-color tiles, see `find_empty_tiles`
+    :param workers: int, number of processes that decode the images, see `iter_tiled_images`
+    """
+    yield from iter_image_patches(
+        iter_tiled_images(
+            include_duplicates=include_duplicates, tile_filter=tile_filter, timer=timer, drop_empty=drop_empty,
+            workers=workers,
+        ),
+        size=size,
+        timer=timer,
+    )
 
-    patch_size = QSize(size, size)
-    model = SourceModel(None)
 
-    for i in range(model.rowCount()):
-        source = model.data(model.index(i, 0), Qt.ItemDataRole.UserRole)
+def iter_tiled_images(
+        include_duplicates: bool = True,
+        tile_filter: Optional[Callable[[TileGrid, Rect, Tuple[int, int]], bool]] = None,
+        timer: Optional[StageTimer] = None,
+        drop_empty: bool = False,
+        workers: int = 0,
+) -> Generator[dict, None, None]:
+    """
+    Decode stage of `iter_patches`.
+
+    Yields each source image that has at least one accepted tile,
+    together with the accepted tiles of all its tilings, in `tile_order_key` order,
+    which decides which of equal tiles is kept.
+    With `drop_empty`, the empty tiles are removed after decoding
+    and their number is stored in "num_empty".
+    With `workers`, the images are decoded by that many processes, in the same order.
+    """
+    if timer is None:
+        timer = StageTimer()
+
+    images = _iter_accepted_tiles(include_duplicates=include_duplicates, tile_filter=tile_filter)
+
+    for image_item, decoded in _iter_decoded_images(images, drop_empty=drop_empty, workers=workers):
+        for name, (calls, wall_time, cpu_time) in decoded["stages"].items():
+            timer.add(name, wall_time, cpu_time, source=image_item["source"]["url"])
+
+        tilings = image_item["tilings"]
+        num_empty = 0
+        if drop_empty:
+            for i, ((tiling_index, tiling, tiles), empty) in enumerate(zip(tilings, decoded["empty"])):
+                tilings[i] = (tiling_index, tiling, [t for t in tiles if t[1] not in empty])
+                num_empty += len(tiles) - len(tilings[i][2])
+            tilings = [t for t in tilings if t[2]]
+            if not tilings:
+                continue
+
+        yield {
+            **image_item,
+            "image": decoded["pixels"],
+            "fill": decoded["fill"],
+            "tilings": tilings,
+            "num_empty": num_empty,
+        }
+
+
+def decode_image(
+        filename: str,
+        alpha_colors: Optional[List[List[int]]] = None,
+        empty_tilings: Sequence[dict] = (),
+) -> dict:
+    """
+    Decode an image file and find the empty tiles of `empty_tilings`, see `find_empty_tiles`.
+
+    Returns a dict with the [H, W] uint32 "pixels", the "fill" value of the pixels outside
+    of the image, the "empty" tile positions of each tiling and the "stages" of a `StageTimer`.
+    It does not need Qt, so it can run in any process.
+    """
+    timer = StageTimer()
+    with timer.measure("decode"):
+        pixels = load_image(filename)
+        # tiles that reach outside of the image are filled with transparent pixels, or opaque black without alpha
+        fill = 0 if alpha_colors or has_alpha_channel(filename) else 0xff000000
+
+    if alpha_colors:
+        with timer.measure("alpha_key"):
+            pixels = apply_alpha_colors(pixels, alpha_colors)
+
+    empty = []
+    if empty_tilings:
+        with timer.measure("empty_tiles"):
+            rgba = pixels_to_rgba(pixels).transpose(2, 0, 1)
+            empty = [find_empty_tiles(rgba, tiling) for tiling in empty_tilings]
+
+    return {"pixels": pixels, "fill": fill, "empty": empty, "stages": timer.stages}
+
+
+def _iter_accepted_tiles(
+        include_duplicates: bool,
+        tile_filter: Optional[Callable[[TileGrid, Rect, Tuple[int, int]], bool]],
+) -> Generator[dict, None, None]:
+    """
+    Yield the images with accepted tiles, the tiles are calculated from the image size
+    in the file header, so nothing is decoded here
+    """
+    for source in scan_sources():
         for image_index, image_data in enumerate(source["images"]):
-            image = get_qimage_from_source(image_data)
+            if not image_data["tilings"]:
+                continue
+
+            image_size = read_image_size(image_data["filename"])
+            if image_size is None:
+                continue
+
+            tilings = []
             for tiling_index, tiling in enumerate(image_data["tilings"]):
-                tiling = Tiling(image.size(), tiling)
+                tiling = TileGrid(image_size, tiling)
 
                 if include_duplicates:
                     tiling.duplicate_tiles.clear()
 
-                for rect, tile_pos in tiling.iter_rects(yield_pos=True):
-                    patch = image.copy(rect).scaled(patch_size)
-                    yield {
-                        "source": source,
-                        "image_index": image_index,
-                        "tiling_index": tiling_index,
-                        "tile_pos": tile_pos,
-                        "rect": rect,
-                        "image": image,
-                        "image_data": image_data,
-                        "tiling": tiling,
-                        "patch": patch,
-                    }
+                tiles = [
+                    (rect, tile_pos)
+                    for rect, tile_pos in tiling.iter_rects()
+                    if tile_filter is None or tile_filter(tiling, rect, tile_pos)
+                ]
+                if tiles:
+                    tilings.append((tiling_index, tiling, tiles))
+
+            if tilings:
+                yield {
+                    "source": source,
+                    "image_index": image_index,
+                    "image_data": image_data,
+                    "tilings": tilings,
+                }
+
+
+def _iter_decoded_images(
+        images: Iterable[dict],
+        drop_empty: bool,
+        workers: int,
+) -> Generator[Tuple[dict, dict], None, None]:
+    """
+    Yield each image item of `_iter_accepted_tiles` with its `decode_image` result, in order
+    """
+    def _get_args(image_item: dict) -> tuple:
+        image_data = image_item["image_data"]
+        empty_tilings = []
+        if drop_empty:
+            empty_tilings = [image_data["tilings"][tiling_index] for tiling_index, _, _ in image_item["tilings"]]
+        return image_data["filename"], image_data.get("alpha"), empty_tilings
+
+    if not workers:
+        for image_item in images:
+            yield image_item, decode_image(*_get_args(image_item))
+        return
+
+    # the pool is started from a pipeline thread, which is not safe to fork
+    with multiprocessing.get_context("spawn").Pool(workers) as pool:
+        # only a few images are decoded ahead, so the pixels do not pile up
+        pending = collections.deque()
+        for image_item in images:
+            pending.append((image_item, pool.apply_async(decode_image, _get_args(image_item))))
+            if len(pending) > 2 * workers:
+                image_item, result = pending.popleft()
+                yield image_item, result.get()
+
+        while pending:
+            image_item, result = pending.popleft()
+            yield image_item, result.get()
+
+
+def iter_image_patches(
+        images: Iterable[dict],
+        size: int,
+        timer: Optional[StageTimer] = None,
+) -> Generator[dict, None, None]:
+    """
+    Extract stage of `iter_patches`.
+
+    Cuts and scales the accepted tiles of the images from `iter_tiled_images`,
+    all tiles of a tiling with the same rect size in one step.
+    Each "patch" is a [size, size] array of 32-bit ARGB pixels.
+    """
+    if timer is None:
+        timer = StageTimer()
+
+    for image_item in images:
+        url = image_item["source"]["url"]
+        for tiling_index, tiling, tiles in image_item["tilings"]:
+            patches = np.empty((len(tiles), size, size), dtype=image_item["image"].dtype)
+            rects_by_size = collections.defaultdict(list)
+            for index, (rect, _) in enumerate(tiles):
+                rects_by_size[tuple(rect[2:])].append(index)
+            for rect_size, indices in rects_by_size.items():
+                with timer.measure("cut", source=url):
+                    cut = cut_tiles(
+                        image_item["image"], [tiles[i][0] for i in indices], rect_size, fill=image_item["fill"],
+                    )
+                with timer.measure("scale", source=url):
+                    patches[indices] = scale_tiles(cut, (size, size))
+            for (rect, tile_pos), patch in zip(tiles, patches):
+                yield {
+                    "source": image_item["source"],
+                    "image_index": image_item["image_index"],
+                    "tiling_index": tiling_index,
+                    "tile_pos": tile_pos,
+                    "rect": rect,
+                    "image_data": image_item["image_data"],
+                    "tiling": tiling,
+                    "patch": patch,
+                }
+
+
+def _rect_contains(rect: Rect, other: Rect) -> bool:
+    """
+    `QRect.contains` for (x, y, width, height) rects, a rect without area contains nothing
+    """
+    x, y, width, height = rect
+    other_x, other_y, other_width, other_height = other
+    if not (width or height) or not (other_width or other_height):
+        return False
+    return (
+        x <= other_x and other_x + other_width <= x + width
+        and y <= other_y and other_y + other_height <= y + height
+    )
 
 
 class SimilarityFilter:
+    """
+    Duplicate filter on the `hash_rows` digests of the patch pixels.
+
+    The digests of all seen patches are kept in numpy arrays, 16 bytes per patch:
+    a sorted array for lookups and the recent digests, which are merged
+    into the sorted array once they make up a sixteenth of it.
 
-    def __init__(self, type: str = "exact"):
+    With `transforms` or `palette`, the filter compares the `canonical_hash_rows`
+    of the patches, so rotated, flipped or recolored copies are duplicates as well.
+    """
+    def __init__(self, type: str = "exact", transforms: bool = False, palette: bool = False):
+        if type != "exact":
+            raise ValueError(f"Invalid type `{type}`")
         self.type = type
-        self.hash_set = set()
+        self.transforms = transforms
+        self.palette = palette
+        self._digests = np.zeros(0, dtype="V16")
+        self._recent = np.zeros(0, dtype="V16")
 
-    def is_similar(self, patch: QImage) -> bool:
-        if self.type == "exact":
-            data = patch.bits().asarray(size=patch.byteCount())
-            hash = hashlib.md5(data).hexdigest()
-            similar = hash in self.hash_set
-            if not similar:
-                self.hash_set.add(hash)
-            return similar
+    def __len__(self):
+        return len(self._digests) + len(self._recent)
 
-        else:
-            raise ValueError(f"Invalid type `{self.type}`")
+    def get_hashes(self, patches: Sequence[np.ndarray]) -> np.ndarray:
+        """
+        Digests of [H, W] uint32 patches of equal size as [N] array of dtype "V16"
+        """
+        if not len(patches):
+            return np.zeros(0, dtype="V16")
+        return hash_rows(np.stack(patches))
+
+    def get_keys(self, patches: Sequence[np.ndarray], digests: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        The digests that `filter_hashes` compares, equal to `get_hashes`
+        unless the filter includes transforms or palette changes.
+        """
+        if not (self.transforms or self.palette):
+            return self.get_hashes(patches) if digests is None else digests
+        if not len(patches):
+            return np.zeros(0, dtype="V16")
+        return canonical_hash_rows(np.stack(patches), transforms=self.transforms, palette=self.palette)
+
+    def get_hash(self, patch: np.ndarray) -> str:
+        return digests_to_hex(self.get_hashes([patch]))[0]
+
+    def filter_hashes(self, digests: np.ndarray) -> np.ndarray:
+        """
+        Boolean array, True for each digest that was seen before,
+        including earlier in the same batch. All digests are added to the filter.
+        """
+        unique, first = np.unique(digests, return_index=True)
+        is_known = self._contains(unique)
+        is_similar = np.ones(len(digests), dtype=bool)
+        is_similar[first[~is_known]] = False
+
+        self._recent = np.concatenate([self._recent, unique[~is_known]])
+        if len(self._recent) > max(1024, len(self._digests) // 16):
+            self._digests = np.sort(np.concatenate([self._digests, self._recent]))
+            self._recent = self._recent[:0]
+        return is_similar
+
+    def is_similar(self, patch: np.ndarray, key: Optional[str] = None) -> bool:
+        """
+        :param key: optional hex digest of `get_keys([patch])`
+        """
+        keys = self.get_keys([patch]) if key is None else hex_to_digests([key])
+        return bool(self.filter_hashes(keys)[0])
+
+    def _contains(self, digests: np.ndarray) -> np.ndarray:
+        found = np.zeros(len(digests), dtype=bool)
+        if len(self._digests):
+            positions = np.minimum(np.searchsorted(self._digests, digests), len(self._digests) - 1)
+            found = self._digests[positions] == digests
+        if len(self._recent):
+            found |= np.isin(digests, self._recent)
+        return found
 
 
 class DatasetCompiler:
@@ -114,6 +526,17 @@ class DatasetCompiler:
             min_size: int,
             max_patches: int,
             require_label: bool,
+            drop_empty: bool = False,
+            dedupe_transforms: bool = False,
+            dedupe_palette: bool = False,
+            split: Optional[str] = None,
+            split_seed: int = 0,
+            update: bool = False,
+            tile_store: Optional[str] = None,
+            indexed: bool = False,
+            workers: int = 0,
+            queue_size: int = 16,
+            profile: bool = False,
     ):
         self.size = size
         self.do_write_duplicates = duplicates
@@ -121,61 +544,202 @@ class DatasetCompiler:
         self.filter_min_size = min_size
         self.max_patches = max_patches
         self.filter_label = require_label
+        self.filter_empty = drop_empty
+        self.split_fractions = parse_split(split) if split else None
+        self.split_seed = split_seed
+        self.do_update = update
+        self.tile_store = None if not tile_store else TileStore(tile_store)
+        self.do_index = indexed
+        self.palette = ColorPalette()
+        # [C, 3] colors of the palette drawn on black, set after all patches are indexed
+        self.palette_rgb: Optional[np.ndarray] = None
+        self.workers = workers
+        self.queue_size = queue_size
+        self.do_profile = profile
 
         self.patches: List[dict] = []
         self.num_duplicates = 0
         self.duplicates_map = {}
         self.num_skipped = 0
-        self.sim_filter = SimilarityFilter()
+        self.num_empty = 0
+        self.sim_filter = SimilarityFilter(transforms=dedupe_transforms, palette=dedupe_palette)
+        self.rows: List[dict] = []
         self.label_stats = {}
         self.source_stats = {}
+        self.source_ids = {}
+        # the tiles.csv rows of the existing dataset in the output directory
+        self.previous_rows: Optional[List[dict]] = None
+        self.pipeline: Optional[Pipeline] = None
+        self.timer = StageTimer()
 
     def compile(self):
-        self._get_patches()
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self.previous_rows = read_tile_table(self.directory / "tiles.csv")
+            if self.previous_rows is not None and self._previous_info().get("tile_id_hash") != HASH_NAME:
+                print("the existing output has tile ids of a different hash, it is not compared or updated")
+                self.previous_rows = None
+            if self.do_update and self.tile_store is not None:
+                print("only new tiles are written to the tile store, --update is not needed")
+                self.do_update = False
+            if self.do_update and self.do_index:
+                print("indexed output is always written completely")
+                self.do_update = False
+            if self.do_update and not self._can_update():
+                print("the existing output can not be updated, writing all tiles")
+                self.do_update = False
+            if not self.do_update:
+                print(f"writing table: {self.directory / 'tiles.csv'}")
+
+        profile = None
+        if self.do_profile:
+            profile = cProfile.Profile()
+            profile.enable()
+
+        try:
+            self._get_patches()
+        finally:
+            if not self.patches:
+                self._remove_partial_table()
+        if self.do_index and len(self.palette):
+            self.palette_rgb = pixels_to_rgb(self.palette.colors)
 
         print(f"duplicates: {self.num_duplicates:,}")
         print(f"skipped:    {self.num_skipped:,}")
+        if self.filter_empty:
+            print(f"empty:      {self.num_empty:,}")
         print(f"patches:    {len(self.patches):,}")
+        self.pipeline.print_stats()
+        self.timer.print_report()
 
-        if self.do_write_duplicates:
+        if self.do_write_duplicates and get_annotation_database() is not None:
+            print(f"writing duplicates: {config.BOOTSTRAP_ANNOTATION_DB}")
+            get_annotation_database().set_duplicates_map(self.duplicates_map)
+
+        elif self.do_write_duplicates:
             filename = config.BOOTSTRAP_DATA_PATH / "duplicates.json"
             print(f"writing duplicates: {filename}")
-            filename.write_text(json.dumps(self.duplicates_map))
+            duplicates_map = self.duplicates_map
+            if config.BOOTSTRAP_COMPACT_POSITIONS:
+                duplicates_map = {
+                    url: {
+                        filename: {
+                            tiling_index: encode_positions(positions)
+                            for tiling_index, positions in tilings.items()
+                        }
+                        for filename, tilings in images.items()
+                    }
+                    for url, images in self.duplicates_map.items()
+                }
+            filename.write_text(json.dumps(duplicates_map))
 
-        if self.directory:
-            os.makedirs(self.directory, exist_ok=True)
+        if self.directory and not self.patches:
+            print("no patches, the output is not changed")
 
-            self._write_patches("tiles.png", [p["patch"] for p in self.patches])
+        if self.directory and self.patches:
+            try:
+                if self.tile_store is not None:
+                    self._store_tiles()
+                elif self.do_update:
+                    self._update_output()
+                elif self.do_index:
+                    self._write_indexed()
+                else:
+                    # the mosaic layout depends on the final number of patches
+                    self._write_patches("tiles.png", [p["patch"] for p in self.patches])
+            except BaseException:
+                self._remove_partial_table()
+                raise
 
-            rows, statistics = self._get_rows_and_statistics(self.patches)
+            if not self.do_update:
+                # the streamed table replaces the previous one together with the tiles
+                (self.directory / "tiles.csv.tmp").replace(self.directory / "tiles.csv")
 
-            filename = (self.directory / "tiles.json")
-            print(f"writing info: {filename}")
-            filename.write_text(json.dumps({
+            if self.previous_rows is not None:
+                delta = get_delta(self.previous_rows, self.rows)
+                filename = self.directory / "delta.json"
+                print(
+                    f"writing delta: {filename}, added {len(delta['added']):,}, removed {len(delta['removed']):,}"
+                    f", relabeled {len(delta['relabeled']):,}, moved {len(delta['moved']):,}"
+                )
+                filename.write_text(json.dumps(delta))
+
+            info = {
                 "count": len(self.patches),
                 "channels": 3,
                 "shape": (self.size, self.size),
                 "min_source_shape": (self.filter_min_size, self.filter_min_size),
-                "info": statistics,
-            }, indent=2))
+                "tile_id_hash": HASH_NAME,
+                "dedupe": {"transforms": self.sim_filter.transforms, "palette": self.sim_filter.palette},
+                "info": self._get_statistics(),
+            }
+            if self.tile_store is not None:
+                info["tile_store"] = str(self.tile_store.path.resolve())
+            elif self.do_index:
+                info["indexed"] = True
+                info["palette"] = {"filename": "palette.npz", "colors": len(self.palette)}
 
-            filename = self.directory / "tiles.csv"
-            print(f"writing table: {filename}")
-            with filename.open("wt") as fp:
-                writer = csv.DictWriter(fp, list(rows[0].keys()))
-                writer.writeheader()
-                writer.writerows(rows)
+            if self.split_fractions:
+                splits = self._get_splits()
+                filename = self.directory / "splits.npz"
+                print(f"writing splits: {filename}")
+                np.savez(str(filename), **splits)
+                info["splits"] = self._get_split_statistics(splits)
+            elif (self.directory / "splits.npz").exists():
+                # the splits of a previous compile do not match the new rows
+                print(f"removing {self.directory / 'splits.npz'}")
+                (self.directory / "splits.npz").unlink()
+
+            filename = (self.directory / "tiles.json")
+            print(f"writing info: {filename}")
+            filename.write_text(json.dumps(info, indent=2))
+
+        if profile is not None:
+            profile.disable()
+            self._write_profile(profile)
 
     def _get_patches(self):
-        for patch_data in tqdm(iter_patches(size=self.size)):
+        """
+        Runs the decode -> extract -> dedupe (-> index) -> write pipeline,
+        each stage in its own thread.
+        """
+        # When writing the duplicates map, every tile needs to pass the similarity filter,
+        #   otherwise the filters can reject tiles before they are cut, scaled and hashed
+        pre_filter = not self.do_write_duplicates
+
+        self.pipeline = (
+            Pipeline(queue_size=self.queue_size, profile=self.do_profile)
+            .add_stage("decode", partial(self._iter_tiled_images, pre_filtered=pre_filter))
+            .add_stage("extract", partial(iter_image_patches, size=self.size, timer=self.timer))
+            .add_stage("dedupe", partial(self._iter_unique_patches, pre_filtered=pre_filter))
+        )
+        if self.do_index:
+            self.pipeline.add_stage("index", self._iter_indexed_patches)
+        self.pipeline.add_stage("write", self._iter_written_rows)
+
+        for patch_data in tqdm(self.pipeline):
+            self.patches.append(patch_data)
+
+    def _iter_tiled_images(self, pre_filtered: bool) -> Generator[dict, None, None]:
+        for image_item in iter_tiled_images(
+                tile_filter=self._accept_tile if pre_filtered else None,
+                timer=self.timer,
+                drop_empty=self.filter_empty,
+                workers=self.workers,
+        ):
+            self.num_empty += image_item["num_empty"]
+            yield image_item
+
+    def _iter_unique_patches(self, patches: Iterable[dict], pre_filtered: bool) -> Generator[dict, None, None]:
+        num_patches = 0
+        for patch_data, is_similar in self._iter_hashed_patches(patches):
             source = patch_data["source"]
             image_data = patch_data["image_data"]
             tiling_index = patch_data["tiling_index"]
             tile_pos = patch_data["tile_pos"]
             tiling = patch_data["tiling"]
-            patch: QImage = patch_data["patch"]
 
-            if self.sim_filter.is_similar(patch):
+            if is_similar:
                 self.num_duplicates += 1
 
                 # store in global duplicate map
@@ -189,131 +753,412 @@ class DatasetCompiler:
                 self.duplicates_map[source["url"]][filename][str(tiling_index)].append(tile_pos)
                 continue
 
-            # -- filter by min-size --
-            source_size = patch_data["rect"]
-            if any(s < self.filter_min_size for s in (source_size.width(), source_size.height())):
-                self.num_skipped += 1
+            if not pre_filtered and not self._accept_tile(tiling, patch_data["rect"], tile_pos):
                 continue
 
-            # -- filter by label --
             label = patch_data["label"] = self._get_single_label(tiling.get_labels_at(*tile_pos))
 
-            if self.filter_label and label == "undefined":
-                self.num_skipped += 1
-                continue
-
             # -- add meta info --
 
-            patch_data["row_data"] = self._analyze_patch(patch_data)
+            with self.timer.measure("analyze", source=source["url"]):
+                patch_data["row_data"] = self._analyze_patch(patch_data)
 
-            self.patches.append(patch_data)
+            yield patch_data
+
+            # returning ends the pipeline, so no further source is decoded
+            num_patches += 1
+            if self.max_patches and num_patches >= self.max_patches:
+                return
+
+    def _iter_hashed_patches(self, patches: Iterable[dict]) -> Generator[Tuple[dict, bool], None, None]:
+        """
+        Hash the patches of each image in one batch,
+        yields each patch with the "hash" set and whether it is a duplicate
+        """
+        for _, image_patches in itertools.groupby(patches, key=lambda p: (id(p["source"]), p["image_index"])):
+            image_patches = list(image_patches)
+            with self.timer.measure("hash", source=image_patches[0]["source"]["url"]):
+                patches = [p["patch"] for p in image_patches]
+                digests = self.sim_filter.get_hashes(patches)
+                keys = self.sim_filter.get_keys(patches, digests)
+                is_similar = self.sim_filter.filter_hashes(keys)
+            for patch_data, hash, similar in zip(image_patches, digests_to_hex(digests), is_similar):
+                patch_data["hash"] = hash
+                yield patch_data, bool(similar)
+
+    def _iter_indexed_patches(self, patches: Iterable[dict]) -> Generator[dict, None, None]:
+        """
+        Replace the patches of each image by their "indices" into the palette.
+
+        The pixels of the patch are dropped, so only the indices
+        of the tiles are kept until the output is written.
+        """
+        for _, image_patches in itertools.groupby(patches, key=lambda p: (id(p["source"]), p["image_index"])):
+            image_patches = list(image_patches)
+            with self.timer.measure("index", source=image_patches[0]["source"]["url"]):
+                pixels = np.stack([p["patch"] for p in image_patches])
+                indices = self.palette.index(pixels)
+            for patch_data, patch_indices in zip(image_patches, indices):
+                patch_data["indices"] = patch_indices
+                del patch_data["patch"]
+                yield patch_data
+
+    def _iter_written_rows(self, patches: Iterable[dict]) -> Generator[dict, None, None]:
+        if not self.directory:
+            yield from patches
+            return
+
+        if self.do_update:
+            # the final indices are known after all patches, see _update_output
+            for patch_data in patches:
+                self._add_row(patch_data)
+                yield patch_data
+            return
+
+        # streamed into a temporary file, the existing tiles.csv is only replaced
+        #   after all tiles are written, see compile()
+        filename = self.directory / "tiles.csv.tmp"
+        try:
+            with filename.open("wt") as fp:
+                writer = None
+                for patch_data in patches:
+                    row = self._add_row(patch_data)
+                    if writer is None:
+                        writer = csv.DictWriter(fp, list(row.keys()))
+                        writer.writeheader()
+                    writer.writerow(row)
+                    yield patch_data
+        except BaseException:
+            self._remove_partial_table()
+            raise
+
+    def _remove_partial_table(self):
+        if self.directory:
+            (self.directory / "tiles.csv.tmp").unlink(missing_ok=True)
+
+    def _accept_tile(self, tiling: TileGrid, rect: Rect, tile_pos: Tuple[int, int]) -> bool:
+        # -- filter by min-size --
+        if any(s < self.filter_min_size for s in rect[2:]):
+            self.num_skipped += 1
+            return False
+
+        # -- filter by label --
+        if self.filter_label and not tiling.get_labels_at(*tile_pos):
+            self.num_skipped += 1
+            return False
 
-            if self.max_patches and len(self.patches) >= self.max_patches:
-                break
+        return True
 
     def _get_single_label(self, labels: List[str]):
         return "/".join(sorted(labels)) or "undefined"
 
     def _analyze_patch(self, patch_data: dict) -> dict:
-        patch_rect: QRect = patch_data["patch"].rect()
-        patch = qimage_to_numpy(patch_data["patch"])
+        patch = patch_data["patch"]
+        patch_rect = (0, 0, patch.shape[1], patch.shape[0])
+        alpha = (patch >> np.uint32(24)).astype(np.uint8)
 
-        has_alpha = np.any(patch[3] < 255)
+        has_alpha = np.any(alpha < 255)
 
         # alpha bounding rect
         if not has_alpha:
             b_rect = patch_rect
             is_alpha_inset = False
         else:
-            b_rect = get_image_bounding_rect(patch[3])
-            is_alpha_inset = not b_rect.contains(patch_rect)
+            b_rect = get_alpha_bounding_rect(alpha)
+            is_alpha_inset = not _rect_contains(b_rect, patch_rect)
 
-        def _area(rect: QRect):
-            return rect.width() * rect.height()
+        # right and bottom are inclusive, like in QRect
+        left, top, width, height = b_rect
+        right, bottom = left + width - 1, top + height - 1
 
-        if b_rect.bottom() > patch_rect.bottom() or b_rect.right() > patch_rect.right():
+        if bottom > patch_rect[3] - 1 or right > patch_rect[2] - 1:
             raise ValueError(f"Messed up alpha-bounding-box in {patch_data}")
 
         return {
             "has_alpha": 1 if has_alpha else 0,
             "is_alpha_inset": 1 if is_alpha_inset else 0,
-            "alpha_bb_left": b_rect.left(),
-            "alpha_bb_top": b_rect.top(),
-            "alpha_bb_right": b_rect.right(),
-            "alpha_bb_bottom": b_rect.bottom(),
-            "opaque_area_ratio": _area(b_rect) / _area(patch_rect),
+            "alpha_bb_left": left,
+            "alpha_bb_top": top,
+            "alpha_bb_right": right,
+            "alpha_bb_bottom": bottom,
+            "opaque_area_ratio": (width * height) / (patch_rect[2] * patch_rect[3]),
         }
 
-    def _get_rows_and_statistics(self, patches: List[dict]):
-        rows = []
-        label_stats = dict()
-        source_stats = dict()
-        source_ids = dict()
+    def _add_row(self, patch: dict) -> dict:
+        url = patch["source"]["url"]
+        label = patch["label"]
 
-        for idx, patch in enumerate(patches):
-            source = patch["source"]
-            url = source["url"]
-            label = patch["label"]
+        if url not in self.source_ids:
+            self.source_ids[url] = len(self.source_ids) + 1
 
-            if url not in source_ids:
-                source_ids[url] = len(source_ids) + 1
+        self.label_stats[label] = self.label_stats.get(label, 0) + 1
+        self.source_stats[url] = self.source_stats.get(url, 0) + 1
 
-            label_stats[label] = label_stats.get(label, 0) + 1
-            source_stats[url] = source_stats.get(url, 0) + 1
-
-            rows.append({
-                "index": idx,
-                "source_id": source_ids[url],
-                "label": patch["label"],
-                **(patch.get("row_data") or {}),
-            })
+        image_filename = Path(patch["image_data"]["filename"]).relative_to(config.BOOTSTRAP_WEBCACHE_PATH)
+        row = {
+            "index": len(self.rows),
+            # the content hash, unique within the dataset because duplicates are removed
+            "tile_id": patch["hash"],
+            "source_id": self.source_ids[url],
+            "label": label,
+            **(patch.get("row_data") or {}),
+            "position": f"{image_filename}:{patch['tiling_index']}:{patch['tile_pos'][0]}:{patch['tile_pos'][1]}",
+        }
+        self.rows.append(row)
+        return row
 
+    def _get_statistics(self) -> dict:
         def _sort_stats(stats):
             return {
                 key: stats[key]
                 for key in sorted(stats, key=lambda k: stats[k], reverse=True)
             }
 
-        statistics = {
+        return {
             "distribution": {
-                "label": _sort_stats(label_stats),
-                "source": _sort_stats(source_stats),
+                "label": _sort_stats(self.label_stats),
+                "source": _sort_stats(self.source_stats),
             },
             "source_id_mapping": {
-                str(source_ids[key]): key
-                for key in sorted(source_ids, key=lambda k: source_ids[k])
+                str(self.source_ids[key]): key
+                for key in sorted(self.source_ids, key=lambda k: self.source_ids[k])
             },
         }
-        return rows, statistics
 
-    def _write_patches(self, name: str, patches: List[QImage]):
-        size = patches[0].width()
-        width = int(math.ceil(math.sqrt(len(patches))))
+    def _previous_info(self) -> dict:
+        try:
+            return json.loads((self.directory / "tiles.json").read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _can_update(self) -> bool:
+        if not self.previous_rows or "tile_id" not in self.previous_rows[0]:
+            return False
+        info = self._previous_info()
+        try:
+            tiles = np.load(str(self.directory / "tiles.npy"), mmap_mode="r")
+        except (OSError, ValueError):
+            return False
+        return (
+            list(info.get("shape", [])) == [self.size, self.size]
+            and tiles.shape == (len(self.previous_rows), self.size, self.size, 3)
+        )
+
+    def _update_output(self):
+        """
+        Re-index the rows so that unchanged tiles keep their previous index.
+
+        New tiles take the slots of removed tiles first and are appended otherwise.
+        If more tiles were removed than added, the tiles at the end are moved into the holes.
+        Only the new and moved tiles are written to tiles.npy.
+        """
+        previous_index = {row["tile_id"]: int(row["index"]) for row in self.previous_rows}
+        num_previous = len(self.previous_rows)
+        num_tiles = len(self.rows)
+
+        indices = np.array([previous_index.get(row["tile_id"], -1) for row in self.rows])
+        is_new = indices < 0
+        free_slots = np.setdiff1d(np.arange(num_previous), indices[~is_new])
+        num_new = int(is_new.sum())
+        indices[is_new] = np.concatenate([
+            free_slots[:num_new], np.arange(num_previous, num_previous + max(0, num_new - len(free_slots))),
+        ])[:num_new]
+
+        holes = free_slots[num_new:]
+        holes = holes[holes < num_tiles]
+        movers = np.nonzero(indices >= num_tiles)[0]
+        movers = movers[np.argsort(indices[movers])]
+        indices[movers] = holes
+
+        is_written = is_new.copy()
+        is_written[movers] = True
+
+        order = np.argsort(indices)
+        self.rows = [self.rows[i] for i in order]
+        self.patches = [self.patches[i] for i in order]
+        for index, row in enumerate(self.rows):
+            row["index"] = index
+        is_written = is_written[order]
+
+        filename = self.directory / "tiles.npy"
+        print(f"updating tiles: {filename}, writing {int(is_written.sum()):,} of {num_tiles:,} tiles")
+        tiles = resize_npy(filename, num_tiles)
+        if tiles is None:
+            tiles = np.load(str(filename))
+            tiles = np.concatenate([tiles, np.zeros((max(0, num_tiles - len(tiles)), *tiles.shape[1:]), np.uint8)])
+            tiles = tiles[:num_tiles]
+            is_written[:] = True
+        for index in np.nonzero(is_written)[0]:
+            tiles[index] = self._get_tile_rgb(index)
+        if isinstance(tiles, np.memmap):
+            tiles.flush()
+        else:
+            np.save(str(filename), tiles)
+
+        filename = self.directory / "tiles.png"
+        print(f"writing tiles: {filename}")
+        write_mosaic(filename, tiles)
+
+        filename = self.directory / "tiles.csv"
+        print(f"writing table: {filename}")
+        with filename.open("wt") as fp:
+            writer = csv.DictWriter(fp, list(self.rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+    def _store_tiles(self):
+        """
+        Write the tiles that are not yet in the tile store, keyed by their `tile_id`.
+
+        The pixels of a previous compile in the output directory are removed,
+        `TileDataset` reads them from the store.
+        """
+        tile_ids = [row["tile_id"] for row in self.rows]
+        new_tiles = np.nonzero(~self.tile_store.contains(tile_ids))[0]
+        print(f"writing tiles: {self.tile_store.path}, {len(new_tiles):,} new of {len(tile_ids):,} tiles")
+        self.tile_store.put_batch(
+            [tile_ids[i] for i in new_tiles],
+            (self._get_tile_rgb(i) for i in new_tiles),
+        )
+        self.tile_store.flush()
+
+        for name in ("tiles.png", "tiles.npy"):
+            filename = self.directory / name
+            if filename.exists():
+                print(f"removing {filename}")
+                filename.unlink()
+
+    def _get_splits(self) -> Dict[str, np.ndarray]:
+        """
+        Assign all rows of a source to one split.
+
+        Sources are shuffled with the seed and the largest come first. Each source goes
+        to the split where the label counts and the number of tiles deviate the least
+        from the split fractions. The squared deviation of each label is relative
+        to its total count and weighted by its share of all tiles.
+        """
+        names = SPLIT_NAMES[:len(self.split_fractions)]
+        fractions = np.array(self.split_fractions)
+
+        source_ids = np.array([row["source_id"] for row in self.rows])
+        label_names, label_codes = np.unique(np.array([row["label"] for row in self.rows]), return_inverse=True)
+        sources, source_codes = np.unique(source_ids, return_inverse=True)
 
-        pixmap = QPixmap(QSize(width * size, width * size))
-        print(f"creating {pixmap.width()}x{pixmap.height()} image")
+        # [source, label] -> number of rows
+        counts = np.zeros((len(sources), len(label_names)))
+        np.add.at(counts, (source_codes, label_codes), 1)
+        # the total number of tiles is treated like one more label
+        counts = np.concatenate([counts, counts.sum(axis=1, keepdims=True)], axis=1)
+        totals = counts.sum(axis=0)
+        targets = fractions[:, None] * totals[None, :]
 
-        painter = QPainter(pixmap)
-        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
-        painter.setBrush(QBrush(QColor(0, 0, 0)))
-        painter.drawRect(pixmap.rect())
+        order = np.random.default_rng(self.split_seed).permutation(len(sources))
+        order = order[np.argsort(-counts[order, -1], kind="stable")]
 
-        x, y = 0, 0
-        for patch in patches:
-            painter.drawImage(QPoint(x * size, y * size), patch)
-            x += 1
-            if x >= width:
-                x = 0
-                y += 1
-        painter.end()
+        assigned = np.zeros_like(targets)
+        source_split = np.zeros(len(sources), dtype=int)
+        choices = np.eye(len(names))[:, :, None]
+        for source in order:
+            # [choice, split, label]
+            candidates = assigned[None] + choices * counts[source][None, None]
+            errors = ((candidates - targets[None]) ** 2 / (totals * totals[-1])[None, None]).sum(axis=(1, 2))
+            split = int(np.argmin(errors))
+            source_split[source] = split
+            assigned[split] += counts[source]
+
+        row_split = source_split[source_codes]
+        return {
+            name: np.nonzero(row_split == i)[0].astype(np.int32)
+            for i, name in enumerate(names)
+        }
+
+    def _get_split_statistics(self, splits: Dict[str, np.ndarray]) -> dict:
+        stats = {
+            "seed": self.split_seed,
+            "fractions": dict(zip(splits, self.split_fractions)),
+            "filename": "splits.npz",
+        }
+        for name, indices in splits.items():
+            label_counts = {}
+            source_ids = set()
+            for index in indices:
+                row = self.rows[index]
+                label_counts[row["label"]] = label_counts.get(row["label"], 0) + 1
+                source_ids.add(row["source_id"])
+            stats[name] = {
+                "count": len(indices),
+                "sources": len(source_ids),
+                "label": {
+                    key: label_counts[key]
+                    for key in sorted(label_counts, key=lambda k: label_counts[k], reverse=True)
+                },
+            }
+        return stats
+
+    def _get_tile_rgb(self, index: int) -> np.ndarray:
+        """
+        The [H, W, 3] pixels of a patch, like in the tiles.png mosaic
+        """
+        patch_data = self.patches[index]
+        if "indices" in patch_data:
+            return self.palette_rgb[patch_data["indices"]]
+        return pixels_to_rgb(patch_data["patch"])
+
+    def _write_indexed(self):
+        indices = np.stack([p["indices"] for p in self.patches]).astype(index_dtype(len(self.palette)))
+
+        filename = self.directory / "tiles.npy"
+        print(f"writing tiles: {filename}, {len(self.palette):,} colors")
+        np.save(str(filename), indices)
+
+        filename = self.directory / "palette.npz"
+        print(f"writing palette: {filename}")
+        np.savez(str(filename), rgba=self.palette.to_rgba(), rgb=self.palette_rgb)
+
+        filename = self.directory / "tiles.png"
+        print(f"writing tiles: {filename}")
+        if len(self.palette) < 256:
+            write_mosaic(filename, indices, color_table=self.palette_rgb)
+        else:
+            write_mosaic(filename, self.palette_rgb[indices])
+
+    def _write_patches(self, name: str, patches: List[np.ndarray]):
+        # drawn on black, like in the tiles of the other outputs
+        tiles = pixels_to_rgb(np.stack(patches))
 
         filename = self.directory / name
+        print(f"writing tiles: {filename}, {tiles.shape[0]:,} tiles")
+        write_mosaic(filename, tiles)
+
+        # the same pixels as [N, H, W, C] array, for random access without decoding the mosaic
+        filename = filename.with_suffix(".npy")
         print(f"writing tiles: {filename}")
-        pixmap.save(str(filename))
+        np.save(str(filename), tiles)
+
+    def _write_profile(self, profile: cProfile.Profile):
+        directory = self.directory or Path(".")
+
+        stats = pstats.Stats(profile)
+        for stage in self.pipeline.stages:
+            if stage.profile is not None:
+                stats.add(stage.profile)
+
+        filename = directory / "compile.prof"
+        print(f"writing profile: {filename}")
+        stats.dump_stats(str(filename))
+
+        filename = directory / "compile-timing.json"
+        print(f"writing timing report: {filename}")
+        filename.write_text(json.dumps({
+            **self.timer.report(),
+            "pipeline": {
+                stage.name: stage.stats()
+                for stage in self.pipeline.stages
+            },
+        }, indent=2))
 
 
 def main():
-    app = QGuiApplication(sys.argv)
     compiler = DatasetCompiler(**parse_args())
     compiler.compile()
 
@@ -14,6 +14,15 @@ BOOTSTRAP_DATA_PATH = Path(
     decouple.config("BOOTSTRAP_DATA_PATH", default=str(BOOTSTRAP_BASE_PATH / "data"))
 ).expanduser()
 
+# store tile positions in annotation files run-length or bitmap encoded
+BOOTSTRAP_COMPACT_POSITIONS = decouple.config("BOOTSTRAP_COMPACT_POSITIONS", default=False, cast=bool)
+
+# optional sqlite file that replaces the json annotation files, see bootstrap/annotationdb.py
+BOOTSTRAP_ANNOTATION_DB = decouple.config("BOOTSTRAP_ANNOTATION_DB", default="")
+
+# optional directory of the tile store shared by compiled datasets, see bootstrap/tilestore.py
+BOOTSTRAP_TILE_STORE = decouple.config("BOOTSTRAP_TILE_STORE", default="")
+
 
 with open(BOOTSTRAP_DATA_PATH / "urls.txt") as fp:
     SOURCE_URLS = list(
@@ -0,0 +1,271 @@
+import csv
+import json
+from pathlib import Path
+from typing import Optional, Union, List, Dict, Callable, Generator, Iterable
+
+import numpy as np
+import PIL.Image
+
+from bootstrap.tilestore import TileStore
+
+
+class TileDataset:
+    """
+    Reader for the output of `compile.py`.
+
+    The meta-data of `tiles.json` and `tiles.csv` is loaded on construction,
+    the pixels are only read when tiles are requested.
+    `tiles.npy` is memory-mapped, so a subset only reads its own tiles.
+    Without it, the `tiles.png` mosaic is decoded once on the first request.
+    Datasets compiled with `--tile-store` read their tiles from the store by `tile_id`.
+    Datasets compiled with `--indexed` store palette indices, the tiles are
+    looked up in the palette, see `palette` and `get_index_batch`.
+
+    `filter` and slicing return views that share the pixel data of the parent.
+
+        dataset = TileDataset("dataset-path")
+        walls = dataset.split("train").filter(label="wall", has_alpha=False)
+        batch = walls.get_batch(range(32))  # [32, H, W, C] uint8
+    """
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.info: dict = json.loads((self.path / "tiles.json").read_text())
+        self._columns = _read_columns(self.path / "tiles.csv")
+        self._indices = np.arange(self.info["count"])
+        # [N, H, W, C] uint8, shared with all views
+        self._pixels_ref = [None]
+
+    def __len__(self):
+        return len(self._indices)
+
+    def __getitem__(self, item: Union[int, slice]):
+        if isinstance(item, slice):
+            return self._view(self._indices[item])
+        return np.array(self._pixels()[self._indices[item]])
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.path}, {len(self)} tiles)"
+
+    @property
+    def shape(self) -> tuple:
+        """
+        Shape of one tile: (height, width, channels)
+        """
+        return (*self.info["shape"], self.info["channels"])
+
+    @property
+    def indices(self) -> np.ndarray:
+        """
+        Indices of the tiles of this view in the compiled dataset
+        """
+        return self._indices
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self._columns)
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        The values of a `tiles.csv` column for the tiles of this view
+        """
+        return self._columns[name][self._indices]
+
+    @property
+    def labels(self) -> np.ndarray:
+        return self.column("label")
+
+    def row(self, index: int) -> dict:
+        """
+        The `tiles.csv` row of a tile of this view
+        """
+        index = self._indices[index]
+        return {name: values[index].item() for name, values in self._columns.items()}
+
+    @property
+    def splits(self) -> List[str]:
+        """
+        Names of the splits written by `compile.py --split`
+        """
+        stats = self.info.get("splits") or {}
+        return [name for name in stats if isinstance(stats[name], dict) and "count" in stats[name]]
+
+    def split(self, name: str) -> "TileDataset":
+        """
+        A view of the tiles of one split, e.g. "train"
+        """
+        if name not in self.splits:
+            raise KeyError(f"No split '{name}' in {self.path}, available: {self.splits}")
+        with np.load(str(self.path / self.info["splits"]["filename"])) as data:
+            indices = data[name]
+        # the split of the whole dataset, restricted to this view
+        return self._view(self._indices[np.isin(self._indices, indices)])
+
+    def source_url(self, source_id: int) -> Optional[str]:
+        return self.info["info"]["source_id_mapping"].get(str(source_id))
+
+    def filter(
+            self,
+            label: Optional[Union[str, Iterable[str]]] = None,
+            source_id: Optional[Union[int, Iterable[int]]] = None,
+            has_alpha: Optional[bool] = None,
+            where: Optional[Callable[["TileDataset"], np.ndarray]] = None,
+    ) -> "TileDataset":
+        """
+        A view of the tiles that match all given conditions.
+
+        :param label: str or list of str
+        :param source_id: int or list of int
+        :param has_alpha: bool
+        :param where: optional callable(dataset) -> boolean array, e.g.
+            `lambda ds: ds.column("opaque_area_ratio") > .5`
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if label is not None:
+            mask &= np.isin(self.column("label"), [label] if isinstance(label, str) else list(label))
+        if source_id is not None:
+            source_ids = [source_id] if isinstance(source_id, int) else list(source_id)
+            mask &= np.isin(self.column("source_id"), source_ids)
+        if has_alpha is not None:
+            mask &= self.column("has_alpha").astype(bool) == has_alpha
+        if where is not None:
+            mask &= np.asarray(where(self), dtype=bool)
+        return self._view(self._indices[mask])
+
+    def get_batch(self, indices: Iterable[int]) -> np.ndarray:
+        """
+        Tiles of this view as [len(indices), H, W, C] uint8 array
+        """
+        if not isinstance(indices, np.ndarray):
+            indices = list(indices)
+        indices = self._indices[np.asarray(indices, dtype=int)]
+        if not len(indices):
+            return np.zeros((0, *self.shape), dtype=np.uint8)
+        # reading in ascending order keeps the access to the memory-mapped file sequential
+        order = np.argsort(indices, kind="stable")
+        batch = np.empty((len(indices), *self.shape), dtype=np.uint8)
+        batch[order] = self._pixels()[indices[order]]
+        return batch
+
+    @property
+    def palette(self) -> Optional[np.ndarray]:
+        """
+        The [C, 4] RGBA colors of an indexed dataset or None
+        """
+        if not self.info.get("indexed"):
+            return None
+        return self._pixels().rgba
+
+    def get_index_batch(self, indices: Iterable[int]) -> np.ndarray:
+        """
+        Palette indices of tiles of an indexed dataset as [len(indices), H, W] array
+        """
+        if not self.info.get("indexed"):
+            raise ValueError(f"{self.path} is not an indexed dataset")
+        if not isinstance(indices, np.ndarray):
+            indices = list(indices)
+        indices = self._indices[np.asarray(indices, dtype=int)]
+        return np.array(self._pixels().indices[indices])
+
+    def iter_batches(
+            self,
+            batch_size: int,
+            shuffle: bool = False,
+            seed: Optional[int] = None,
+    ) -> Generator[np.ndarray, None, None]:
+        """
+        Yield all tiles of this view in batches of [batch_size, H, W, C]
+        """
+        order = np.arange(len(self))
+        if shuffle:
+            np.random.default_rng(seed).shuffle(order)
+        for start in range(0, len(order), batch_size):
+            yield self.get_batch(order[start:start + batch_size])
+
+    def _view(self, indices: np.ndarray) -> "TileDataset":
+        view = self.__class__.__new__(self.__class__)
+        view.path = self.path
+        view.info = self.info
+        view._columns = self._columns
+        view._indices = indices
+        view._pixels_ref = self._pixels_ref
+        return view
+
+    def _pixels(self) -> np.ndarray:
+        if self._pixels_ref[0] is None:
+            filename = self.path / "tiles.npy"
+            if self.info.get("tile_store"):
+                self._pixels_ref[0] = _StoredTiles(TileStore(self.info["tile_store"]), self._columns["tile_id"])
+            elif self.info.get("indexed"):
+                with np.load(str(self.path / self.info["palette"]["filename"])) as data:
+                    self._pixels_ref[0] = _IndexedTiles(
+                        np.load(str(filename), mmap_mode="r"), data["rgb"], data["rgba"],
+                    )
+            elif filename.exists():
+                self._pixels_ref[0] = np.load(str(filename), mmap_mode="r")
+            else:
+                self._pixels_ref[0] = self._decode_mosaic()
+        return self._pixels_ref[0]
+
+    def _decode_mosaic(self) -> np.ndarray:
+        height, width, channels = self.shape
+        image = np.asarray(PIL.Image.open(self.path / "tiles.png").convert("RGBA"))[..., :channels]
+        num_columns = image.shape[1] // width
+        num_rows = image.shape[0] // height
+        return (
+            image[:num_rows * height, :num_columns * width]
+            .reshape(num_rows, height, num_columns, width, channels)
+            .transpose(0, 2, 1, 3, 4)
+            .reshape(num_rows * num_columns, height, width, channels)[:self.info["count"]]
+        )
+
+
+class _IndexedTiles:
+    """
+    Indexing by dataset index returns the colors of the palette indices
+    """
+    def __init__(self, indices: np.ndarray, rgb: np.ndarray, rgba: np.ndarray):
+        self.indices = indices
+        self.rgb = rgb
+        self.rgba = rgba
+
+    def __getitem__(self, indices):
+        return self.rgb[self.indices[indices]]
+
+
+class _StoredTiles:
+    """
+    Indexing by dataset index, like the array of `tiles.npy`
+    """
+    def __init__(self, store: TileStore, tile_ids: np.ndarray):
+        self.store = store
+        self.tile_ids = tile_ids
+
+    def __getitem__(self, indices):
+        if np.ndim(indices) == 0:
+            return self.store.get(self.tile_ids[indices])
+        return self.store.get_batch(self.tile_ids[indices])
+
+
+def _read_columns(filename: Path) -> Dict[str, np.ndarray]:
+    """
+    The csv columns as numpy arrays, numeric columns are converted to int or float
+    """
+    with filename.open("rt") as fp:
+        rows = list(csv.reader(fp))
+    if not rows:
+        return {}
+    if len(rows) == 1:
+        return {name: np.array([]) for name in rows[0]}
+
+    columns = {}
+    for name, values in zip(rows[0], zip(*rows[1:])):
+        # label names and hashes are strings, even if they look like numbers
+        for dtype in (int, float) if name not in ("label", "tile_id", "source_tile_id") else ():
+            try:
+                columns[name] = np.array([dtype(v) for v in values])
+                break
+            except ValueError:
+                pass
+        else:
+            columns[name] = np.array(values)
+    return columns
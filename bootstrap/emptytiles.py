@@ -0,0 +1,72 @@
+from typing import Set, Tuple
+
+import numpy as np
+
+
+def find_empty_tiles(image: np.ndarray, tiling: dict, uniform: bool = True) -> Set[Tuple[int, int]]:
+    """
+    Positions of the tiles that are fully transparent or of a single color.
+
+    The tiles are a strided [4, rows, columns, patch_size_y, patch_size_x] view of the image,
+    so the test is a reduction over the last two axes instead of a loop over tiles.
+
+    :param image: numpy array of shape [4, H, W] as returned by `qimage_to_numpy`
+        or `pixels_to_rgba(pixels).transpose(2, 0, 1)` of `bootstrap/images.py`,
+        with the alpha colors already applied
+    :param tiling: tiling dict, the positions follow `Tiling.iter_rects`
+    :param uniform: bool, also flag opaque tiles of a single color (e.g. background-only)
+    :return: set of (row, column)
+    """
+    tiles, first_pos = _tile_view(image, tiling)
+    if tiles is None:
+        return set()
+
+    is_empty = (tiles[3] == 0).all(axis=(-2, -1))
+    if uniform:
+        is_empty |= (tiles == tiles[..., :1, :1]).all(axis=(-2, -1)).all(axis=0)
+
+    return set(
+        (int(row) + first_pos[0], int(column) + first_pos[1])
+        for row, column in zip(*np.nonzero(is_empty))
+    )
+
+
+def _tile_view(image: np.ndarray, tiling: dict):
+    """
+    Returns the [C, rows, columns, patch_size_y, patch_size_x] view of all tiles
+    and the position of its first tile, or (None, None) if there are no tiles.
+
+    Tiles that start outside the top-left of the image are not part of the view.
+    """
+    first_pos, starts, counts = [], [], []
+    for axis, key in ((1, "y"), (2, "x")):
+        patch_size = tiling[f"patch_size_{key}"]
+        stride = patch_size + tiling[f"spacing_{key}"]
+        offset = tiling[f"offset_{key}"]
+
+        first = max(0, -offset + stride - 1) // stride
+        start = offset + first * stride
+        count = max(0, (image.shape[axis] - patch_size - start) // stride + 1)
+        if tiling.get(f"size_{key}"):
+            count = min(count, tiling[f"size_{key}"] - first)
+        if count <= 0:
+            return None, None
+
+        first_pos.append(first)
+        starts.append(start)
+        counts.append(count)
+
+    image = image[:, starts[0]:, starts[1]:]
+    tiles = np.lib.stride_tricks.as_strided(
+        image,
+        shape=(image.shape[0], counts[0], counts[1], tiling["patch_size_y"], tiling["patch_size_x"]),
+        strides=(
+            image.strides[0],
+            image.strides[1] * (tiling["patch_size_y"] + tiling["spacing_y"]),
+            image.strides[2] * (tiling["patch_size_x"] + tiling["spacing_x"]),
+            image.strides[1],
+            image.strides[2],
+        ),
+        writeable=False,
+    )
+    return tiles, tuple(first_pos)
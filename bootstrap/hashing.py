@@ -0,0 +1,196 @@
+from typing import Iterable, List, Dict, Tuple
+
+import numpy as np
+
+
+# name of the hash of `hash_rows`, stored with the tile ids of compiled datasets
+HASH_NAME = "nh128"
+
+_KEY_SEED = 0x74696c65
+_BLOCK_ROWS = 256
+# up to this number of colors per batch, `_number_colors` compares with each color instead of sorting
+_ONE_HOT_COLORS = 48
+# number of 32-bit words -> [2, words] uint32 keys
+_keys: Dict[int, np.ndarray] = {}
+
+
+def hash_rows(data: np.ndarray) -> np.ndarray:
+    """
+    128-bit digests of the bytes of each row of a [N, ...] array.
+
+    Each of the two 64-bit lanes is an NH hash (as in UMAC) of the 32-bit words of a row:
+    the sum of the products of pairs of (word + key) over the row,
+    followed by the murmur3 finalizer. The whole batch is hashed with
+    a few numpy operations, there is no per-row python code.
+
+    It's fast and well-distributed but not cryptographic, the probability of two
+    different rows having the same digest is about 2^-64.
+
+    :return: array of shape [N] and dtype "V16", see `digests_to_hex`
+    """
+    if not len(data):
+        return np.empty(0, dtype="V16")
+    data = np.ascontiguousarray(data)
+    data = data.view(np.uint8).reshape(len(data), -1)
+    num_bytes = data.shape[1]
+    if num_bytes % 8:
+        data = np.pad(data, ((0, 0), (0, 8 - num_bytes % 8)))
+    words = data.view("<u4")
+    keys = _get_keys(words.shape[1])
+
+    digests = np.empty((len(data), 2), dtype="<u8")
+    # blocks of rows keep the temporary arrays small
+    for start in range(0, len(words), _BLOCK_ROWS):
+        block = words[start:start + _BLOCK_ROWS]
+        for lane in range(2):
+            # the uint32 addition wraps around, the products fit into uint64
+            mixed = block + keys[lane]
+            digests[start:start + _BLOCK_ROWS, lane] = (
+                mixed[:, 0::2].astype(np.uint64) * mixed[:, 1::2]
+            ).sum(axis=1, dtype=np.uint64)
+    # rows that only differ in the zero-padding differ in length
+    digests += np.uint64(num_bytes)
+
+    digests ^= digests >> np.uint64(33)
+    digests *= np.uint64(0xff51afd7ed558ccd)
+    digests ^= digests >> np.uint64(33)
+    digests *= np.uint64(0xc4ceb9fe1a85ec53)
+    digests ^= digests >> np.uint64(33)
+    return digests.view("V16").reshape(-1)
+
+
+def digests_to_hex(digests: np.ndarray) -> List[str]:
+    text = digests.tobytes().hex()
+    return [text[i:i + 32] for i in range(0, len(text), 32)]
+
+
+def hex_to_digests(keys: Iterable[str]) -> np.ndarray:
+    return np.array([bytes.fromhex(key) for key in keys], dtype="V16").reshape(-1)
+
+
+def _get_keys(num_words: int) -> np.ndarray:
+    if num_words not in _keys:
+        _keys[num_words] = np.random.default_rng(_KEY_SEED).integers(
+            0, 2**32, size=(2, num_words), dtype=np.uint32,
+        )
+    return _keys[num_words]
+
+
+def canonical_hash_rows(tiles: np.ndarray, transforms: bool = True, palette: bool = False) -> np.ndarray:
+    """
+    Digests of [N, H, W] uint32 tiles (32-bit pixels) that are equal for equivalent tiles.
+
+    Fully transparent pixels are treated as equal, regardless of their color.
+
+    :param transforms: bool, tiles that are rotated or flipped copies of each other
+        (the symmetry group of the square) have the same digest.
+        All 8 variants of the batch are hashed at once and the smallest digest is used.
+    :param palette: bool, tiles that only differ in their colors have the same digest,
+        see `normalize_palette`
+    :return: array of shape [N] and dtype "V16"
+    """
+    if not len(tiles):
+        return np.empty(0, dtype="V16")
+    tiles = np.asarray(tiles, dtype=np.uint32)
+    num_tiles, height, width = tiles.shape
+    # the pixels are 0xAARRGGBB, fully transparent pixels are equal whatever their color
+    tiles = np.where(tiles >> np.uint32(24) == 0, np.uint32(0), tiles)
+    if palette:
+        # the colors are numbered after the transforms, the ids are just small integers
+        ids, num_ids = _color_ids(tiles.reshape(num_tiles, -1))
+        if num_ids <= 256:
+            ids = ids.astype(np.uint8)
+        tiles = ids.reshape(tiles.shape)
+
+    if transforms and height == width:
+        variants = np.stack([
+            np.rot90(t, k, axes=(1, 2))
+            for t in (tiles, tiles.transpose(0, 2, 1))
+            for k in range(4)
+        ]).reshape(-1, height * width)
+    elif transforms:
+        # without the rotations by 90 degrees, only the flips remain
+        variants = np.stack([
+            tiles, tiles[:, ::-1], tiles[:, :, ::-1], tiles[:, ::-1, ::-1],
+        ]).reshape(-1, height * width)
+    else:
+        variants = tiles.reshape(-1, height * width)
+
+    if palette:
+        variants = _number_colors(variants, num_ids)
+
+    digests = hash_rows(variants).view("<u8").reshape(-1, num_tiles, 2)
+    # the variant with the smallest first lane is the canonical one,
+    #   equal first lanes of different variants are practically impossible
+    canonical = np.argmin(digests[:, :, 0], axis=0)
+    return np.ascontiguousarray(digests[canonical, np.arange(num_tiles)]).view("V16").reshape(-1)
+
+
+def normalize_palette(rows: np.ndarray) -> np.ndarray:
+    """
+    Replace the colors of each row of [N, P] pixels by their order of first appearance.
+
+    The value 0 (fully transparent) stays 0, other colors are numbered from 1
+    in the order in which they first appear in the row.
+    Rows that only differ by a one-to-one change of colors become equal.
+    """
+    return _number_colors(*_color_ids(rows))
+
+
+def _color_ids(rows: np.ndarray) -> Tuple[np.ndarray, int]:
+    """
+    Small integer ids of the colors of each row of 32-bit values, 0 for value 0.
+    Returns the [N, P] uint32 ids and the number of ids.
+    """
+    num_rows, num_pixels = rows.shape
+    # sorted by color, the position is in the low bits
+    keys = np.sort((rows.astype(np.uint64) << np.uint64(32)) | np.arange(num_pixels, dtype=np.uint64), axis=1)
+    colors = keys >> np.uint64(32)
+    is_new = np.ones(keys.shape, dtype=bool)
+    is_new[:, 1:] = colors[:, 1:] != colors[:, :-1]
+    sorted_ids = np.cumsum(is_new, axis=1, dtype=np.uint32)
+    sorted_ids[colors == 0] = 0
+
+    ids = np.empty_like(sorted_ids)
+    np.put_along_axis(ids, (keys & np.uint64(0xffffffff)).astype(np.intp), sorted_ids, axis=1)
+    return ids, int(sorted_ids[:, -1].max()) + 1
+
+
+def _number_colors(ids: np.ndarray, num_ids: int) -> np.ndarray:
+    """
+    `normalize_palette` of the [N, P] color ids of `_color_ids`
+    """
+    num_rows, num_pixels = ids.shape
+    if num_ids <= _ONE_HOT_COLORS:
+        # [N, colors, P] comparison instead of a sort of each row
+        is_color = ids[:, None, :] == np.arange(num_ids, dtype=ids.dtype)[None, :, None]
+        first_position = np.where(is_color.any(axis=2), is_color.argmax(axis=2), num_pixels)
+        first_position[:, 0] = -1
+        color_numbers = np.argsort(np.argsort(first_position, axis=1), axis=1).astype(ids.dtype)
+        return _take_rows(color_numbers, ids)
+
+    row_index = np.broadcast_to(np.arange(num_rows)[:, None], ids.shape)
+    # the keys are unique within a row, sorted they group the pixels by color in the order of their position
+    keys = np.sort(ids * np.uint32(num_pixels + 1) + np.arange(num_pixels, dtype=np.uint32), axis=1)
+    colors, positions = np.divmod(keys, np.uint32(num_pixels + 1))
+    is_first = np.ones(keys.shape, dtype=bool)
+    is_first[:, 1:] = colors[:, 1:] != colors[:, :-1]
+
+    # each color is numbered by the count of colors that appear up to its first pixel
+    is_first &= colors != 0
+    is_first_at = np.zeros((num_rows, num_pixels), dtype=bool)
+    is_first_at[row_index[is_first], positions[is_first]] = True
+    numbers = np.cumsum(is_first_at, axis=1, dtype=np.uint32)
+
+    # color id -> number, transparent stays 0
+    color_numbers = np.zeros((num_rows, num_ids), dtype=ids.dtype)
+    color_numbers[row_index[is_first], colors[is_first]] = numbers[row_index[is_first], positions[is_first]]
+    return _take_rows(color_numbers, ids)
+
+
+def _take_rows(table: np.ndarray, indices: np.ndarray) -> np.ndarray:
+    """
+    `np.take_along_axis(table, indices, axis=1)`, but faster for small tables
+    """
+    offsets = np.arange(len(table), dtype=np.intp)[:, None] * table.shape[1]
+    return np.take(table.reshape(-1), indices + offsets)
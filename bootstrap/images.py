@@ -0,0 +1,201 @@
+import math
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import PIL.Image
+import skimage.measure
+
+# (x, y, width, height)
+Rect = Tuple[int, int, int, int]
+
+
+def load_image(filename: Union[str, Path], alpha_colors: Optional[List[List[int]]] = None) -> np.ndarray:
+    """
+    Decode an image file to [H, W] uint32 pixels in 0xAARRGGBB (straight alpha),
+    the same values as the 32-bit QImage of `get_qimage_from_source` in `bootstrap/app/util.py`.
+    Images without alpha channel are opaque (0xff alpha).
+
+    :param alpha_colors: optional list of RGB colors that are made fully transparent
+    """
+    with PIL.Image.open(filename) as image:
+        if image.mode.startswith("I;16"):
+            # 16-bit grayscale, reduced to 8 bits with rounding
+            gray = np.asarray(image).astype(np.uint32)
+            gray = (gray * 255 + 32767) // 65535
+            pixels = np.uint32(0xff000000) | (gray << 16) | (gray << 8) | gray
+        else:
+            rgba = np.asarray(image.convert("RGBA")).astype(np.uint32)
+            pixels = (rgba[..., 3] << 24) | (rgba[..., 0] << 16) | (rgba[..., 1] << 8) | rgba[..., 2]
+
+    if alpha_colors:
+        pixels = apply_alpha_colors(pixels, alpha_colors)
+    return np.ascontiguousarray(pixels, dtype=np.uint32)
+
+
+def has_alpha_channel(filename: Union[str, Path]) -> bool:
+    """
+    Whether the image file has an alpha channel or a transparent color, read from the header
+    """
+    with PIL.Image.open(filename) as image:
+        return image.mode in ("RGBA", "LA", "PA", "RGBa", "La") or "transparency" in image.info
+
+
+def apply_alpha_colors(pixels: np.ndarray, colors: List[List[int]]) -> np.ndarray:
+    """
+    Make all pixels transparent that match one of the RGB `colors`, the color values are kept
+    """
+    rgb = pixels & np.uint32(0xffffff)
+    is_keyed = np.isin(rgb, [(int(r) << 16) | (int(g) << 8) | int(b) for r, g, b, *_ in colors])
+    return np.where(is_keyed, rgb, pixels)
+
+
+def scale_indices(source_length: int, length: int) -> np.ndarray:
+    """
+    Source index of each target pixel of a nearest-neighbour scaling,
+    in the 16.16 fixed-point arithmetic of `QImage.scaled`.
+    """
+    step = int(65536 / (length / source_length))
+    return (step * np.arange(length, dtype=np.int64) + step // 2 - 1) >> 16
+
+
+def cut_tiles(
+        pixels: np.ndarray,
+        rects: Sequence[Rect],
+        size: Tuple[int, int],
+        fill: int = 0,
+) -> np.ndarray:
+    """
+    The rects of [H, W] pixels, scaled to (width, height) `size`, as [N, height, width] array.
+    Rects of equal size are cut in one step and scaled with `scale_tiles`.
+
+    :param fill: 0xAARRGGBB value of the pixels outside the image
+    """
+    width, height = size
+    tiles = np.empty((len(rects), height, width), dtype=pixels.dtype)
+    if not len(rects):
+        return tiles
+
+    coords = np.array(rects, dtype=np.int64).reshape(-1, 4)
+    pad_top, pad_left = (max(0, -int(v)) for v in coords[:, 1::-1].min(axis=0))
+    pad_bottom, pad_right = (
+        max(0, int(v) - length)
+        for v, length in zip((coords[:, 1::-1] + coords[:, :1:-1]).max(axis=0), pixels.shape)
+    )
+    if pad_top or pad_left or pad_bottom or pad_right:
+        pixels = np.pad(pixels, ((pad_top, pad_bottom), (pad_left, pad_right)), constant_values=fill)
+        coords[:, :2] += (pad_left, pad_top)
+
+    for rect_size in np.unique(coords[:, 2:], axis=0):
+        is_size = np.all(coords[:, 2:] == rect_size, axis=1)
+        rect_width, rect_height = (int(s) for s in rect_size)
+        # [N, rect_height, rect_width] indices into the image
+        rows = coords[is_size, 1, None] + np.arange(rect_height)[None, :]
+        columns = coords[is_size, 0, None] + np.arange(rect_width)[None, :]
+        tiles[is_size] = scale_tiles(pixels[rows[:, :, None], columns[:, None, :]], size)
+    return tiles
+
+
+def scale_tiles(tiles: np.ndarray, size: Tuple[int, int]) -> np.ndarray:
+    """
+    [N, H, W] tiles scaled to (width, height) `size` as [N, height, width] array,
+    nearest-neighbour like `QImage.scaled`. Tiles of that size are returned unchanged.
+    """
+    width, height = size
+    tile_height, tile_width = tiles.shape[1:]
+    if (tile_width, tile_height) == (width, height):
+        return tiles
+    scaled = tiles[:, scale_indices(tile_height, height)[:, None], scale_indices(tile_width, width)[None, :]]
+    return premultiply_round_trip(scaled)
+
+
+def premultiply_round_trip(pixels: np.ndarray) -> np.ndarray:
+    """
+    32-bit ARGB pixels after the conversion to 16-bit premultiplied alpha and back,
+    which `QImage.scaled` applies to images with alpha channel.
+    Fully transparent pixels become 0, opaque pixels are unchanged.
+    """
+    alpha = pixels >> np.uint32(24)
+    is_translucent = (alpha != 0) & (alpha != 0xff)
+    pixels = np.where(alpha == 0, np.uint32(0), pixels)
+    if not is_translucent.any():
+        return pixels
+
+    values = pixels[is_translucent].astype(np.int64)
+    alpha16 = (values >> 24) * 257
+    result = values & 0xff000000
+    for shift in (16, 8, 0):
+        premultiplied = (((values >> shift) & 0xff) * 257 * alpha16) >> 16
+        value16 = (premultiplied * 65535 + alpha16 // 2) // alpha16
+        result |= ((value16 - (value16 >> 8) + 0x80) >> 8) << shift
+    pixels[is_translucent] = result.astype(np.uint32)
+    return pixels
+
+
+def pixels_to_rgb(pixels: np.ndarray) -> np.ndarray:
+    """
+    32-bit ARGB pixels of any shape as [..., 3] uint8, drawn on black
+    with the rounding of `QPainter.drawImage` on a black image.
+    """
+    pixels = np.asarray(pixels, dtype=np.uint32)
+    alpha = pixels >> np.uint32(24)
+    rgb = np.stack([(pixels >> np.uint32(shift)) & np.uint32(0xff) for shift in (16, 8, 0)], axis=-1)
+    product = rgb * alpha[..., None]
+    return ((product + (product >> np.uint32(8)) + np.uint32(0x80)) >> np.uint32(8)).astype(np.uint8)
+
+
+def pixels_to_rgba(pixels: np.ndarray) -> np.ndarray:
+    """
+    32-bit ARGB pixels of any shape as [..., 4] uint8 RGBA
+    """
+    pixels = np.asarray(pixels, dtype=np.uint32)
+    return np.stack([
+        (pixels >> np.uint32(shift)) & np.uint32(0xff) for shift in (16, 8, 0, 24)
+    ], axis=-1).astype(np.uint8)
+
+
+def write_mosaic(filename: Union[str, Path], tiles: np.ndarray, color_table: Optional[np.ndarray] = None):
+    """
+    Write [N, H, W, 3] tiles as a square mosaic image.
+
+    With a [C, 3] `color_table` of less than 256 colors, the tiles are [N, H, W] uint8 indices
+    and the mosaic is an 8-bit indexed image, the unused space is black.
+    """
+    size = tiles.shape[1]
+    width = int(math.ceil(math.sqrt(len(tiles))))
+    if color_table is None:
+        mosaic = np.zeros((width * width, size, size, 3), dtype=np.uint8)
+    else:
+        mosaic = np.full((width * width, size, size), len(color_table), dtype=np.uint8)
+    mosaic[:len(tiles)] = tiles
+    mosaic = mosaic.reshape(width, width, *mosaic.shape[1:]).swapaxes(1, 2)
+    mosaic = np.ascontiguousarray(mosaic.reshape(width * size, width * size, *mosaic.shape[4:]))
+
+    image = PIL.Image.fromarray(mosaic)
+    if color_table is not None:
+        image.putpalette(np.concatenate([color_table, [[0, 0, 0]]]).astype(np.uint8).tobytes())
+    image.save(str(filename))
+
+
+def get_alpha_bounding_rect(alpha: np.ndarray) -> Rect:
+    """
+    The (x, y, width, height) bounding box of the contours of an alpha channel,
+    the whole area if there is none
+    """
+    min_x, min_y, max_x, max_y = None, None, None, None
+    for contour in skimage.measure.find_contours(alpha):
+        c_min_x, c_min_y = contour.min(axis=0)
+        c_max_x, c_max_y = contour.max(axis=0)
+        min_x = c_min_x if min_x is None else min(min_x, c_min_x)
+        min_y = c_min_y if min_y is None else min(min_y, c_min_y)
+        max_x = c_max_x if max_x is None else max(max_x, c_max_x)
+        max_y = c_max_y if max_y is None else max(max_y, c_max_y)
+
+    if min_x is None:
+        return 0, 0, alpha.shape[-1], alpha.shape[-2]
+
+    min_x = int(math.floor(min_x))
+    min_y = int(math.floor(min_y))
+    max_x = min(alpha.shape[-1], int(math.ceil(max_x)))
+    max_y = min(alpha.shape[-2], int(math.ceil(max_y)))
+    return min_x, min_y, max_x - min_x, max_y - min_y
@@ -0,0 +1,197 @@
+import json
+import os
+from copy import deepcopy
+from pathlib import Path
+from typing import List, Union, Iterable, Dict, Set, Tuple
+
+from bootstrap import config
+from bootstrap.positions import decode_positions, encode_positions, encode_tiling_positions
+
+
+class SourceJournal:
+    """
+    Append-only edit journal of a source data file.
+
+    Edits are appended as json lines to `data/oga/<name>.journal`
+    next to `data/oga/<name>.json` and are replayed by `load_source_data`.
+    `compact` writes the complete source data file and removes the journal.
+
+    Records are either single tile edits:
+
+        {"op": "tile", "image": "a.png", "tiling": 0, "pos": [y, x], "key": "ignore", "state": true}
+        {"op": "tile", "image": "a.png", "tiling": 0, "pos": [y, x], "key": "labels", "label": "wall", "state": false}
+
+    or the complete data of one image (e.g. after changing the tilings or alpha colors):
+
+        {"op": "image", "image": "a.png", "data": {"tilings": [...], ...}}
+
+    where "image" is the filename relative to the source's web folder.
+    """
+    def __init__(self, data_filename: Union[str, Path]):
+        self.data_filename = Path(data_filename)
+        self.filename = journal_filename(self.data_filename)
+        self.num_records = 0
+        if self.filename.exists():
+            with self.filename.open("rt") as fp:
+                self.num_records = sum(1 for line in fp if line.strip())
+
+    def append(self, records: List[dict]):
+        if not records:
+            return
+
+        os.makedirs(self.filename.parent, exist_ok=True)
+        with self.filename.open("at") as fp:
+            for record in records:
+                fp.write(json.dumps(record) + "\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        self.num_records += len(records)
+
+    def compact(self, source: dict):
+        """
+        Write the complete `source` to the data file and remove the journal.
+
+        The data file is replaced atomically. Replaying the journal is idempotent,
+        so a crash before the journal is removed does not change the data.
+        """
+        os.makedirs(self.data_filename.parent, exist_ok=True)
+        temp_filename = self.data_filename.with_name(f".{self.data_filename.name}.tmp")
+        temp_filename.write_text(json.dumps(source_to_json(source)))
+        os.replace(temp_filename, self.data_filename)
+
+        if self.filename.exists():
+            self.filename.unlink()
+        self.num_records = 0
+
+
+def journal_filename(data_filename: Union[str, Path]) -> Path:
+    return Path(data_filename).with_suffix(".journal")
+
+
+def image_to_json(image: dict, web_folder: Union[str, Path]) -> dict:
+    """
+    Convert an in-memory image to the form stored in the data file
+    """
+    image = deepcopy(image)
+    image["filename"] = str(Path(image["filename"]).relative_to(web_folder))
+    for tiling in image["tilings"]:
+        tiling.pop("duplicates", None)
+        if config.BOOTSTRAP_COMPACT_POSITIONS:
+            encode_tiling_positions(tiling)
+    return image
+
+
+def source_to_json(source: dict) -> dict:
+    """
+    Convert an in-memory source to the form stored in the data file
+    """
+    data = {
+        key: value
+        for key, value in source.items()
+        if key not in ("name", "web_folder", "data_filename", "images")
+    }
+    data = deepcopy(data)
+    data["images"] = [
+        image_to_json(image, source["web_folder"])
+        for image in source["images"]
+        if image["tilings"]
+    ]
+    return data
+
+
+def load_source_data(data_filename: Union[str, Path]) -> dict:
+    """
+    Load a source data file and replay its journal.
+
+    Returns an empty dict if neither exists.
+    """
+    data_filename = Path(data_filename)
+    data = {}
+    if data_filename.exists():
+        data = json.loads(data_filename.read_text())
+
+    filename = journal_filename(data_filename)
+    if filename.exists():
+        data.setdefault("images", [])
+        apply_records(data, iter_records(filename))
+
+    return data
+
+
+def iter_records(filename: Union[str, Path]) -> Iterable[dict]:
+    with Path(filename).open("rt") as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # an incomplete last line, from a crash while appending
+                break
+
+
+def apply_records(data: dict, records: Iterable[dict]):
+    """
+    Apply journal records to the stored form of a source
+    """
+    images = {image["filename"]: image for image in data["images"]}
+    # (image, tiling, key, label) -> set of positions
+    position_sets: Dict[tuple, Set[Tuple[int, int]]] = {}
+
+    def _flush_positions():
+        for (filename, tiling_index, key, label), positions in position_sets.items():
+            tiling = images[filename]["tilings"][tiling_index]
+            if config.BOOTSTRAP_COMPACT_POSITIONS:
+                positions = encode_positions(positions)
+            else:
+                positions = [list(p) for p in sorted(positions)]
+            if key == "ignore":
+                if positions:
+                    tiling["ignore"] = positions
+                else:
+                    tiling.pop("ignore", None)
+            else:
+                labels = tiling.setdefault("labels", {})
+                if positions:
+                    labels[label] = positions
+                else:
+                    labels.pop(label, None)
+                if not labels:
+                    tiling.pop("labels")
+        position_sets.clear()
+
+    for record in records:
+        filename = record["image"]
+
+        if record["op"] == "image":
+            _flush_positions()
+            if record["data"]["tilings"]:
+                images[filename] = {**deepcopy(record["data"]), "filename": filename}
+            else:
+                images.pop(filename, None)
+
+        elif record["op"] == "tile":
+            image = images.get(filename)
+            if not image or record["tiling"] >= len(image["tilings"]):
+                continue
+
+            label = record.get("label") if record["key"] == "labels" else None
+            set_key = (filename, record["tiling"], record["key"], label)
+            if set_key not in position_sets:
+                tiling = image["tilings"][record["tiling"]]
+                if record["key"] == "ignore":
+                    positions = tiling.get("ignore")
+                else:
+                    positions = (tiling.get("labels") or {}).get(label)
+                position_sets[set_key] = decode_positions(positions)
+
+            pos = tuple(record["pos"])
+            if record["state"]:
+                position_sets[set_key].add(pos)
+            else:
+                position_sets[set_key].discard(pos)
+
+    _flush_positions()
+    data["images"] = list(images.values())
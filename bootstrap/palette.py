@@ -0,0 +1,71 @@
+from typing import Optional
+
+import numpy as np
+
+
+class ColorPalette:
+    """
+    Table of 32-bit ARGB colors (0xAARRGGBB, straight alpha) for palette-indexed tiles.
+
+    Colors get their index in the order they are first added, so indices
+    that were handed out stay valid while the palette grows.
+
+        palette = ColorPalette()
+        indices = palette.index(pixels)  # same shape as pixels
+        assert (palette.colors[indices] == pixels).all()
+    """
+    def __init__(self, colors: Optional[np.ndarray] = None):
+        self._colors = np.zeros(0, dtype=np.uint32)
+        # the colors sorted and the index of each sorted color
+        self._sorted_colors = np.zeros(0, dtype=np.uint32)
+        self._sorted_index = np.zeros(0, dtype=np.int64)
+        if colors is not None:
+            self.index(np.asarray(colors, dtype=np.uint32))
+
+    def __len__(self):
+        return len(self._colors)
+
+    @property
+    def colors(self) -> np.ndarray:
+        return self._colors
+
+    def index(self, pixels: np.ndarray) -> np.ndarray:
+        """
+        The palette indices of an array of 32-bit ARGB pixels, colors that are
+        not in the palette are added. The indices are the smallest unsigned integer
+        type that fits the current palette.
+        """
+        pixels = np.asarray(pixels, dtype=np.uint32)
+        colors, inverse = np.unique(pixels.reshape(-1), return_inverse=True)
+
+        positions = np.minimum(np.searchsorted(self._sorted_colors, colors), max(0, len(self._sorted_colors) - 1))
+        is_known = np.zeros(len(colors), dtype=bool)
+        if len(self._sorted_colors):
+            is_known = self._sorted_colors[positions] == colors
+
+        color_index = np.empty(len(colors), dtype=np.int64)
+        color_index[is_known] = self._sorted_index[positions[is_known]]
+        new_colors = colors[~is_known]
+        if len(new_colors):
+            color_index[~is_known] = np.arange(len(self._colors), len(self._colors) + len(new_colors))
+            self._colors = np.concatenate([self._colors, new_colors])
+            order = np.argsort(self._colors, kind="stable")
+            self._sorted_colors = self._colors[order]
+            self._sorted_index = order
+
+        return color_index[inverse].reshape(pixels.shape).astype(index_dtype(len(self)))
+
+    def to_rgba(self) -> np.ndarray:
+        """
+        The colors as [C, 4] uint8 array
+        """
+        return np.stack([
+            self._colors >> 16, self._colors >> 8, self._colors, self._colors >> 24,
+        ], axis=-1).astype(np.uint8)
+
+
+def index_dtype(num_colors: int) -> np.dtype:
+    for dtype in (np.uint8, np.uint16):
+        if num_colors <= np.iinfo(dtype).max + 1:
+            return np.dtype(dtype)
+    return np.dtype(np.uint32)
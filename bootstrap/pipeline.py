@@ -0,0 +1,225 @@
+import cProfile
+import queue
+import threading
+import time
+from typing import Callable, Iterable, Generator, List, Optional, Any
+
+
+class PipelineStage:
+    """
+    One stage of a `Pipeline`.
+
+    `func` is a generator function. The first stage is called without arguments,
+    every other stage receives an iterable of the items of the previous stage.
+
+    The counters are updated while the pipeline runs:
+      - num_items: number of items yielded
+      - busy_time: wall time spent inside `func`, without waiting for input or output
+      - cpu_time: cpu time of the stage thread
+      - wait_input_time: time spent waiting for the previous stage
+      - wait_output_time: time spent waiting for the next stage
+
+    If the pipeline is run with `profile=True`, `profile` holds
+    the cProfile.Profile of the stage thread.
+    """
+    def __init__(self, name: str, func: Callable[..., Iterable]):
+        self.name = name
+        self.func = func
+        self.num_items = 0
+        self.busy_time = 0.
+        self.cpu_time = 0.
+        self.wait_input_time = 0.
+        self.wait_output_time = 0.
+        self.profile: Optional[cProfile.Profile] = None
+
+    @property
+    def items_per_second(self) -> float:
+        return self.num_items / self.busy_time if self.busy_time else 0.
+
+    def stats(self) -> dict:
+        return {
+            "items": self.num_items,
+            "busy_time": round(self.busy_time, 3),
+            "cpu_time": round(self.cpu_time, 3),
+            "wait_input_time": round(self.wait_input_time, 3),
+            "wait_output_time": round(self.wait_output_time, 3),
+            "items_per_second": round(self.items_per_second, 1),
+        }
+
+
+class _Stopped(Exception):
+    pass
+
+
+class _Failure:
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+_END = object()
+
+
+class Pipeline:
+    """
+    Runs a chain of generator functions, each in its own thread,
+    connected by bounded queues.
+
+    Iterating the pipeline yields the items of the last stage.
+    The order of items is preserved and an exception in any stage
+    is re-raised in the iterating thread. Leaving the iteration early
+    stops all stages and a stage that returns early stops all previous stages,
+    so no further items are produced that nobody consumes.
+    """
+    def __init__(self, queue_size: int = 16, poll_interval: float = .1, profile: bool = False):
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+        self.profile = profile
+        self.stages: List[PipelineStage] = []
+        # one event per stage, set when the items of the stage are not needed any more
+        self._stops: List[threading.Event] = []
+
+    def add_stage(self, name: str, func: Callable[..., Iterable]) -> "Pipeline":
+        self.stages.append(PipelineStage(name, func))
+        return self
+
+    def __iter__(self) -> Generator[Any, None, None]:
+        if not self.stages:
+            return
+
+        queues = [queue.Queue(self.queue_size) for _ in self.stages]
+        self._stops = [threading.Event() for _ in self.stages]
+        threads = [
+            threading.Thread(
+                target=self._run_stage,
+                args=(i, queues[i - 1] if i else None, queues[i]),
+                name=f"pipeline-{stage.name}",
+                daemon=True,
+            )
+            for i, stage in enumerate(self.stages)
+        ]
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            yield from self._iter_queue(queues[-1], self._stops[-1])
+        finally:
+            for stop in self._stops:
+                stop.set()
+            for thread in threads:
+                thread.join()
+
+    def bottleneck(self) -> Optional[PipelineStage]:
+        """
+        The stage that spent the most time working
+        """
+        if not self.stages:
+            return None
+        return max(self.stages, key=lambda s: s.busy_time)
+
+    def print_stats(self):
+        bottleneck = self.bottleneck()
+        for stage in self.stages:
+            stats = stage.stats()
+            print(
+                f"stage {stage.name:10} items: {stats['items']:9,}"
+                f"  busy: {stats['busy_time']:8.2f}s  cpu: {stats['cpu_time']:8.2f}s"
+                f"  wait in: {stats['wait_input_time']:8.2f}s  wait out: {stats['wait_output_time']:8.2f}s"
+                f"  {stats['items_per_second']:10,.1f}/s"
+                + ("  <- bottleneck" if stage is bottleneck and len(self.stages) > 1 else "")
+            )
+
+    def _run_stage(self, index: int, input_queue: Optional[queue.Queue], output_queue: queue.Queue):
+        stage = self.stages[index]
+        stop = self._stops[index]
+        cpu_start = time.thread_time()
+        if self.profile:
+            stage.profile = cProfile.Profile()
+            stage.profile.enable()
+        try:
+            if input_queue is None:
+                iterable = iter(stage.func())
+            else:
+                iterable = iter(stage.func(self._iter_queue(input_queue, stop, stage)))
+
+            while True:
+                # checked before each item, not only when the output queue is full
+                if stop.is_set():
+                    raise _Stopped()
+
+                wait_input_time = stage.wait_input_time
+                start_time = time.perf_counter()
+                try:
+                    item = next(iterable)
+                except StopIteration:
+                    break
+                finally:
+                    stage.busy_time += time.perf_counter() - start_time - (stage.wait_input_time - wait_input_time)
+
+                stage.num_items += 1
+                self._put(output_queue, item, stop, stage)
+
+            self._put(output_queue, _END, stop)
+
+        except _Stopped:
+            pass
+
+        except BaseException as e:
+            try:
+                self._put(output_queue, _Failure(e), stop)
+            except _Stopped:
+                pass
+
+        finally:
+            # the previous stage is not needed any more, e.g. when this stage returned early
+            if index:
+                self._stops[index - 1].set()
+            stage.cpu_time = time.thread_time() - cpu_start
+            if stage.profile is not None:
+                stage.profile.disable()
+
+    def _put(
+            self,
+            output_queue: queue.Queue,
+            item: Any,
+            stop: threading.Event,
+            stage: Optional[PipelineStage] = None,
+    ):
+        start_time = time.perf_counter()
+        while True:
+            if stop.is_set():
+                raise _Stopped()
+            try:
+                output_queue.put(item, timeout=self.poll_interval)
+                break
+            except queue.Full:
+                pass
+
+        if stage is not None:
+            stage.wait_output_time += time.perf_counter() - start_time
+
+    def _iter_queue(
+            self,
+            input_queue: queue.Queue,
+            stop: threading.Event,
+            stage: Optional[PipelineStage] = None,
+    ) -> Generator[Any, None, None]:
+        while True:
+            start_time = time.perf_counter()
+            while True:
+                try:
+                    item = input_queue.get(timeout=self.poll_interval)
+                    break
+                except queue.Empty:
+                    if stop.is_set():
+                        raise _Stopped()
+
+            if stage is not None:
+                stage.wait_input_time += time.perf_counter() - start_time
+
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                raise item.exception
+
+            yield item
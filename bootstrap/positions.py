@@ -0,0 +1,94 @@
+import base64
+import json
+from typing import Iterable, Set, Tuple, Union, Optional
+
+import numpy as np
+
+
+EncodedPositions = Union[list, dict]
+
+
+def decode_positions(value: Optional[EncodedPositions]) -> Set[Tuple[int, int]]:
+    """
+    Decode tile positions (the `ignore`, `duplicates` and `labels` values of a tiling)
+    which are stored in one of three forms:
+
+        [[row, col], ...]                            # list of positions
+        {"runs": [row, col, length, ...]}            # row-major run-lengths
+        {"bitmap": "<base64>", "offset": [row, col], "shape": [rows, cols]}
+                                                     # packed row-major bitmap of the bounding box
+    """
+    if not value:
+        return set()
+
+    if isinstance(value, list):
+        return set(tuple(p) for p in value)
+
+    if "runs" in value:
+        runs = value["runs"]
+        return set(
+            (runs[i], col)
+            for i in range(0, len(runs), 3)
+            for col in range(runs[i + 1], runs[i + 1] + runs[i + 2])
+        )
+
+    if "bitmap" in value:
+        rows, cols = value["shape"]
+        bits = np.unpackbits(
+            np.frombuffer(base64.b64decode(value["bitmap"]), dtype=np.uint8),
+            count=rows * cols,
+        ).reshape(rows, cols)
+        ys, xs = np.nonzero(bits)
+        ys = (ys + value["offset"][0]).tolist()
+        xs = (xs + value["offset"][1]).tolist()
+        return set(zip(ys, xs))
+
+    raise ValueError(f"Invalid tile positions {value}")
+
+
+def encode_positions(positions: Iterable[Tuple[int, int]]) -> EncodedPositions:
+    positions = sorted(set(tuple(p) for p in positions))
+    if not positions:
+        return []
+
+    candidates = [[list(p) for p in positions]]
+
+    runs = []
+    for y, x in positions:
+        if runs and runs[-3] == y and runs[-2] + runs[-1] == x:
+            runs[-1] += 1
+        else:
+            runs.extend((y, x, 1))
+    candidates.append({"runs": runs})
+
+    array = np.array(positions)
+    offset = array.min(axis=0)
+    shape = array.max(axis=0) - offset + 1
+    # skip bitmaps that are obviously larger than the run-lengths
+    if shape[0] * shape[1] / 6 < len(runs) * 4:
+        bits = np.zeros(shape, dtype=np.uint8)
+        bits[array[:, 0] - offset[0], array[:, 1] - offset[1]] = 1
+        candidates.append({
+            "bitmap": base64.b64encode(np.packbits(bits)).decode("ascii"),
+            "offset": offset.tolist(),
+            "shape": shape.tolist(),
+        })
+
+    return min(candidates, key=lambda c: len(json.dumps(c)))
+
+
+def encode_tiling_positions(tiling: dict) -> dict:
+    """
+    Encode all tile positions of a tiling dict in place
+    """
+    for key in ("ignore", "duplicates"):
+        if tiling.get(key):
+            tiling[key] = encode_positions(decode_positions(tiling[key]))
+
+    if tiling.get("labels"):
+        tiling["labels"] = {
+            label: encode_positions(decode_positions(positions))
+            for label, positions in tiling["labels"].items()
+        }
+
+    return tiling
@@ -0,0 +1,105 @@
+import sys
+import time
+import threading
+from contextlib import contextmanager
+from typing import Optional, Dict
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+
+def get_peak_rss() -> Optional[int]:
+    """
+    Peak resident set size of this process in bytes, or None if unknown
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macos bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class StageTimer:
+    """
+    Accumulates wall and cpu time of named stages, optionally per source.
+
+    Can be used from several threads, the cpu time is the time
+    of the measuring thread.
+
+        timer = StageTimer()
+        with timer.measure("decode", source=url):
+            ...
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+        # stage-name -> [calls, wall-time, cpu-time]
+        self.stages: Dict[str, list] = {}
+        # source -> stage-name -> wall-time
+        self.sources: Dict[str, Dict[str, float]] = {}
+
+    @contextmanager
+    def measure(self, name: str, source: Optional[str] = None):
+        wall_time = time.perf_counter()
+        cpu_time = time.thread_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall_time, time.thread_time() - cpu_time, source=source)
+
+    def add(self, name: str, wall_time: float, cpu_time: float, source: Optional[str] = None):
+        with self._lock:
+            if name not in self.stages:
+                self.stages[name] = [0, 0., 0.]
+            stage = self.stages[name]
+            stage[0] += 1
+            stage[1] += wall_time
+            stage[2] += cpu_time
+
+            if source is not None:
+                if source not in self.sources:
+                    self.sources[source] = {}
+                self.sources[source][name] = self.sources[source].get(name, 0.) + wall_time
+
+    def report(self) -> dict:
+        with self._lock:
+            peak_rss = get_peak_rss()
+            return {
+                "wall_time": round(time.perf_counter() - self._start_wall, 6),
+                "cpu_time": round(time.process_time() - self._start_cpu, 6),
+                "peak_rss_mb": None if peak_rss is None else round(peak_rss / 2**20, 1),
+                "stages": {
+                    name: {
+                        "calls": calls,
+                        "wall_time": round(wall_time, 6),
+                        "cpu_time": round(cpu_time, 6),
+                        "us_per_call": round(wall_time / calls * 1_000_000, 3),
+                    }
+                    for name, (calls, wall_time, cpu_time) in self.stages.items()
+                },
+                "sources": {
+                    source: {
+                        "wall_time": round(sum(stages.values()), 6),
+                        **{name: round(t, 6) for name, t in stages.items()},
+                    }
+                    for source, stages in sorted(
+                        self.sources.items(), key=lambda s: sum(s[1].values()), reverse=True
+                    )
+                },
+            }
+
+    def print_report(self, num_sources: int = 5):
+        report = self.report()
+        for name, stage in report["stages"].items():
+            print(
+                f"time {name:10} calls: {stage['calls']:9,}"
+                f"  wall: {stage['wall_time']:8.2f}s  cpu: {stage['cpu_time']:8.2f}s"
+                f"  {stage['us_per_call']:10,.1f}us/call"
+            )
+        for source, times in list(report["sources"].items())[:num_sources]:
+            print(f"slow source: {times['wall_time']:8.2f}s {source}")
+        if report["peak_rss_mb"] is not None:
+            print(f"peak rss:   {report['peak_rss_mb']:,} mb")
@@ -0,0 +1,208 @@
+import json
+import time
+import argparse
+from pathlib import Path
+from typing import List, Dict, Iterable, Generator, Optional
+
+from bootstrap import config
+from bootstrap.positions import decode_positions
+from bootstrap.sources import scan_sources, read_image_size, tile_grid_shape
+
+
+def iter_image_stats(sources: Iterable[dict]) -> Generator[dict, None, None]:
+    """
+    Yield the tile counts of each image of the sources, calculated from the tiling
+    parameters and the image size in the file header. No pixels are decoded.
+
+    Each item has the source "url", the "filename" relative to the web-cache,
+    the (width, height) "size" (None for images without tilings or unreadable files)
+    and a list of "tilings" with the "rows" and "columns" of the tile grid,
+    the number of "tiles" (not ignored), "ignored", "duplicates" and "labeled" tiles
+    and the number of tiles of each label in "labels".
+    Positions outside the tile grid and ignored positions are not counted.
+    """
+    for source in sources:
+        for image_data in source["images"]:
+            item = {
+                "url": source["url"],
+                "filename": _relative_filename(image_data["filename"]),
+                "size": None,
+                "tilings": [],
+            }
+            if image_data["tilings"]:
+                item["size"] = read_image_size(image_data["filename"])
+
+            for tiling_index, tiling in enumerate(image_data["tilings"]):
+                rows, columns = tile_grid_shape(item["size"], tiling) if item["size"] else (0, 0)
+
+                def _in_grid(positions):
+                    return set(pos for pos in positions if 0 <= pos[0] < rows and 0 <= pos[1] < columns)
+
+                ignored = _in_grid(decode_positions(tiling.get("ignore")))
+                duplicates = _in_grid(decode_positions(tiling.get("duplicates"))) - ignored
+                labels = {
+                    label: _in_grid(decode_positions(positions)) - ignored
+                    for label, positions in (tiling.get("labels") or {}).items()
+                }
+                item["tilings"].append({
+                    "tiling_index": tiling_index,
+                    "rows": rows,
+                    "columns": columns,
+                    "tiles": rows * columns - len(ignored),
+                    "ignored": len(ignored),
+                    "duplicates": len(duplicates),
+                    "labeled": len(set().union(*labels.values())),
+                    "labels": {label: len(positions) for label, positions in labels.items() if positions},
+                })
+            yield item
+
+
+def get_summary(images: List[dict]) -> dict:
+    tilings = [t for image in images for t in image["tilings"]]
+    return {
+        "sources": len(set(image["url"] for image in images)),
+        "images": len(images),
+        "tiled_images": sum(1 for image in images if image["tilings"]),
+        "unreadable_images": sum(1 for image in images if image["tilings"] and image["size"] is None),
+        "tilings": len(tilings),
+        "tiles": sum(t["tiles"] for t in tilings),
+        "ignored": sum(t["ignored"] for t in tilings),
+        "duplicates": sum(t["duplicates"] for t in tilings),
+        "labeled": sum(t["labeled"] for t in tilings),
+        "labels": len(set(label for t in tilings for label in t["labels"])),
+    }
+
+
+def get_label_counts(images: List[dict], by_source: bool = False, label: Optional[str] = None) -> dict:
+    """
+    Number of tiles per label, or per source url and label
+    """
+    counts = {}
+    for image in images:
+        target = counts.setdefault(image["url"], {}) if by_source else counts
+        for tiling in image["tilings"]:
+            for name, count in tiling["labels"].items():
+                if label is None or name == label:
+                    target[name] = target.get(name, 0) + count
+    if by_source:
+        return {url: _sorted_counts(c) for url, c in counts.items() if c}
+    return _sorted_counts(counts)
+
+
+def get_source_stats(images: List[dict]) -> Dict[str, dict]:
+    stats = {}
+    for image in images:
+        s = stats.setdefault(
+            image["url"], {"images": 0, "tiled_images": 0, "tilings": 0, "tiles": 0, "labeled": 0},
+        )
+        s["images"] += 1
+        s["tiled_images"] += bool(image["tilings"])
+        s["tilings"] += len(image["tilings"])
+        s["tiles"] += sum(t["tiles"] for t in image["tilings"])
+        s["labeled"] += sum(t["labeled"] for t in image["tilings"])
+    return stats
+
+
+def get_untiled_images(images: List[dict]) -> Dict[str, List[str]]:
+    """
+    Filenames of the images without tilings, per source url
+    """
+    untiled = {}
+    for image in images:
+        if not image["tilings"]:
+            untiled.setdefault(image["url"], []).append(image["filename"])
+    return untiled
+
+
+def _sorted_counts(counts: Dict[str, int]) -> Dict[str, int]:
+    return dict(sorted(counts.items(), key=lambda i: (-i[1], i[0])))
+
+
+def _relative_filename(filename: str) -> str:
+    try:
+        return str(Path(filename).relative_to(config.BOOTSTRAP_WEBCACHE_PATH))
+    except ValueError:
+        return filename
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Statistics of the annotations, calculated from the tiling parameters"
+                    " without decoding any image",
+    )
+
+    parser.add_argument(
+        "command", type=str, choices=["summary", "labels", "sources", "untiled"],
+        help="summary: number of sources, images, tilings and tiles,"
+             " labels: number of tiles per label,"
+             " sources: number of images, tilings and tiles per source,"
+             " untiled: images without tilings",
+    )
+    parser.add_argument(
+        "-l", "--label", type=str, default=None,
+        help="Only count the tiles of this label",
+    )
+    parser.add_argument(
+        "-bs", "--by-source", type=bool, nargs="?", default=False, const=True,
+        help="Count the labels per source",
+    )
+    parser.add_argument(
+        "-j", "--json", type=bool, nargs="?", default=False, const=True,
+        help="Print the result as json",
+    )
+
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_args()
+
+    start_time = time.time()
+    images = list(iter_image_stats(scan_sources()))
+
+    if args["command"] == "summary":
+        result = get_summary(images)
+    elif args["command"] == "labels":
+        result = get_label_counts(images, by_source=args["by_source"], label=args["label"])
+    elif args["command"] == "sources":
+        result = get_source_stats(images)
+    else:
+        result = get_untiled_images(images)
+
+    if args["json"]:
+        print(json.dumps(result, indent=2))
+        return
+
+    if args["command"] == "summary":
+        for key, value in result.items():
+            print(f"{value:9,} {key.replace('_', ' ')}")
+
+    elif args["command"] == "labels" and args["by_source"]:
+        for url, counts in result.items():
+            print(url)
+            for label, count in counts.items():
+                print(f"  {count:9,} {label}")
+
+    elif args["command"] == "labels":
+        for label, count in result.items():
+            print(f"{count:9,} {label}")
+
+    elif args["command"] == "sources":
+        print(f"{'images':>9} {'tiled':>9} {'tilings':>9} {'tiles':>9} {'labeled':>9} url")
+        for url, s in result.items():
+            print(
+                f"{s['images']:9,} {s['tiled_images']:9,} {s['tilings']:9,}"
+                f" {s['tiles']:9,} {s['labeled']:9,} {url}"
+            )
+
+    else:
+        for url, filenames in result.items():
+            print(url)
+            for filename in filenames:
+                print(f"  {filename}")
+
+    print(f"{len(images):,} images in {(time.time() - start_time) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import json
+import urllib.parse
+from pathlib import Path
+from typing import List, Optional, Tuple, Union, Generator
+
+import PIL.Image
+
+from bootstrap import config
+from bootstrap.journal import load_source_data
+from bootstrap.positions import decode_positions
+from bootstrap.annotationdb import get_annotation_database
+
+
+DEFAULT_TILING = {
+    "offset_x": 0,
+    "offset_y": 0,
+    "patch_size_x": 16,
+    "patch_size_y": 16,
+    "spacing_x": 0,
+    "spacing_y": 0,
+    "size_x": 0,
+    "size_y": 0,
+}
+
+
+def scan_sources(
+        urls: Optional[List[str]] = None,
+        webcache_path: Optional[Union[str, Path]] = None,
+) -> List[dict]:
+    """
+    All sources with their images and annotations, without Qt.
+
+    The sources, images and tilings are in `tile_order_key` order.
+    Each source is a dict with "url", "name", "web_folder", "data_filename" and "images",
+    where each image has the absolute "filename" and its "tilings".
+    Images in the web-cache without annotations have an empty list of tilings
+    and the tilings have the positions of duplicates.json in "duplicates".
+
+    :param urls: source urls, defaults to bootstrap/data/urls.txt
+    :param webcache_path: defaults to BOOTSTRAP_WEBCACHE_PATH
+    """
+    if urls is None:
+        urls = config.SOURCE_URLS
+    webcache_path = Path(webcache_path or config.BOOTSTRAP_WEBCACHE_PATH)
+
+    source_image_map = {}
+    duplicates_map = {}
+    database = get_annotation_database()
+
+    if database is not None:
+        duplicates_map = database.get_duplicates_map()
+    else:
+        duplicates_name = config.BOOTSTRAP_DATA_PATH / "duplicates.json"
+        if duplicates_name.exists():
+            duplicates_map = json.loads(duplicates_name.read_text())
+
+    for url in sorted(urls):
+
+        name = url.split("/")[-1]
+        folder = webcache_path / "oga" / name
+
+        for file in sorted(folder.rglob("**/*")):
+            if file.suffix.lower() in (".png", ".gif") and not file.name.startswith("."):
+
+                if url not in source_image_map:
+                    source_image_map[url] = {
+                        "url": url,
+                        "name": f"oga/{urllib.parse.unquote(name)}",
+                        "web_folder": str(folder),
+                        "data_filename": str(config.BOOTSTRAP_DATA_PATH / f"oga/{name}.json"),
+                        "images": [],
+                    }
+                    if database is not None:
+                        source_image_map[url].update(database.get_source_data(url) or {})
+                    else:
+                        source_image_map[url].update(
+                            load_source_data(source_image_map[url]["data_filename"])
+                        )
+                    # temporarily convert images to dict for quicker lookup
+                    source_image_map[url]["images_map"] = {
+                        str((Path(source_image_map[url]["web_folder"]) / img["filename"]).relative_to(webcache_path)): {
+                            **img,
+                            "filename": str(Path(source_image_map[url]["web_folder"]) / img["filename"])
+                        }
+                        for img in source_image_map[url]["images"]
+                    }
+
+                relative_filename = str(file.relative_to(webcache_path))
+                if relative_filename not in source_image_map[url]["images_map"]:
+                    source_image_map[url]["images_map"][relative_filename] = {
+                        "filename": str(file),
+                        "tilings": [],
+                    }
+
+    sources = []
+    for url in sorted(source_image_map):
+        source_image_map[url]["images"] = list(source_image_map[url].pop("images_map").values())
+        for image in source_image_map[url]["images"]:
+            for tiling_index, tiling in enumerate(image["tilings"]):
+                for k, v in DEFAULT_TILING.items():
+                    tiling.setdefault(k, v)
+
+                if url in duplicates_map:
+                    filename = str(Path(image["filename"]).relative_to(webcache_path))
+                    if filename in duplicates_map[url]:
+                        if str(tiling_index) in duplicates_map[url][filename]:
+                            tiling["duplicates"] = duplicates_map[url][filename][str(tiling_index)]
+        sources.append(source_image_map[url])
+
+    return sources
+
+
+def tile_order_key(
+        url: str,
+        image_index: int,
+        tiling_index: int,
+        tile_pos: Tuple[int, int],
+) -> Tuple[str, int, int, int, int]:
+    """
+    The order in which `scan_sources` lists the tiles and `compile.py` reads them:
+    sources by url, images in the order of the annotation data (not by filename),
+    tilings and then the tiles row by row.
+    Of equal tiles, the first in this order is kept and the others are duplicates.
+    """
+    return url, image_index, tiling_index, tile_pos[0], tile_pos[1]
+
+
+def read_image_size(filename: Union[str, Path]) -> Optional[Tuple[int, int]]:
+    """
+    (width, height) of an image file from its header, the pixels are not decoded.
+    Returns None if the file can not be read.
+    """
+    try:
+        with PIL.Image.open(filename) as image:
+            return image.size
+    except (OSError, ValueError):
+        return None
+
+
+def tile_grid_shape(image_size: Tuple[int, int], tiling: dict) -> Tuple[int, int]:
+    """
+    Number of (rows, columns) of the tiles of a tiling, the tiles of `TileGrid.iter_rects`.
+
+    :param image_size: (width, height)
+    """
+    def _count(image_length: int, offset: int, patch_size: int, spacing: int, limit: int) -> int:
+        # the tiles start at offset + i * stride and must end inside the image
+        count = max(0, (image_length - patch_size - offset) // (patch_size + spacing) + 1)
+        return min(count, limit) if limit else count
+
+    width, height = image_size
+    return (
+        _count(height, tiling["offset_y"], tiling["patch_size_y"], tiling["spacing_y"], tiling.get("size_y") or 0),
+        _count(width, tiling["offset_x"], tiling["patch_size_x"], tiling["spacing_x"], tiling.get("size_x") or 0),
+    )
+
+
+class TileGrid:
+    """
+    The tiles of one tiling of an image, without Qt.
+
+    The rects are (x, y, width, height) tuples,
+    `Tiling` of `bootstrap/app/util.py` wraps the grid with QRects for the app.
+
+    :param image_size: (width, height)
+    :param tiling: tiling dict of the annotation data
+    """
+    def __init__(self, image_size: Tuple[int, int], tiling: dict):
+        self.image_size = image_size
+        self.tiling = tiling
+        self.rows, self.columns = tile_grid_shape(image_size, tiling)
+        self.ignore_tiles = decode_positions(tiling.get("ignore"))
+        self.duplicate_tiles = decode_positions(tiling.get("duplicates"))
+        self.labels = {
+            label: decode_positions(positions)
+            for label, positions in (tiling.get("labels") or {}).items()
+        }
+
+    def iter_rects(
+            self,
+            ignored: bool = False,
+            duplicates: bool = False,
+    ) -> Generator[Tuple[Tuple[int, int, int, int], Tuple[int, int]], None, None]:
+        """
+        Yield (rect, tile_pos) of the tiles in row-major order, by default
+        all tiles that are neither ignored nor duplicates
+        """
+        stride_x = self.tiling["patch_size_x"] + self.tiling["spacing_x"]
+        stride_y = self.tiling["patch_size_y"] + self.tiling["spacing_y"]
+        for row in range(self.rows):
+            for column in range(self.columns):
+                tile_pos = (row, column)
+                if ignored == (tile_pos in self.ignore_tiles) or duplicates:
+                    if duplicates == (tile_pos in self.duplicate_tiles):
+                        rect = (
+                            self.tiling["offset_x"] + column * stride_x,
+                            self.tiling["offset_y"] + row * stride_y,
+                            self.tiling["patch_size_x"],
+                            self.tiling["patch_size_y"],
+                        )
+                        yield rect, tile_pos
+
+    def get_labels_at(self, *pos: int) -> List[str]:
+        return [label for label, positions in self.labels.items() if pos in positions]
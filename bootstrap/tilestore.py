@@ -0,0 +1,194 @@
+import os
+from pathlib import Path
+from typing import Union, List, Iterable, Dict
+
+import numpy as np
+
+from bootstrap.hashing import hex_to_digests
+
+
+class TileStore:
+    """
+    Content-addressed storage of tile pixels, shared by compiled datasets.
+
+    Tiles are keyed by a 32 character hex hash (the `tile_id` of `compile.py`)
+    and appended to `chunks/<number>.bin`. The index is a file of fixed-size
+    records (key, chunk, offset, shape) that is only ever appended to,
+    after the tile data has been written.
+
+    A tile that is already stored is never written again, so datasets of
+    different filters and sizes only add the tiles they do not share.
+    Only one process should write to a store at a time.
+    """
+    INDEX_DTYPE = np.dtype([
+        ("key", "V16"),
+        ("chunk", "<u4"),
+        ("offset", "<u8"),
+        ("shape", "<u2", (3,)),
+    ])
+
+    def __init__(self, path: Union[str, Path], chunk_bytes: int = 64 * 2**20):
+        self.path = Path(path)
+        self.chunk_bytes = chunk_bytes
+        self._index_filename = self.path / "index.bin"
+        self._records = np.zeros(0, dtype=self.INDEX_DTYPE)
+        # index into _records, sorted by key
+        self._order = np.zeros(0, dtype=np.int64)
+        self._sorted_keys = np.zeros(0, dtype="V16")
+        self._pending: List[np.ndarray] = []
+        self._chunks: Dict[int, np.memmap] = {}
+
+        if self._index_filename.exists():
+            self._records = np.fromfile(self._index_filename, dtype=self.INDEX_DTYPE)
+            self._sort()
+
+    def __len__(self):
+        return len(self._records) + sum(len(p) for p in self._pending)
+
+    def __contains__(self, key: str) -> bool:
+        return bool(self.contains([key])[0])
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.path}, {len(self)} tiles)"
+
+    def contains(self, keys: Iterable[str]) -> np.ndarray:
+        """
+        Boolean array, True for each key that is stored
+        """
+        self.flush()
+        return self._find(hex_to_digests(keys)) >= 0
+
+    def put_batch(self, keys: Iterable[str], tiles: Union[np.ndarray, Iterable[np.ndarray]]) -> int:
+        """
+        Store the tiles whose keys are not yet stored.
+
+        :param keys: hex hashes
+        :param tiles: uint8 arrays of shape [H, W, C]
+        :return: int, number of written tiles
+        """
+        keys = hex_to_digests(keys)
+        is_stored = self._find(keys) >= 0
+        # keys that are repeated within the batch are only written once
+        _, first = np.unique(keys, return_index=True)
+        is_first = np.zeros(len(keys), dtype=bool)
+        is_first[first] = True
+
+        chunk = max(self._chunk_numbers(), default=0)
+        offset = self._chunk_size(chunk)
+        # chunk -> list of tile bytes
+        chunk_data: Dict[int, List[bytes]] = {}
+        records = []
+        for i, tile in enumerate(tiles):
+            if is_stored[i] or not is_first[i]:
+                continue
+            tile = np.ascontiguousarray(tile, dtype=np.uint8)
+            if tile.ndim == 2:
+                tile = tile[:, :, None]
+            if offset and offset + tile.nbytes > self.chunk_bytes:
+                chunk, offset = chunk + 1, 0
+            chunk_data.setdefault(chunk, []).append(tile.tobytes())
+            records.append((keys[i], chunk, offset, tile.shape))
+            offset += tile.nbytes
+
+        for chunk, data in chunk_data.items():
+            filename = self._chunk_filename(chunk)
+            os.makedirs(filename.parent, exist_ok=True)
+            with open(filename, "ab") as fp:
+                fp.write(b"".join(data))
+            # the memory-map of the chunk does not cover the new data
+            self._chunks.pop(chunk, None)
+
+        if records:
+            self._pending.append(np.array(records, dtype=self.INDEX_DTYPE))
+        return len(records)
+
+    def get_batch(self, keys: Iterable[str]) -> np.ndarray:
+        """
+        The tiles of the keys as [N, H, W, C] uint8 array, all tiles must have the same shape
+        """
+        self.flush()
+        keys = hex_to_digests(keys)
+        rows = self._find(keys)
+        if np.any(rows < 0):
+            missing = keys[rows < 0][0].tobytes().hex()
+            raise KeyError(f"Tile {missing} is not in {self.path}")
+
+        records = self._records[rows]
+        if not len(records):
+            return np.zeros((0, 0, 0, 0), dtype=np.uint8)
+        shapes = np.unique(records["shape"], axis=0)
+        if len(shapes) > 1:
+            raise ValueError(f"Tiles of different shapes {shapes.tolist()} can not be batched")
+        shape = tuple(int(s) for s in shapes[0])
+        tile_bytes = int(np.prod(shape))
+
+        batch = np.empty((len(records), *shape), dtype=np.uint8)
+        for chunk in np.unique(records["chunk"]):
+            in_chunk = np.nonzero(records["chunk"] == chunk)[0]
+            data = self._chunk(int(chunk))
+            offsets = records["offset"][in_chunk].astype(np.int64)
+            batch[in_chunk] = data[offsets[:, None] + np.arange(tile_bytes)].reshape(-1, *shape)
+        return batch
+
+    def get(self, key: str) -> np.ndarray:
+        return self.get_batch([key])[0]
+
+    def flush(self):
+        """
+        Append the index records of the written tiles, after their data is on disk
+        """
+        if not self._pending:
+            return
+
+        for chunk in set(int(c) for p in self._pending for c in p["chunk"]):
+            with open(self._chunk_filename(chunk), "rb+") as fp:
+                os.fsync(fp.fileno())
+
+        records = np.concatenate(self._pending)
+        self._pending.clear()
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._index_filename, "ab") as fp:
+            fp.write(records.tobytes())
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        self._records = np.concatenate([self._records, records])
+        self._sort()
+
+    def _find(self, keys: np.ndarray) -> np.ndarray:
+        """
+        Row of each key in the index (including pending rows) or -1
+        """
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        if len(self._sorted_keys):
+            positions = np.minimum(np.searchsorted(self._sorted_keys, keys), len(self._sorted_keys) - 1)
+            found = self._sorted_keys[positions] == keys
+            rows[found] = self._order[positions[found]]
+        if self._pending:
+            pending = np.concatenate([p["key"] for p in self._pending])
+            is_pending = np.isin(keys, pending)
+            # pending rows are not readable before the flush, only their existence counts
+            rows[is_pending & (rows < 0)] = len(self._records)
+        return rows
+
+    def _sort(self):
+        self._order = np.argsort(self._records["key"], kind="stable")
+        self._sorted_keys = self._records["key"][self._order]
+
+    def _chunk(self, chunk: int) -> np.memmap:
+        if chunk not in self._chunks:
+            self._chunks[chunk] = np.memmap(self._chunk_filename(chunk), dtype=np.uint8, mode="r")
+        return self._chunks[chunk]
+
+    def _chunk_size(self, chunk: int) -> int:
+        filename = self._chunk_filename(chunk)
+        return filename.stat().st_size if filename.exists() else 0
+
+    def _chunk_numbers(self) -> List[int]:
+        if not (self.path / "chunks").exists():
+            return []
+        return [int(f.stem) for f in (self.path / "chunks").glob("*.bin")]
+
+    def _chunk_filename(self, chunk: int) -> Path:
+        return self.path / "chunks" / f"{chunk:06d}.bin"
+
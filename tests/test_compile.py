@@ -0,0 +1,70 @@
+import json
+
+import numpy as np
+import PIL.Image
+import pytest
+
+from bootstrap import config
+from bootstrap.compile import DatasetCompiler
+
+TILING = {
+    "offset_x": 0, "offset_y": 0, "patch_size_x": 4, "patch_size_y": 4,
+    "spacing_x": 0, "spacing_y": 0, "size_x": 0, "size_y": 0,
+}
+URLS = [f"https://opengameart.org/content/sheet-{i}" for i in range(4)]
+
+
+@pytest.fixture
+def sources(tmp_path, monkeypatch):
+    webcache_path = tmp_path / "web-cache"
+    data_path = tmp_path / "data"
+    monkeypatch.setattr(config, "BOOTSTRAP_WEBCACHE_PATH", webcache_path)
+    monkeypatch.setattr(config, "BOOTSTRAP_DATA_PATH", data_path)
+    monkeypatch.setattr(config, "BOOTSTRAP_ANNOTATION_DB", "")
+    monkeypatch.setattr(config, "SOURCE_URLS", URLS)
+
+    rng = np.random.default_rng(0)
+    for url in URLS:
+        name = url.split("/")[-1]
+        folder = webcache_path / "oga" / name
+        folder.mkdir(parents=True)
+        PIL.Image.fromarray(rng.integers(0, 256, (8, 12, 3), dtype=np.uint8)).save(folder / "sheet.png")
+        (data_path / "oga").mkdir(parents=True, exist_ok=True)
+        (data_path / "oga" / f"{name}.json").write_text(json.dumps({
+            "images": [{"filename": "sheet.png", "tilings": [TILING]}],
+        }))
+    return data_path
+
+
+def _compile(output, **kwargs) -> DatasetCompiler:
+    compiler = DatasetCompiler(
+        size=4, duplicates=False, output=str(output), min_size=0, max_patches=0, require_label=False, **kwargs,
+    )
+    compiler.compile()
+    return compiler
+
+
+def test_compile_without_split_removes_previous_splits(sources, tmp_path):
+    output = tmp_path / "dataset"
+    _compile(output, split="50,50")
+    assert (output / "splits.npz").exists()
+
+    _compile(output)
+    assert not (output / "splits.npz").exists()
+    assert "splits" not in json.loads((output / "tiles.json").read_text())
+
+
+def test_update_recomputes_splits(sources, tmp_path):
+    output = tmp_path / "dataset"
+    _compile(output, split="50,50")
+
+    # remove the tiles of one source
+    (sources / "oga" / "sheet-1.json").write_text(json.dumps({
+        "images": [{"filename": "sheet.png", "tilings": []}],
+    }))
+    compiler = _compile(output, split="50,50", update=True)
+    assert compiler.do_update
+
+    with np.load(str(output / "splits.npz")) as splits:
+        indices = np.sort(np.concatenate([splits[name] for name in splits]))
+    assert indices.tolist() == list(range(len(compiler.rows)))
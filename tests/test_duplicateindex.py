@@ -0,0 +1,99 @@
+import os
+import json
+
+import numpy as np
+import PIL.Image
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+pytest.importorskip("PyQt5.QtGui")
+
+from bootstrap import config
+from bootstrap.sources import scan_sources
+from bootstrap.compile import DatasetCompiler
+from bootstrap.app.duplicateindex import DuplicateIndex, update_duplicate_index
+
+TILING = {
+    "offset_x": 0, "offset_y": 0, "patch_size_x": 4, "patch_size_y": 4,
+    "spacing_x": 0, "spacing_y": 0, "size_x": 0, "size_y": 0,
+}
+# the url order differs from the order of the folder names in the web-cache
+URLS = ["https://b.example.org/content/zzz", "https://c.example.org/content/aaa"]
+
+
+@pytest.fixture
+def sources(tmp_path, monkeypatch):
+    webcache_path = tmp_path / "web-cache"
+    data_path = tmp_path / "data"
+    monkeypatch.setattr(config, "BOOTSTRAP_WEBCACHE_PATH", webcache_path)
+    monkeypatch.setattr(config, "BOOTSTRAP_DATA_PATH", data_path)
+    monkeypatch.setattr(config, "BOOTSTRAP_ANNOTATION_DB", "")
+    monkeypatch.setattr(config, "SOURCE_URLS", URLS)
+
+    tile = np.random.default_rng(0).integers(0, 256, (4, 4, 3), dtype=np.uint8)
+    other = 255 - tile
+    images = {
+        # one tile, equal to the first tile of the other source
+        "zzz": {"sheet.png": tile},
+        # the annotation lists "z.png" before "a.png", both have the same two tiles
+        "aaa": {"a.png": np.concatenate([tile, other], axis=1), "z.png": np.concatenate([other, tile], axis=1)},
+    }
+    for name, files in images.items():
+        folder = webcache_path / "oga" / name
+        folder.mkdir(parents=True)
+        for filename, pixels in files.items():
+            PIL.Image.fromarray(pixels).save(folder / filename)
+        (data_path / "oga").mkdir(parents=True, exist_ok=True)
+        (data_path / "oga" / f"{name}.json").write_text(json.dumps({
+            "images": [
+                {"filename": filename, "tilings": [TILING]}
+                for filename in sorted(files, reverse=True)
+            ],
+        }))
+    return scan_sources(URLS, webcache_path)
+
+
+def _index_duplicates(sources) -> dict:
+    index = DuplicateIndex(size=4)
+    update_duplicate_index(index, sources)
+    return {
+        filename: sorted(index.duplicates(filename, tiling_index))
+        for filename, tiling_index in index.tilings()
+        if index.duplicates(filename, tiling_index)
+    }
+
+
+def _compile_duplicates() -> dict:
+    compiler = DatasetCompiler(
+        size=4, duplicates=True, output=None, min_size=0, max_patches=0, require_label=False,
+    )
+    compiler.compile()
+    return {
+        filename: sorted(tuple(pos) for pos in tilings["0"])
+        for images in compiler.duplicates_map.values()
+        for filename, tilings in images.items()
+    }
+
+
+def test_original_is_first_in_scan_order(sources):
+    assert [s["url"] for s in sources] == URLS
+
+    duplicates = _index_duplicates(sources)
+    # the tile of the first url is the original, although its filename sorts last
+    assert duplicates == {
+        "oga/aaa/a.png": [(0, 0), (0, 1)],
+        "oga/aaa/z.png": [(0, 1)],
+    }
+
+
+def test_order_is_saved(sources, tmp_path):
+    index = DuplicateIndex(tmp_path / "index.json", size=4)
+    update_duplicate_index(index, sources)
+    index.save()
+
+    loaded = DuplicateIndex(tmp_path / "index.json", size=4)
+    assert all(loaded.duplicates(*key) == index.duplicates(*key) for key in index.tilings())
+
+
+def test_index_agrees_with_compile(sources):
+    assert _index_duplicates(sources) == _compile_duplicates()
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from bootstrap.hashing import hash_rows, canonical_hash_rows, digests_to_hex, hex_to_digests
+
+
+def _tiles(count: int, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).integers(0, 2**32, (count, 4, 4), dtype=np.uint32)
+
+
+def test_hash_rows_empty():
+    for data in (np.zeros((0, 16), dtype=np.uint8), np.zeros((0, 4, 4), dtype=np.uint32), []):
+        digests = hash_rows(data)
+        assert digests.shape == (0,)
+        assert digests.dtype == np.dtype("V16")
+
+
+@pytest.mark.parametrize("transforms, palette", [(False, False), (True, False), (False, True), (True, True)])
+def test_canonical_hash_rows_empty(transforms, palette):
+    for tiles in (np.zeros((0, 4, 4), dtype=np.uint32), []):
+        digests = canonical_hash_rows(tiles, transforms=transforms, palette=palette)
+        assert digests.shape == (0,)
+        assert digests.dtype == np.dtype("V16")
+
+
+def test_hash_rows_equal_rows():
+    tiles = _tiles(3)
+    digests = hash_rows(np.concatenate([tiles, tiles[:1]]))
+    assert digests[0] == digests[3]
+    assert len(set(digests_to_hex(digests))) == 3
+    assert np.array_equal(hex_to_digests(digests_to_hex(digests)), digests)
+
+
+def test_canonical_hash_rows_transforms_and_palette():
+    tiles = _tiles(1) | np.uint32(0xff000000)
+    rotated = np.rot90(tiles, 1, axes=(1, 2))
+    recolored = tiles ^ np.uint32(0x00ffffff)
+    digests = canonical_hash_rows(np.concatenate([tiles, rotated, recolored]), transforms=True, palette=True)
+    assert digests[0] == digests[1] == digests[2]
+    digests = canonical_hash_rows(np.concatenate([tiles, rotated]), transforms=False)
+    assert digests[0] != digests[1]
@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+
+from bootstrap.images import cut_tiles, scale_tiles
+
+
+def _pixels(height: int, width: int, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).integers(0, 2**32, (height, width), dtype=np.uint32)
+
+
+@pytest.mark.parametrize("size", [(4, 4), (8, 8), (5, 3), (16, 16)])
+def test_cut_then_scale_equals_cut_scaled(size):
+    pixels = _pixels(20, 24)
+    rects = [(0, 0, 8, 8), (8, 4, 8, 8), (20, 16, 8, 8), (-2, -3, 8, 8)]
+    cut = cut_tiles(pixels, rects, (8, 8))
+    assert np.array_equal(scale_tiles(cut, size), cut_tiles(pixels, rects, size))
+
+
+def test_scale_tiles_same_size_is_unchanged():
+    tiles = _pixels(12, 4).reshape(3, 4, 4)
+    assert scale_tiles(tiles, (4, 4)) is tiles
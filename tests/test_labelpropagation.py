@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+pytest.importorskip("PyQt5.QtGui")
+
+from bootstrap import config
+from bootstrap.app.labelpropagation import propagate_labels
+
+
+class _Index:
+    """
+    The `tile_hashes` of a DuplicateIndex, every tile of the tiling has the same hash
+    """
+    def tile_hashes(self, filename: str, tiling_index: int) -> dict:
+        return {(0, 0): "h", (0, 1): "h", (0, 2): "h"}
+
+
+def _sources(tiling: dict) -> list:
+    return [{
+        "url": "https://example.org/content/a",
+        "images": [{"filename": str(config.BOOTSTRAP_WEBCACHE_PATH / "oga/a/sheet.png"), "tilings": [tiling]}],
+    }]
+
+
+def test_labeled_tile_suggests_label():
+    suggestions, conflicts = propagate_labels(_Index(), _sources({"labels": {"wall": [[0, 0]]}}))
+    assert [s["pos"] for s in suggestions] == [[0, 1], [0, 2]]
+    assert all(s["labels"] == ["wall"] for s in suggestions)
+    assert conflicts == []
+
+
+def test_ignored_tiles_do_not_vote():
+    tiling = {"labels": {"wall": [[0, 0]], "floor": [[0, 1]]}, "ignore": [[0, 1]]}
+    suggestions, conflicts = propagate_labels(_Index(), _sources(tiling))
+    # without the ignored "floor" tile there is no conflict
+    assert conflicts == []
+    assert [(s["pos"], s["labels"]) for s in suggestions] == [([0, 2], ["wall"])]
@@ -0,0 +1,73 @@
+import time
+import itertools
+
+import pytest
+
+from bootstrap.pipeline import Pipeline
+
+
+def _counting_source(counter: list, delay: float = .005):
+    def _source():
+        for i in itertools.count():
+            counter.append(i)
+            time.sleep(delay)
+            yield i
+    return _source
+
+
+def _take(count: int):
+    def _stage(items):
+        for item in itertools.islice(items, count):
+            yield item
+    return _stage
+
+
+def test_items_in_order():
+    pipeline = (
+        Pipeline(queue_size=2)
+        .add_stage("source", lambda: range(100))
+        .add_stage("double", lambda items: (i * 2 for i in items))
+    )
+    assert list(pipeline) == [i * 2 for i in range(100)]
+
+
+def test_early_return_stops_previous_stages():
+    decoded = []
+    pipeline = (
+        Pipeline(queue_size=16, poll_interval=.01)
+        .add_stage("decode", _counting_source(decoded))
+        .add_stage("dedupe", _take(3))
+        .add_stage("write", lambda items: (time.sleep(.05) or i for i in items))
+    )
+    assert list(pipeline) == [0, 1, 2]
+    # the decode stage stops with the dedupe stage, not when its queue is full
+    # or after the slower write stage finished
+    assert len(decoded) <= 5
+
+
+def test_leaving_iteration_stops_all_stages():
+    decoded = []
+    pipeline = (
+        Pipeline(queue_size=16, poll_interval=.01)
+        .add_stage("decode", _counting_source(decoded))
+        .add_stage("copy", lambda items: (i for i in items))
+    )
+    for item in pipeline:
+        if item == 2:
+            break
+    num_decoded = len(decoded)
+    time.sleep(.05)
+    assert len(decoded) == num_decoded
+    assert num_decoded <= 5
+
+
+def test_exception_is_raised():
+    def _fail(items):
+        for item in items:
+            if item == 3:
+                raise ValueError("failed")
+            yield item
+
+    pipeline = Pipeline().add_stage("source", lambda: range(10)).add_stage("fail", _fail)
+    with pytest.raises(ValueError, match="failed"):
+        list(pipeline)
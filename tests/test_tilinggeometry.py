@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+pytest.importorskip("PyQt5.QtWidgets")
+
+from PyQt5 import sip
+from PyQt5.QtCore import QSize
+from PyQt5.QtWidgets import QApplication
+
+from bootstrap.app.tilinggeometry import TilingGeometryWorker, compute_tiling_geometry
+
+TILING = {
+    "offset_x": 0, "offset_y": 0, "patch_size_x": 4, "patch_size_y": 4,
+    "spacing_x": 0, "spacing_y": 0, "size_x": 0, "size_y": 0,
+}
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QApplication.instance() or QApplication([])
+
+
+def test_geometry_rects(app):
+    geometry = compute_tiling_geometry(1, QSize(10, 8), TILING, zoom=2)
+    assert sorted(geometry.rects) == [(0, 0), (0, 1), (1, 0), (1, 1)]
+    assert geometry.rects[(1, 1)].getRect() == (8, 8, 8, 8)
+    assert not geometry.outside.isEmpty()
+
+
+def test_stop_ends_the_thread(app):
+    worker = TilingGeometryWorker()
+    worker.request(QSize(4096, 4096), TILING, 1)
+    thread = worker._thread
+    worker.stop()
+    assert not thread.is_alive()
+    # stopping twice is fine
+    worker.stop()
+
+
+def test_deleting_the_widget_stops_the_worker(app):
+    from bootstrap.app.imagepatchwidget import ImagePatchWidget
+
+    widget = ImagePatchWidget()
+    worker = widget._geometry_worker
+    worker.request(QSize(4096, 4096), TILING, 1)
+    thread = worker._thread
+    sip.delete(widget)
+    assert not thread.is_alive()